@@ -1,10 +1,51 @@
 const composer = require('@ibm-functions/composer')
 
+// compiled from OpenAQ-ETL.bpmn by code/tools/bpmn_compiler.py
+
+// runs body on the items of params.value, at most budget of them at a time,
+// max_concurrency of the run when budget is 0 and 40 without it
+const windowed = (budget, body) => composer.let(
+    { items: [], results: [], budget: budget },
+    composer.function(params => { items = params.value; budget = budget || params.max_concurrency || 40 }),
+    composer.while(
+        () => items.length > 0,
+        composer.sequence(
+            composer.function(() => ({ value: items.splice(0, budget) })),
+            composer.map(body),
+            composer.function(({ value }) => { results = results.concat(value) }))),
+    composer.function(() => ({ value: results })))
+
+// composer.retry retries at once, retryInterval and backoffRate only apply on AWS
 module.exports = composer.sequence(
-    composer.action('ListFiles', { limits: { timeout: 300000 } }),
-    composer.map(
-        composer.action('TransformData', { limits: { timeout: 300000 } })
-    ),
-    composer.action('AggregateData', { limits: { timeout: 300000 } }),
-    composer.action('CleanUp', { limits: { timeout: 300000 } })
-)
\ No newline at end of file
+    composer.retry(2, composer.action('ListFiles', { limits: { timeout: 300000 } })),
+    composer.retain(
+        windowed(0, composer.retry(2, composer.action('TransformData', { limits: { timeout: 600000 } })))),
+    composer.function(({ params, result }) => Object.assign(params, { value: result.value })),
+    // a combine level merges groups of 16 results, so no AggregateData reads more of them
+    composer.if(
+        params => params.value.length > 16,
+        composer.sequence(
+            composer.retain(
+                composer.sequence(
+                    composer.function(params => ({
+                        value: Array.from({ length: Math.ceil(params.value.length / 16) }, (_, i) => ({
+                            combine: true, value: params.value.slice(i * 16, i * 16 + 16), trace: params.trace
+                        })),
+                        max_concurrency: params.max_concurrency
+                    })),
+                    windowed(0, composer.action('AggregateData', { limits: { timeout: 300000 } })))),
+            composer.function(({ params, result }) => Object.assign(params, {
+                value: [].concat(...result.value.map(output => output.value))
+            })))),
+    // one AggregateData per date, each with the results of its date
+    composer.retain(
+        composer.sequence(
+            composer.function(params => ({
+                value: params.days.map(date => ({
+                    date: date, value: params.value.filter(item => item.date === date), trace: params.trace
+                })),
+                max_concurrency: params.max_concurrency
+            })),
+            windowed(0, composer.action('AggregateData', { limits: { timeout: 300000 } })))),
+    composer.function(({ params, result }) => Object.assign(params, { value: result.value })),
+    composer.retry(2, composer.action('CleanUp', { limits: { timeout: 300000 } })))
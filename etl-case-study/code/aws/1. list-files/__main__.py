@@ -1,42 +1,136 @@
-import boto3
+import json
+import logging
 import os
-from botocore import UNSIGNED
-from botocore.client import Config
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
-from datetime import datetime, timedelta
-
-s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+import planning
+import storage
+import tracing
 
 OPENAQ_BUCKET = 'openaq-fetches'
 DATA_PREFIX = 'realtime-gzipped'
+# finalize the partial results of the event-driven TransformData instead of listing files
+INCREMENTAL_MODE = os.environ.get('INCREMENTAL_MODE', 'false').lower() == 'true'
+# parallel activities shared by all days and chunks of a run
+MAX_CONCURRENCY = 40
+# files per chunk if the event sets no chunk size and there is no telemetry yet
+CHUNK_SIZE = 12
+# bucket of the reducer telemetry, one object per run and day, unset to keep the static chunk size
+RESULTS_BUCKET = os.environ.get('RESULTS_BUCKET')
+TELEMETRY_FOLDER = 'openaq/telemetry/'
+TELEMETRY_RUNS = int(os.environ.get('TELEMETRY_RUNS', 7))
+
+log = logging.getLogger()
+
+def get_target_days(event):
+    """Days to process, read from the input object at invocation time
+    Parameters
+    ----------
+    event: dict, required
+        Input object with an optional 'date' or 'start_date' and 'end_date' (YYYY-MM-DD)
+    Returns
+    -------
+    days: list
+        Days in the range, both ends included, the previous day by default
+    """
 
-# look for all files from previous day
-prev_day = datetime.utcnow() - timedelta(days=1)
-prev_day = prev_day.strftime('%Y-%m-%d')
-prefix = '{}/{}/'.format(DATA_PREFIX, prev_day)
+    if 'start_date' in event:
+        start = date.fromisoformat(event['start_date'])
+        end = date.fromisoformat(event.get('end_date', event['start_date']))
+    elif 'date' in event:
+        start = end = date.fromisoformat(event['date'])
+    else:
+        start = end = datetime.utcnow().date() - timedelta(days=1)
+    if end < start:
+        log.error(f'Backfill ends before it starts: {start} to {end}')
+        raise ValueError(f'end_date {end} is before start_date {start}')
+    return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
 
-def get_file_inventory():
+
+def get_file_inventory(day):
+    prefix = '{}/{}/'.format(DATA_PREFIX, day)
     try:
-        response = s3.list_objects_v2(Bucket=OPENAQ_BUCKET, Prefix=prefix)
-        file_names = [item['Key'] for item in response['Contents']]
+        # listed page by page, a day can hold more than 1000 files
+        objects = list(storage.open_bucket(OPENAQ_BUCKET, unsigned=True).list(prefix))
     except Exception as e:
         print('Unable to list OpenAQ files')
         raise
-    return file_names
+    if not objects:
+        log.warning(f'No OpenAQ files for {day}')
+    return objects
+
+
+def read_telemetry():
+    """Read the mapper chunks of the latest runs from the telemetry written by the reducers
+    Returns
+    -------
+    chunks: list of dicts
+        Bytes, rows, duration and memory of each chunk, oldest first, empty without telemetry
+    """
+
+    if not RESULTS_BUCKET:
+        return []
+    try:
+        bucket = storage.open_bucket(RESULTS_BUCKET)
+        keys = sorted(item['key'] for item in bucket.list(TELEMETRY_FOLDER))
+        chunks = []
+        for key in keys[-TELEMETRY_RUNS:]:
+            chunks.extend(json.loads(bucket.get(key))['chunks'])
+    except Exception as e:
+        log.warning('Unable to read telemetry, chunks keep the static size')
+        log.debug(e)
+        return []
+    return chunks
 
 
 def main(event, context):
-    # default chunk size if no value is provided in the input
-    chunk_size = 12
+    # a chunk size in the input overrides the sizing from the telemetry of earlier runs
+    chunk_size = None
 
     if 'chunk_size' in event: 
         if type(event['chunk_size']) == int:
             chunk_size = event['chunk_size']
+
+    max_concurrency = event.get('max_concurrency', MAX_CONCURRENCY)
+    days = get_target_days(event)
+    # the run starts here, its trace context travels with every chunk and result
+    trace = tracing.start(event, 'ListFiles', days=len(days))
+    try:
+        if event.get('incremental', INCREMENTAL_MODE):
+            # TransformData already wrote partial results as the files arrived,
+            # so the reducers only finalize the days
+            trace.end()
+            return {
+                "value": [],
+                "days": days,
+                "max_concurrency": max_concurrency,
+                "trace": trace.context(),
+                "message": "Init phase complete, finalizing partial results"}
+
+        # a backfill lists each day with its own request
+        with trace.span('list'), ThreadPoolExecutor(max_workers=max(1, min(len(days), 8))) as executor:
+            inventories = list(executor.map(get_file_inventory, days))
+
+        with trace.span('telemetry'):
+            model = None if chunk_size else planning.estimate_mapper_model(read_telemetry())
+        if model:
+            planned = planning.plan_chunks(days, inventories, model, max_concurrency)
+        else:
+            chunk_size = chunk_size or CHUNK_SIZE
+            planned = planning.fixed_chunks(days, inventories, chunk_size)
+        # chunks never mix days, so every mapper reports the day it worked on
+        chunks = [{"date": day, "files": files, "trace": trace.context()} for day, files in planned]
     
-    file_names = get_file_inventory()
-    chunks = [file_names[i:i + chunk_size]
-            for i in range(0, len(file_names), chunk_size)]
-    
-    return {
-        "value": chunks, 
-        "message": "Init phase complete"}
\ No newline at end of file
+        trace.end(chunks=len(chunks))
+
+        return {
+            "value": chunks, 
+            "days": [day for day, objects in zip(days, inventories) if objects],
+            "max_concurrency": max_concurrency,
+            "trace": trace.context(),
+            "message": "Init phase complete"}
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
@@ -1,30 +1,160 @@
-import boto3
-from boto3.s3.transfer import TransferConfig
-import botocore
+import botocore.exceptions
 import gzip
+import io
 import json
 import logging
+import math
+import multiprocessing
 import os
-import pandas as pd
-import warnings
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
 
-from pandas.io.json import json_normalize
+import storage
+import tracing
 
-s3 = boto3.client('s3')
+# pandas is imported on first use to keep the module import cheap
 
 OPENAQ_BUCKET = 'openaq-fetches'
+DATA_PREFIX = 'realtime-gzipped'
+SECONDS_PER_DAY = 24 * 60 * 60
 RESULTS_BUCKET = os.environ['RESULTS_BUCKET']
 TEMP_FOLDER_TEMPLATE = 'openaq/temp/{}'
+# partial results of the incremental mode, per day and source object
+PARTIAL_FILE_TEMPLATE = 'partials/{}/{}.json.{}'
+
+COLUMNS_TO_KEEP = ['country', 'city', 'location', 'parameter', 'value', 'unit', 'date.utc']
+# repeated strings are held as categoricals with a dictionary shared across frames
+CATEGORICAL_COLUMNS = ['country', 'city', 'location', 'parameter', 'unit']
+# a reading is identified by its station, parameter and timestamp
+DEDUP_KEY = ['country', 'city', 'location', 'parameter', 'date.utc']
+# 'wide' pivots parameters into columns, 'long' keeps one row per reading
+INTERMEDIATE_LAYOUT = os.environ.get('INTERMEDIATE_LAYOUT', 'wide')
+LONG_COLUMNS = ['country', 'city', 'location', 'parameter', 'date.utc', 'value']
+# number of parse processes, 0 picks one per available vCPU
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 0))
+# source objects kept in /tmp across warm invocations, evicted least recently used first
+CACHE_FOLDER = '/tmp/openaq-cache'
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# optional prefix in the results bucket shared by all containers, e.g. openaq/cache
+SHARED_CACHE_PREFIX = os.environ.get('SHARED_CACHE_PREFIX')
+# codec of the intermediate files, gzip, zstd or lz4, recorded in the object metadata for the reducer
+INTERMEDIATE_CODEC = os.environ.get('INTERMEDIATE_CODEC', 'gzip')
+CODEC_LEVELS = {'gzip': 9, 'zstd': 3, 'lz4': 0}
+CODEC_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst', 'lz4': 'lz4'}
+INTERMEDIATE_LEVEL = int(os.environ.get('INTERMEDIATE_LEVEL', CODEC_LEVELS[INTERMEDIATE_CODEC]))
+# part size and concurrency of ranged GETs, derived from the function memory if 0
+RANGED_GET_PART_SIZE = int(os.environ.get('RANGED_GET_PART_SIZE', 0))
+RANGED_GET_WORKERS = int(os.environ.get('RANGED_GET_WORKERS', 0))
+MAX_RANGED_GET_WORKERS = 16
+# ranged GETs in flight, never more than the cap, the storage layer adds connections for the part uploads
+DOWNLOAD_CONCURRENCY = min(RANGED_GET_WORKERS or MAX_RANGED_GET_WORKERS, MAX_RANGED_GET_WORKERS)
+
+# source key -> ETag, local path and size of the cached copy
+cache = OrderedDict()
 
 log = logging.getLogger()
 
 
-def download_data(filename):
-    """Download a file from S3
+def get_source_bucket(bucket=OPENAQ_BUCKET):
+    """Open the bucket source objects are read from
+    Parameters
+    ----------
+    bucket: string, optional
+        Name of the source bucket
+    Returns
+    -------
+    source: Storage
+        Storage of the bucket, with connections for the ranged GETs
+    """
+
+    return storage.open_bucket(bucket, concurrency=DOWNLOAD_CONCURRENCY)
+
+
+def get_results_bucket():
+    """Open the results bucket
+    Returns
+    -------
+    results: Storage
+        Storage of the S3 results bucket, sharing the client of the source bucket
+    """
+
+    return storage.open_bucket(RESULTS_BUCKET, concurrency=DOWNLOAD_CONCURRENCY)
+
+
+def is_modified(filename, etag, bucket=OPENAQ_BUCKET):
+    """Check whether a source object changed since it was cached
+    Parameters
+    ----------
+    filename: string, required
+        Name of the file in S3 source bucket (OpenAQ)
+    etag: string, required
+        ETag of the cached copy
+    bucket: string, optional
+        Name of the source bucket
+    Returns
+    -------
+    modified: bool
+        False if the cached copy is still current
+    """
+
+    return get_source_bucket(bucket).head(filename)['etag'] != etag
+
+
+def get_ranged_get_parts():
+    """Part size and concurrency of ranged GETs
+    Returns
+    -------
+    part_size: int
+        Bytes per ranged GET
+    workers: int
+        Ranged GETs in flight per object
+    """
+
+    # parts in flight may take a quarter of the function memory
+    budget = tracing.get_memory_size() // 4
+    workers = min(RANGED_GET_WORKERS, MAX_RANGED_GET_WORKERS) or max(2, min(MAX_RANGED_GET_WORKERS, budget // (8 * 1024 * 1024)))
+    part_size = RANGED_GET_PART_SIZE or max(4 * 1024 * 1024, min(32 * 1024 * 1024, budget // workers))
+    return part_size, workers
+
+
+def fetch_shared(filename, data_file, bucket=OPENAQ_BUCKET):
+    """Download a source object through the shared cache in the results bucket
     Parameters
     ----------
     filename: string, required
         Name of the file in S3 source bucket (OpenAQ)
+    data_file: string, required
+        Local path to write to
+    bucket: string, optional
+        Name of the source bucket
+    Returns
+    -------
+    etag: string
+        ETag of the source object
+    """
+
+    etag = get_source_bucket(bucket).head(filename)['etag']
+    shared_key = '{}/{}/{}'.format(SHARED_CACHE_PREFIX, etag.strip('"'), os.path.basename(filename))
+    try:
+        get_results_bucket().download(shared_key, data_file, *get_ranged_get_parts())
+        return etag
+    except storage.NotFound:
+        pass
+    etag = get_source_bucket(bucket).download(filename, data_file, *get_ranged_get_parts())['etag']
+    get_results_bucket().upload(shared_key, data_file)
+    return etag
+
+
+def download_data(filename, bucket=OPENAQ_BUCKET):
+    """Download a file from S3, reusing the copy of an earlier invocation
+    Parameters
+    ----------
+    filename: string, required
+        Name of the file in S3 source bucket (OpenAQ)
+    bucket: string, optional
+        Name of the source bucket, another one receives new objects in incremental mode
     Returns
     -------
     data_file: string
@@ -32,22 +162,234 @@ def download_data(filename):
     """
 
     try:
-        config = TransferConfig(max_concurrency=2)
-        data_file = os.path.join('/tmp', os.path.basename(filename))
-        s3.download_file(OPENAQ_BUCKET, filename, data_file, Config=config)
-    except botocore.exceptions.ClientError as e:
+        cached = cache.get(filename)
+        if cached is not None and not is_modified(filename, cached['etag'], bucket):
+            cache.move_to_end(filename)
+            log.info(f'Using cached copy of {filename}')
+            return cached['path']
+
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        data_file = os.path.join(CACHE_FOLDER, filename.replace('/', '_'))
+        if SHARED_CACHE_PREFIX:
+            etag = fetch_shared(filename, data_file, bucket)
+        else:
+            etag = get_source_bucket(bucket).download(filename, data_file, *get_ranged_get_parts())['etag']
+        cache[filename] = {'etag': etag, 'path': data_file, 'size': os.path.getsize(data_file)}
+        cache.move_to_end(filename)
+    except (botocore.exceptions.ClientError, storage.NotFound) as e:
         log.error(f'Unable to download data: {filename}')
         log.debug(e)
         raise
     return data_file
 
 
-def process_data(dataframes):
+def trim_cache():
+    """Evict least recently used source objects until the cache fits CACHE_MAX_BYTES
+    """
+
+    size = sum(entry['size'] for entry in cache.values())
+    while cache and size > CACHE_MAX_BYTES:
+        _, entry = cache.popitem(last=False)
+        size -= entry['size']
+        try:
+            os.remove(entry['path'])
+        except FileNotFoundError:
+            pass
+
+
+def get_day_window(filename):
+    """Time window of the day an OpenAQ file holds readings for
+    Parameters
+    ----------
+    filename: string, required
+        Name of the file in the OpenAQ bucket, realtime-gzipped/<date>/<file>
+    Returns
+    -------
+    window: tuple of int or None
+        Start and end of the day in epoch seconds, None if the name has no date
+    """
+
+    parts = filename.split('/')
+    if len(parts) < 3 or parts[0] != DATA_PREFIX:
+        return None
+    try:
+        day = datetime.strptime(parts[1], '%Y-%m-%d').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    start = int(day.timestamp())
+    return start, start + SECONDS_PER_DAY
+
+
+def get_parse_workers():
+    """Number of processes used to parse raw files
+    Returns
+    -------
+    workers: int
+        PARSE_WORKERS if set, otherwise one per vCPU of the function
+    """
+
+    if PARSE_WORKERS > 0:
+        return PARSE_WORKERS
+    cpus = os.cpu_count() or 1
+    # Lambda allocates CPU in proportion to memory, one vCPU per 1769 MB
+    memory = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 0))
+    if memory:
+        return max(1, min(cpus, math.ceil(memory / 1769)))
+    return cpus
+
+
+def parse_data(data_file, window=None):
+    """Decompress and parse a raw OpenAQ file
+    Parameters
+    ----------
+    data_file: string, required
+        Local path to a gzipped ndjson file
+    window: tuple of int, optional
+        Start and end of the target day in epoch seconds, rows outside are dropped
+    Returns
+    -------
+    df: Pandas dataframe
+        Raw air quality data restricted to the columns we need in compact
+        dtypes, without repeated readings and with the hash of each reading's key
+    discarded: int
+        Number of rows outside the target day
+    """
+
+    import pandas as pd
+    from pandas import json_normalize
+
+    with gzip.open(data_file, 'rb') as ndjson_file:
+        records = map(json.loads, ndjson_file)
+        df = pd.DataFrame.from_records(json_normalize(records))
+    # drop unused columns before the frame is sent to the parent process
+    df = apply_schema(df[df.columns.intersection(COLUMNS_TO_KEEP)])
+    discarded = 0
+    if window is not None:
+        # there is occasionally historic data in the source, drop it before it is hashed
+        timestamps = df['date.utc'].values
+        in_window = (timestamps >= window[0]) & (timestamps < window[1])
+        discarded = int(len(df) - in_window.sum())
+        df = df[in_window]
+    # a compact uint64 hash per reading key makes duplicate checks cheap
+    df = df.assign(key_hash=pd.util.hash_pandas_object(df[DEDUP_KEY], index=False).values)
+    return df[~df['key_hash'].duplicated().values], discarded
+
+
+def apply_schema(df):
+    """Convert raw air quality data to compact dtypes
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Raw air quality data
+    Returns
+    -------
+    df: Pandas dataframe
+        Data with categorical keys, float32 readings and int64 epoch seconds
+    """
+
+    import pandas as pd
+
+    dtypes = {column: 'category' for column in CATEGORICAL_COLUMNS if column in df}
+    dtypes['value'] = 'float32'
+    timestamps = pd.to_datetime(df['date.utc'], utc=True).values.astype('int64')
+    return df.astype(dtypes).assign(**{'date.utc': timestamps // 10**9})
+
+
+def parse_worker(jobs, connection):
+    """Parse a share of the files in a child process
+    Parameters
+    ----------
+    jobs: list, required
+        Local paths and day windows of the files assigned to this worker
+    connection: multiprocessing Connection, required
+        Pipe end used to send the parsed dataframes back
+    """
+
+    try:
+        connection.send([parse_data(*job) for job in jobs])
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+def parse_data_parallel(jobs, workers):
+    """Parse files in child processes, one per available vCPU
+    Parameters
+    ----------
+    jobs: list, required
+        Local paths to downloaded files with their day windows
+    workers: int, required
+        Number of child processes
+    Returns
+    -------
+    results: list of tuples
+        Parsed air quality data and number of discarded rows per file
+    """
+
+    # multiprocessing.Pool needs /dev/shm, which is missing on AWS Lambda,
+    # so results are sent back over plain pipes instead
+    processes = []
+    for i in range(workers):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=parse_worker, args=(jobs[i::workers], sender))
+        process.start()
+        sender.close()
+        processes.append((process, receiver))
+
+    results = []
+    failure = None
+    for process, receiver in processes:
+        # receive before joining, large results would otherwise block the child
+        result = receiver.recv()
+        process.join()
+        if isinstance(result, Exception):
+            failure = result
+        else:
+            results.extend(result)
+    if failure is not None:
+        log.error("Error parsing data")
+        raise failure
+    return results
+
+
+def concat_compact(dataframes):
+    """Concatenate dataframes without losing their categorical columns
+    Parameters
+    ----------
+    dataframes: list of Pandas dataframes, required
+        Dataframes with compact dtypes
+    Returns
+    -------
+    data: Pandas dataframe
+        Combined dataframe with compact dtypes
+    """
+
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+
+    # pd.concat falls back to object dtype when categories differ,
+    # so all frames are recoded to one shared dictionary first
+    for column in CATEGORICAL_COLUMNS:
+        if not all(column in df for df in dataframes):
+            continue
+        categories = union_categoricals(
+            [df[column] for df in dataframes], ignore_order=True).categories
+        dataframes = [
+            df.assign(**{column: df[column].cat.set_categories(categories)})
+            for df in dataframes]
+    return pd.concat(dataframes, sort=False)
+
+
+def process_data(dataframes, layout='wide'):
     """Combine datasets and process to extract required fields
     Parameters
     ----------
     dataframes: list of Pandas dataframes, required
         List of dataframes with raw air quality data
+    layout: string, optional
+        'wide' to pivot parameters into columns, 'long' to keep one row per reading
     Returns
     -------
     parameter_readings: Pandas dataframe
@@ -56,22 +398,29 @@ def process_data(dataframes):
 
     try:
         # combine into single dataframe
-        data = pd.concat(dataframes, sort=False)
-        
+        data = concat_compact(dataframes)
+        # overlapping fetch files repeat readings, keep the first one of each key
+        unique = ~data['key_hash'].duplicated().values
+
         # keep only coulumns we need
-        columns_to_keep = ['country','city','location','parameter','value', 'unit','date.utc']
-        data.drop(set(data.columns.values) - set(columns_to_keep), axis=1, inplace=True)
-        log.info(f"Total rows to process: {len(data)}")
-
-        # pivot to convert air quality parameters to columns
-        parameter_readings = data.pivot_table(
-            index=[
-                'country',
-                'city',
-                'location',
-                'date.utc'],
-            columns='parameter',
-            values='value').reset_index()
+        data.drop(set(data.columns.values) - set(COLUMNS_TO_KEEP), axis=1, inplace=True)
+        data = data[unique]
+        log.info(f"Total rows to process: {len(data)}, duplicates dropped: {(~unique).sum()}")
+
+        if layout == 'long':
+            # the reducer widens the daily summary only when writing the output
+            parameter_readings = data[LONG_COLUMNS].reset_index(drop=True)
+        else:
+            # pivot to convert air quality parameters to columns
+            parameter_readings = data.pivot_table(
+                index=[
+                    'country',
+                    'city',
+                    'location',
+                    'date.utc'],
+                columns='parameter',
+                values='value',
+                observed=True).reset_index()
     except Exception as e:
         log.error("Error processing data")
         log.debug(e)
@@ -79,54 +428,168 @@ def process_data(dataframes):
     return parameter_readings
 
 
-def upload_intermediate_results(results):
-    """Upload a file to S3
+def open_compressor(fileobj):
+    """Open a compressing stream with the codec of the intermediate files
     Parameters
     ----------
+    fileobj: file object, required
+        Binary stream the compressed data is written to, stays open on close
+    Returns
+    -------
+    compressed: file object
+        Binary stream compressing into fileobj
+    """
+
+    if INTERMEDIATE_CODEC == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=INTERMEDIATE_LEVEL).stream_writer(fileobj, closefd=False)
+    if INTERMEDIATE_CODEC == 'lz4':
+        import lz4.frame
+        return lz4.frame.LZ4FrameFile(fileobj, mode='wb', compression_level=INTERMEDIATE_LEVEL)
+    return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=INTERMEDIATE_LEVEL)
+
+
+def upload_intermediate_results(df, results):
+    """Stream compressed intermediate results to S3 as JSON
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Intermediate results
     results: string, required
-        Name of the local file with intermediate results
+        Name of the file with intermediate results
     """
 
-    results_path = os.path.join('/tmp', results)
-    # upload to target S3 bucket
+    # compressed straight into the upload parts, nothing is written to the temporary folder
     try:
-        response = s3.upload_file(
-            results_path,
-            RESULTS_BUCKET,
-            TEMP_FOLDER_TEMPLATE.format(results))
+        with get_results_bucket().open_writer(TEMP_FOLDER_TEMPLATE.format(results), {'codec': INTERMEDIATE_CODEC}) as writer:
+            with open_compressor(writer) as compressed, io.TextIOWrapper(compressed, encoding='utf-8') as text:
+                df.to_json(text)
         log.info("Uploaded temp results to s3://{}/".format(RESULTS_BUCKET) + TEMP_FOLDER_TEMPLATE.format(results))
     except botocore.exceptions.ClientError as e:
         log.error(f'Unable to upload intermediate results: {results}')
         log.debug(e)
         raise
 
-def main(event, context):
-    dataframes = []
-    # download files locally
-    for filename in event:
-        data_file = download_data(filename)
-        # read each file and store as Pandas dataframe
-        with gzip.open(data_file, 'rb') as ndjson_file:
-            records = map(json.loads,ndjson_file)
-            df = pd.DataFrame.from_records(json_normalize(records))
-            dataframes.append(df)
-
-    # process the data to get air quality readings
-    parameter_readings = process_data(dataframes)
-
-    # write to file
-    results_filename = "{}.json.gz".format(context.aws_request_id)
-    parameter_readings.to_json(
-        os.path.join(
-            '/tmp',
-            results_filename),
-        compression='gzip')
-
-    # upload to target S3 bucket
-    upload_intermediate_results(results_filename)
-
-    # return temp file and number of rows processed.
+
+def get_new_objects(event):
+    """Source objects named in a storage event
+    Parameters
+    ----------
+    event: dict, required
+        S3 event, sent directly or wrapped in SNS notifications
+    Returns
+    -------
+    objects: list of tuples
+        Bucket and key of each new object
+    """
+
+    objects = []
+    for record in event['Records']:
+        if 'Sns' in record:
+            objects.extend(get_new_objects(json.loads(record['Sns']['Message'])))
+        else:
+            objects.append((record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])))
+    return objects
+
+
+def update_partial_results(bucket, filename):
+    """Transform a new source object into partial results of its day
+    Parameters
+    ----------
+    bucket: string, required
+        Name of the bucket that received the object
+    filename: string, required
+        Name of the object, realtime-gzipped/<date>/<file>
+    Returns
+    -------
+    partial: dict
+        Partial results file with its day and row counts, None if the name has no date
+    """
+
+    window = get_day_window(filename)
+    if window is None:
+        log.warning(f'Skipping {filename}, its name has no date')
+        return None
+    day = datetime.fromtimestamp(window[0], timezone.utc).strftime('%Y-%m-%d')
+
+    df, discarded_rows = parse_data(download_data(filename, bucket), window)
+    # partials keep one row per reading, so the daily step can drop readings repeated across files
+    readings = process_data([df], 'long')
+    # named after the source object, a redelivered event overwrites its own partial
+    partial_file = PARTIAL_FILE_TEMPLATE.format(
+        day, os.path.basename(filename).split('.')[0], CODEC_EXTENSIONS[INTERMEDIATE_CODEC])
+    upload_intermediate_results(readings, partial_file)
     return {
-        "message": "Mapper phase complete",
-        "processed_file": results_filename,
-        "rows": len(parameter_readings)}
\ No newline at end of file
+        "partial_file": partial_file,
+        "date": day,
+        "rows": len(readings),
+        "discarded_rows": discarded_rows}
+
+
+def main(event, context):
+    # the trace of the run comes with the chunk, an S3 event starts its own
+    trace = tracing.start(event, 'TransformData', request_id=context.aws_request_id)
+    try:
+        # in incremental mode every new source object triggers the function
+        if 'Records' in event:
+            with trace.span('partials'):
+                partials = [update_partial_results(bucket, filename) for bucket, filename in get_new_objects(event)]
+            trim_cache()
+            trace.end()
+            return {
+                "message": "Partial results updated",
+                "partials": [partial for partial in partials if partial is not None]}
+
+        # the duration of the chunk is reported to ListFiles through the reducer
+        started = time.monotonic()
+        # download files locally
+        with trace.span('download', files=len(event['files'])) as span:
+            data_files = [download_data(filename) for filename in event['files']]
+            # sized before the cache may evict the files
+            chunk_bytes = span['bytes'] = sum(os.path.getsize(data_file) for data_file in data_files)
+
+        # read each file and keep only readings of the day it was fetched for
+        jobs = [(data_file, get_day_window(filename))
+                for data_file, filename in zip(data_files, event['files'])]
+        workers = min(get_parse_workers(), len(jobs))
+        with trace.span('parse', workers=workers):
+            if workers > 1:
+                results = parse_data_parallel(jobs, workers)
+            else:
+                results = [parse_data(*job) for job in jobs]
+        dataframes = [df for df, _ in results]
+        discarded_rows = sum(discarded for _, discarded in results)
+        log.info(f"Rows outside the target day discarded: {discarded_rows}")
+
+        # process the data to get air quality readings
+        with trace.span('process') as span:
+            parameter_readings = process_data(dataframes, INTERMEDIATE_LAYOUT)
+            span['rows'] = len(parameter_readings)
+
+        results_filename = "{}.json.{}".format(context.aws_request_id, CODEC_EXTENSIONS[INTERMEDIATE_CODEC])
+
+        # upload to target S3 bucket
+        with trace.span('upload'):
+            upload_intermediate_results(parameter_readings, results_filename)
+        # files of this chunk were parsed, so they may be evicted now
+        trim_cache()
+        trace.end(date=event['date'])
+
+        # return temp file and number of rows processed.
+        return {
+            "message": "Mapper phase complete",
+            "processed_file": results_filename,
+            "date": event['date'],
+            "layout": INTERMEDIATE_LAYOUT,
+            "rows": len(parameter_readings),
+            "discarded_rows": discarded_rows,
+            "files": len(data_files),
+            "bytes": chunk_bytes,
+            "duration": round(time.monotonic() - started, 3),
+            "memory": tracing.get_memory_size() // (1024 * 1024),
+            # the reducer links the mapper spans that fed it
+            "trace": trace.context()}
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
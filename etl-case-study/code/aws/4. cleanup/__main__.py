@@ -1,14 +1,16 @@
-import boto3
-import botocore
+import botocore.exceptions
 
 import os
 import logging
 
-s3 = boto3.client('s3')
+import storage
+import tracing
+
 RESULTS_BUCKET = os.environ['RESULTS_BUCKET']
 
 log = logging.getLogger()
 
+
 def delete_intermediate_results(intermediate_files):
     """Delete files from the S3 bucket
     Parameters
@@ -18,17 +20,30 @@ def delete_intermediate_results(intermediate_files):
     """
 
     try:
-        s3.delete_objects(Bucket=RESULTS_BUCKET, Delete={'Objects': intermediate_files})
+        storage.open_bucket(RESULTS_BUCKET).delete_batch([item['Key'] for item in intermediate_files])
     except botocore.exceptions.ClientError as e:
         log.error(f'Unable to delete intermediate results')
         log.debug(e)
         raise
 
 def main(event, context):
-    # delete from the S3 bucket
-    delete_intermediate_results(event['intermediate_files'])
+    # a backfill passes the results of one reducer per day
+    results = event.get('value', [event])
+    # the last step of the run links the reducers it cleans up after
+    trace = tracing.start(event, 'CleanUp', links=[result.get('trace') for result in results])
+    try:
+        # delete from the S3 bucket
+        with trace.span('delete'):
+            delete_intermediate_results([item for result in results for item in result['intermediate_files']])
 
-    return {
-        "message": f'Processing complete, you can download the result from {event["result_path"]}',
-        "result_path": event["result_path"]
-    }
\ No newline at end of file
+        # days without data have no result
+        result_paths = [result['result_path'] for result in results if result['result_path']]
+        trace.end()
+        return {
+            "message": f'Processing complete, you can download the results from {", ".join(result_paths)}',
+            "result_paths": result_paths
+        }
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
@@ -1,39 +1,94 @@
 import os
 import json
 import logging
-import boto3
+from urllib.parse import unquote_plus
 from botocore.exceptions import ClientError
 
 
 QUEUE_NAME = os.environ['QUEUE_NAME']
 REGION = os.environ['REGION']
-sqs_client = boto3.client('sqs', region_name=REGION) 
+# skips resolving the queue URL if set
+QUEUE_URL = os.environ.get('QUEUE_URL')
+# only objects with these suffixes are announced, e.g. not every partition of an output, empty for all
+NOTIFY_SUFFIXES = tuple(suffix.strip() for suffix in os.environ.get('NOTIFY_SUFFIXES', '_manifest.json,.csv.gz').split(',') if suffix.strip())
+# SQS accepts at most 10 messages per batch
+MAX_BATCH_SIZE = 10
 
+# created on first use and reused by warm containers
+sqs_client = None
+queue_urls = {}
 
-def send_sqs_message(QueueName, msg_body):
-    """ Send SQS message 
-    :param sqs_queue_url: String URL of existing SQS queue
-    :param msg_body: String message body
-    :return: Dictionary containing information about the sent message. If error, returns None.
+
+def get_sqs_client():
+    """ Create the SQS client on first use
+    :return: SQS client cached for subsequent invocations
+    """
+
+    global sqs_client
+    if sqs_client is None:
+        import boto3
+        sqs_client = boto3.client('sqs', region_name=REGION)
+    return sqs_client
+
+
+def get_queue_url(QueueName):
+    """ Resolve the URL of a queue on first use
+    :param QueueName: String name of existing SQS queue
+    :return: String URL of the queue, cached for subsequent invocations
+    """
+
+    if QueueName not in queue_urls:
+        queue_urls[QueueName] = QUEUE_URL or get_sqs_client().get_queue_url(QueueName=QueueName)['QueueUrl']
+    return queue_urls[QueueName]
+
+
+def get_notifications(event):
+    """ Split an S3 event into one notification per announced object
+    :param event: Dictionary with the S3 event, other events are sent as they are
+    :return: List of message bodies, each in the form of an S3 event with a single record
+    """
+
+    if 'Records' not in event:
+        return [event]
+    return [{'Records': [record]} for record in event['Records']
+            if not NOTIFY_SUFFIXES or 's3' not in record
+            or unquote_plus(record['s3']['object']['key']).endswith(NOTIFY_SUFFIXES)]
+
+
+def send_sqs_messages(QueueName, msg_bodies):
+    """ Send SQS messages in batches
+    Batches only group the records of one S3 event, and S3 usually delivers one record per event,
+    so this saves requests on events with several records but does not raise throughput.
+    :param QueueName: String name of existing SQS queue
+    :param msg_bodies: List of message bodies
+    :return: List of IDs of the sent messages. Messages that could not be sent are logged.
     """
 
-    # Send the SQS message
-    
-    sqs_queue_url = sqs_client.get_queue_url(QueueName=QueueName)['QueueUrl']
-    try:
-        msg = sqs_client.send_message(QueueUrl=sqs_queue_url, MessageBody=json.dumps(msg_body))
-    except ClientError as e:
-        logging.error(e)
-        return None
-    return msg
+    sqs_client = get_sqs_client()
+    sqs_queue_url = get_queue_url(QueueName)
+    message_ids = []
+    for i in range(0, len(msg_bodies), MAX_BATCH_SIZE):
+        entries = [{'Id': str(j), 'MessageBody': json.dumps(msg_body)}
+                   for j, msg_body in enumerate(msg_bodies[i:i + MAX_BATCH_SIZE])]
+        try:
+            response = sqs_client.send_message_batch(QueueUrl=sqs_queue_url, Entries=entries)
+        except ClientError as e:
+            logging.error(e)
+            continue
+        for failed in response.get('Failed', []):
+            logging.error(f'Unable to send SQS message: {failed.get("Message", failed["Code"])}')
+        message_ids.extend(msg['MessageId'] for msg in response.get('Successful', []))
+    return message_ids
 
 
 def main(event, context):
     logging.basicConfig(level=logging.DEBUG, format='%(levelname)s: %(asctime)s: %(message)s')
 
-    msg = send_sqs_message(QUEUE_NAME, event)
-    if msg is not None:
-        logging.info(f'Sent SQS message ID: {msg["MessageId"]}')
+    notifications = get_notifications(event)
+    # all records of an event are sent together, events are not batched with each other
+    message_ids = send_sqs_messages(QUEUE_NAME, notifications) if notifications else []
+    for message_id in message_ids:
+        logging.info(f'Sent SQS message ID: {message_id}')
     return {
         'statusCode': 200,
         'body': json.dumps(event)
@@ -1,24 +1,80 @@
-from azure.storage.blob import BlobClient
-
 import os
 import tempfile
 import logging
 import gzip
+import io
 import json
-import pandas as pd
-from pandas.io.json import json_normalize
-import numpy as np
-from datetime import datetime, timedelta
+import math
+import pickle
+import uuid
+from datetime import date, datetime, timedelta
+from urllib.parse import quote
+
+import storage
+import tracing
+
+# pandas, numpy and the Azure SDK are imported on first use to keep the module import cheap
 
 connection_str = os.environ["AzureWebJobsStorage"]
 
 OUTPUT_BLOB_CONTAINER = 'openaq-output'
 TEMP_FOLDER_TEMPLATE = 'openaq/temp/{}'
 OUTPUT_FOLDER_TEMPLATE = 'openaq/output/{}'
+# partial results of the incremental mode, relative to the temp folder
+PARTIALS_FOLDER_TEMPLATE = 'partials/{}/'
+# state of the rolling aggregates, per station and parameter
+STATE_FOLDER_TEMPLATE = 'openaq/state/{}'
+# mapper throughput of each run, read by ListFiles to size the chunks of the next run
+TELEMETRY_FOLDER_TEMPLATE = 'openaq/telemetry/{}'
+# results of several mappers merged by a combining reducer of a tree reduce, per day
+COMBINED_FILE_TEMPLATE = 'combined-{}-{}.json.gz'
+DAILY_STATE_TEMPLATE = 'daily/{}.json.gz'
+ROLLING_STATE_TEMPLATE = 'rolling-{}d/{}.json.gz'
+ROLLING_OUTPUT_TEMPLATE = 'rolling-{}d/{}.csv.gz'
+ROLLING_DATASET_TEMPLATE = 'rolling-{}d'
+# partitioned output of a dataset, relative to the output folder
+PARTITION_FOLDER_TEMPLATE = '{}/date={}/'
+PARTITION_FILE = 'part-0.parquet'
+MANIFEST_FILE = '_manifest.json'
+PARQUET_COMPRESSION = 'snappy'
+# comma separated, csv keeps the single gzipped file for existing consumers
+OUTPUT_FORMATS = [fmt.strip() for fmt in os.environ.get('OUTPUT_FORMATS', 'parquet').split(',') if fmt.strip()]
+# partitions are serialized and uploaded in parallel
+OUTPUT_WRITERS = int(os.environ.get('OUTPUT_WRITERS', 8))
+# lengths of the rolling windows in days, empty to only write the daily summary
+ROLLING_WINDOWS = [int(window) for window in os.environ.get('ROLLING_WINDOWS', '7,30').split(',') if window.strip()]
+
+# repeated strings are held as categoricals with a dictionary shared across frames
+CATEGORICAL_COLUMNS = ['country', 'city', 'location', 'parameter', 'unit']
+# a reading is identified by its station, parameter and timestamp
+DEDUP_KEY = ['country', 'city', 'location', 'parameter', 'date.utc']
+STATION_KEY = ['country', 'city', 'location']
+STATE_KEY = STATION_KEY + ['parameter']
+STATE_DTYPES = {'min': 'float64', 'max': 'float64', 'sum': 'float64', 'count': 'int64', 'day': 'int64', 'value': 'float64'}
+SECONDS_PER_DAY = 24 * 60 * 60
+# share of the function memory the aggregation may take, larger days are spilled to disk
+AGGREGATION_MEMORY_FRACTION = float(os.environ.get('AGGREGATION_MEMORY_FRACTION', 0.5))
+# fixed budget in bytes instead of the share, 0 uses the share
+AGGREGATION_MEMORY_BUDGET = int(os.environ.get('AGGREGATION_MEMORY_BUDGET', 0))
+# peak memory of the in-memory aggregation per byte of compressed intermediate results
+AGGREGATION_EXPANSION = int(os.environ.get('AGGREGATION_EXPANSION', 12))
+SPILL_FOLDER = tempfile.gettempdir()
+SPILL_MAX_PARTITIONS = 256
 
-prev_day = datetime.utcnow() - timedelta(days=1)
-prev_day = prev_day.strftime('%Y-%m-%d')
 log = logging.getLogger()
+# daily states read by the current run, by day ordinal
+daily_states = {}
+
+
+def get_output_container():
+    """Open the output blob container
+    Returns
+    -------
+    output: Storage
+        Storage of the output container, with connections for the partition writers
+    """
+
+    return storage.open_container(connection_str, OUTPUT_BLOB_CONTAINER, concurrency=OUTPUT_WRITERS)
 
 
 def download_intermediate_results(filename):
@@ -31,55 +87,215 @@ def download_intermediate_results(filename):
     -------
     processed_file: string
         Local path to downloaded file
+    codec: string
+        Codec the file is compressed with
     """
 
     try:
-        blob_name = TEMP_FOLDER_TEMPLATE.format(filename)
         processed_file = os.path.join(
             tempfile.gettempdir(), os.path.basename(filename))
-        blob = BlobClient.from_connection_string(
-            conn_str=connection_str, container_name=OUTPUT_BLOB_CONTAINER, blob_name=blob_name)
+        properties = get_output_container().download(TEMP_FOLDER_TEMPLATE.format(filename), processed_file)
+    except Exception as e:
+        log.error(f'Unable to download result file: {filename}')
+        log.debug(e)
+        raise
+    # intermediates written before the codec was configurable carry no metadata
+    return processed_file, properties['metadata'].get('codec', 'gzip')
+
+
+def open_intermediate(path, codec='gzip'):
+    """Open a downloaded intermediate file for reading
+    Parameters
+    ----------
+    path: string, required
+        Local path to the file
+    codec: string, optional
+        Codec the file is compressed with, gzip, zstd or lz4
+    Returns
+    -------
+    data_file: file object
+        Binary stream of the decompressed data
+    """
 
-        with open(processed_file, "wb") as my_blob:
-            blob_data = blob.download_blob()
-            blob_data.readinto(my_blob)
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    if codec == 'lz4':
+        import lz4.frame
+        return lz4.frame.open(path, mode='rb')
+    return gzip.GzipFile(path, 'r')
+
+
+def list_partial_results(day):
+    """List the partial results the incremental mode wrote for a day
+    Parameters
+    ----------
+    day: string, required
+        Day to finalize (YYYY-MM-DD)
+    Returns
+    -------
+    items: list of dicts
+        Partial results in the form of mapper results
+    """
 
+    prefix = TEMP_FOLDER_TEMPLATE.format(PARTIALS_FOLDER_TEMPLATE.format(day))
+    try:
+        keys = [item['key'] for item in get_output_container().list(prefix)]
     except Exception as e:
-        log.error(f'Unable to download result file: {filename}')
+        log.error(f'Unable to list partial results: {prefix}')
         log.debug(e)
         raise
-    return processed_file
+    temp_folder = TEMP_FOLDER_TEMPLATE.format('')
+    return [{'processed_file': key[len(temp_folder):], 'layout': 'long', 'date': day} for key in keys]
+
+
+def get_previous_day():
+    """Day before the current UTC day, evaluated per invocation
+    Returns
+    -------
+    day: string
+        Previous day (YYYY-MM-DD)
+    """
+
+    return (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d')
 
 
-def process_intermediate_results(dataframes):
+def apply_schema(df):
+    """Restore the compact dtypes of deserialized intermediate results
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Intermediate results read from JSON
+    Returns
+    -------
+    df: Pandas dataframe
+        Data with categorical keys, float32 readings and int64 epoch seconds
+    """
+
+    # every column except keys and timestamps holds readings
+    dtypes = {
+        column: 'category' if column in CATEGORICAL_COLUMNS else 'float32'
+        for column in df.columns if column != 'date.utc'}
+    dtypes['date.utc'] = 'int64'
+    return df.astype(dtypes)
+
+
+def concat_compact(dataframes):
+    """Concatenate dataframes without losing their categorical columns
+    Parameters
+    ----------
+    dataframes: list of Pandas dataframes, required
+        Dataframes with compact dtypes
+    Returns
+    -------
+    data: Pandas dataframe
+        Combined dataframe with compact dtypes
+    """
+
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+
+    # pd.concat falls back to object dtype when categories differ,
+    # so all frames are recoded to one shared dictionary first
+    for column in CATEGORICAL_COLUMNS:
+        if not all(column in df for df in dataframes):
+            continue
+        categories = union_categoricals(
+            [df[column] for df in dataframes], ignore_order=True).categories
+        dataframes = [
+            df.assign(**{column: df[column].cat.set_categories(categories)})
+            for df in dataframes]
+    return pd.concat(dataframes, sort=False)
+
+
+def drop_seen_readings(df, seen, layout='wide'):
+    """Drop readings that the results of another mapper already contained
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Intermediate results of one mapper
+    seen: numpy array, required
+        Sorted key hashes of the readings kept so far
+    layout: string, optional
+        Layout of the intermediate results, 'wide' or 'long'
+    Returns
+    -------
+    df: Pandas dataframe
+        Intermediate results without readings seen before
+    seen: numpy array
+        Sorted key hashes including the readings of this mapper
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    if layout == 'long':
+        keys = pd.util.hash_pandas_object(df[DEDUP_KEY], index=False).values
+        unique = ~np.isin(keys, seen) & ~pd.Series(keys).duplicated().values
+        return df[unique], np.union1d(seen, keys[unique])
+    # chunks may split the parameters of a station and hour over several wide rows,
+    # so every reading is checked on its own and repeated readings are blanked
+    row_columns = STATION_KEY + ['date.utc']
+    parameters = [column for column in df.columns if column not in row_columns]
+    row_keys = pd.util.hash_pandas_object(df[row_columns], index=False).values
+    df = df.copy()
+    kept = []
+    for parameter in parameters:
+        values = df[parameter].to_numpy(copy=True)
+        present = np.flatnonzero(~np.isnan(values))
+        # the key of a reading combines the key of its row with the parameter
+        keys = pd.util.hash_pandas_object(
+            pd.DataFrame({'row': row_keys[present], 'parameter': parameter}), index=False).values
+        unique = ~np.isin(keys, seen) & ~pd.Series(keys).duplicated().values
+        values[present[~unique]] = np.nan
+        df[parameter] = values
+        kept.append(keys[unique])
+    if parameters:
+        df = df[df[parameters].notna().any(axis=1).values]
+    return df, np.union1d(seen, np.concatenate(kept)) if kept else seen
+
+
+def process_intermediate_results(dataframes, day, layout='wide'):
     """Combine hourly air quality ratings and calculate daily ratings for each location.
     Parameters
     ----------
     dataframes: list of Pandas dataframes, required
         List of dataframes with hourly air quality ratings
+    day: string, required
+        Day the ratings are calculated for (YYYY-MM-DD)
+    layout: string, optional
+        Layout of the intermediate results, 'wide' or 'long'
     Returns
     -------
     summary_stats: Pandas dataframe
         Daily summary of air quality ratings
     """
 
+    import numpy as np
+    import pandas as pd
+
     try:
         # combine into single dataframe
-        data = pd.concat(dataframes, sort=False)
+        data = concat_compact(dataframes)
 
-        data['date.utc'] = pd.to_datetime(data['date.utc'], utc=True)
+        data['date.utc'] = pd.to_datetime(data['date.utc'], unit='s', utc=True)
 
         # calculate stats
-        summary_stats = data.set_index('date.utc').groupby([pd.Grouper(
-            freq='D'), 'country', 'city', 'location']).agg([np.nanmin, np.nanmax, np.nanmean])
-        summary_stats.columns = ["_".join(x)
-                                 for x in summary_stats.columns.ravel()]
+        if layout == 'long':
+            # aggregate each parameter in long form and widen only the daily summary
+            summary_stats = data.groupby([data['date.utc'].dt.floor('D'), 'country', 'city', 'location', 'parameter'], observed=True)['value'].agg(['min', 'max', 'mean']).unstack('parameter')
+            parameters = sorted(summary_stats.columns.get_level_values('parameter').unique())
+            summary_stats = summary_stats[[(stat, parameter) for parameter in parameters for stat in ('min', 'max', 'mean')]]
+            summary_stats.columns = ["{}_{}".format(parameter, stat) for stat, parameter in summary_stats.columns]
+        else:
+            summary_stats = data.set_index('date.utc').groupby([pd.Grouper(
+                freq='D'), 'country', 'city', 'location'], observed=True).agg([np.nanmin, np.nanmax, np.nanmean])
+            summary_stats.columns = ["_".join(x) for x in summary_stats.columns]
 
         # format the columns
         summary_stats = summary_stats.reset_index()
-        # there is occasionally historic data in the source
-        summary_stats = summary_stats[summary_stats['date.utc'].dt.date.astype(
-            str) == prev_day]
+        # mappers drop historic data already, this only guards the day boundary
+        summary_stats = summary_stats[summary_stats['date.utc'] == pd.Timestamp(day, tz='UTC')]
         summary_stats['date.utc'] = summary_stats['date.utc'].dt.date
         summary_stats.drop_duplicates(inplace=True)
         new_columns = {'date.utc': 'date',
@@ -106,6 +322,7 @@ def process_intermediate_results(dataframes):
                        'so2_nanmean': 'so2_mean'
                        }
         summary_stats.rename(columns=new_columns, inplace=True)
+        summary_stats = sort_summary(summary_stats)
     except Exception as e:
         log.error("Error processing data")
         log.debug(e)
@@ -114,23 +331,876 @@ def process_intermediate_results(dataframes):
     return summary_stats
 
 
-def upload_final_results(results):
-    """Upload a file to blob container
+def get_aggregation_budget():
+    """Memory the aggregation may take before it spills to disk
+    Returns
+    -------
+    budget: int
+        AGGREGATION_MEMORY_BUDGET if set, otherwise a share of the memory of the function
+    """
+
+    return AGGREGATION_MEMORY_BUDGET or int(tracing.get_memory_size() * AGGREGATION_MEMORY_FRACTION)
+
+
+def estimate_aggregation_size(paths):
+    """Estimate the memory the in-memory aggregation of the intermediate results takes
+    Parameters
+    ----------
+    paths: list, required
+        Local paths of the downloaded intermediate results
+    Returns
+    -------
+    size: int
+        Estimated peak memory in bytes
+    """
+
+    return sum(os.path.getsize(path) for path in paths) * AGGREGATION_EXPANSION
+
+
+def read_intermediate(path, codec='gzip'):
+    """Read a downloaded intermediate file into a dataframe with compact dtypes
+    Parameters
+    ----------
+    path: string, required
+        Local path to the file
+    codec: string, optional
+        Codec the file is compressed with
+    Returns
+    -------
+    df: Pandas dataframe
+        Intermediate results of one mapper
+    """
+
+    import pandas as pd
+
+    with open_intermediate(path, codec) as data_file:
+        raw_json = json.loads(data_file.read())
+    return apply_schema(pd.DataFrame.from_dict(raw_json))
+
+
+def spill_partitions(downloads, partitions):
+    """Hash-partition the intermediate results by station into spill files
+    Parameters
+    ----------
+    downloads: list of tuples, required
+        Local path and codec of each intermediate file
+    partitions: int, required
+        Number of spill files
+    Returns
+    -------
+    paths: list
+        Spill file of each partition, each holding a sequence of pickled dataframes
+    """
+
+    import pandas as pd
+
+    folder = tempfile.mkdtemp(prefix='spill-', dir=SPILL_FOLDER)
+    paths = [os.path.join(folder, '{}.pkl'.format(i)) for i in range(partitions)]
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for path, codec in downloads:
+            df = read_intermediate(path, codec)
+            # all readings of a station land in one partition, with its groups and duplicates
+            buckets = pd.util.hash_pandas_object(df[STATION_KEY], index=False).values % partitions
+            for i, part in df.groupby(buckets, sort=False):
+                pickle.dump(part, files[i], protocol=pickle.HIGHEST_PROTOCOL)
+            # the spill files take the place of the intermediate file on disk
+            os.remove(path)
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def read_partition(path):
+    """Read and remove a spill file
+    Parameters
+    ----------
+    path: string, required
+        Spill file of one partition
+    Returns
+    -------
+    frames: list of Pandas dataframes
+        Readings of the partition from each intermediate file
+    """
+
+    frames = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                frames.append(pickle.load(f))
+            except EOFError:
+                break
+    os.remove(path)
+    return frames
+
+
+def sort_summary(summary_stats):
+    """Order a daily summary by day and station
+    Parameters
+    ----------
+    summary_stats: Pandas dataframe, required
+        Daily summary with one row per station
+    Returns
+    -------
+    summary_stats: Pandas dataframe
+        Daily summary sorted by the string values of its keys
+    """
+
+    # categoricals sort by their codes, which follow the order the files were read in
+    return summary_stats.sort_values(['date', 'country', 'city', 'location'], key=lambda column: column.astype(str),
+                                     kind='mergesort').reset_index(drop=True)
+
+
+def merge_summaries(summaries, layout='wide'):
+    """Combine the summaries of disjoint sets of stations
+    Parameters
+    ----------
+    summaries: list of Pandas dataframes, required
+        Daily summary of each partition
+    layout: string, optional
+        Layout of the intermediate results, 'wide' or 'long'
+    Returns
+    -------
+    summary_stats: Pandas dataframe
+        Daily summary in the order of the in-memory aggregation
+    """
+
+    import pandas as pd
+
+    summary_stats = pd.concat(summaries, ignore_index=True, sort=False)
+    if layout == 'long':
+        # partitions may lack parameters, the long layout orders them by name
+        keys = [column for column in summary_stats.columns if column in ('date', 'country', 'city', 'location')]
+        values = sorted((column for column in summary_stats.columns if column not in keys),
+                        key=lambda column: column.rsplit('_', 1)[0])
+        summary_stats = summary_stats[keys + values]
+    return sort_summary(summary_stats)
+
+
+def aggregate_external(downloads, day, layout, size):
+    """Aggregate the intermediate results of a day one partition of stations at a time
+    Parameters
+    ----------
+    downloads: list of tuples, required
+        Local path and codec of each intermediate file
+    day: string, required
+        Day the ratings are calculated for (YYYY-MM-DD)
+    layout: string, required
+        Layout of the intermediate results, 'wide' or 'long'
+    size: int, required
+        Estimated memory of the in-memory aggregation in bytes
+    Returns
+    -------
+    summary_stats: Pandas dataframe
+        Daily summary of air quality ratings
+    daily: Pandas dataframe
+        Daily state of the stations, None without rolling windows
+    """
+
+    import numpy as np
+    import pandas as pd
+
+    budget = get_aggregation_budget()
+    # each partition gets half the budget, concatenation and grouping copy the data
+    partitions = min(max(2, math.ceil(2 * size / budget)), SPILL_MAX_PARTITIONS)
+    log.warning(f'Estimated {size} bytes exceed the aggregation budget of {budget} bytes, '
+                f'spilling {day} to {partitions} partitions')
+    paths = spill_partitions(downloads, partitions)
+    summaries = []
+    states = []
+    for path in paths:
+        frames = read_partition(path)
+        if not frames:
+            continue
+        data = concat_compact(frames)
+        # duplicates share their station, so they meet in one partition
+        data, _ = drop_seen_readings(data, np.empty(0, dtype=np.uint64), layout)
+        summaries.append(process_intermediate_results([data], day, layout))
+        if ROLLING_WINDOWS:
+            states.append(compute_daily_state([data], day, layout))
+    os.rmdir(os.path.dirname(paths[0]))
+    if not summaries:
+        log.warning(f'No readings for {day}')
+        daily = apply_state_schema(pd.DataFrame(columns=STATE_KEY + ['min', 'max', 'sum', 'count']))
+        return pd.DataFrame(columns=['date', 'country', 'city', 'location']), daily
+    daily = pd.concat(states, ignore_index=True, sort=False) if states else None
+    return merge_summaries(summaries, layout), daily
+
+
+def compute_daily_state(dataframes, day, layout='wide'):
+    """Reduce the readings of a day to compact per-station state
+    Parameters
+    ----------
+    dataframes: list of Pandas dataframes, required
+        Intermediate results of the day without repeated readings
+    day: string, required
+        Day of the readings (YYYY-MM-DD)
+    layout: string, optional
+        Layout of the intermediate results, 'wide' or 'long'
+    Returns
+    -------
+    state: Pandas dataframe
+        Minimum, maximum, sum and count of each parameter per station
+    """
+
+    import pandas as pd
+
+    data = concat_compact(dataframes)
+    start = pd.Timestamp(day, tz='UTC').value // 10**9
+    data = data[(data['date.utc'] >= start) & (data['date.utc'] < start + SECONDS_PER_DAY)]
+    if layout != 'long':
+        # every column apart from the station and the timestamp holds a parameter
+        data = data.melt(id_vars=STATION_KEY + ['date.utc'], var_name='parameter').dropna(subset=['value'])
+    state = data.assign(value=data['value'].astype('float64')).groupby(
+        STATE_KEY, observed=True)['value'].agg(['min', 'max', 'sum', 'count']).reset_index()
+    # plain strings, so the state merges with deserialized state of other days
+    return state.astype({column: str for column in STATE_KEY})
+
+
+def push_candidates(candidates, daily, stat, day_number, window):
+    """Add a day to the monotonic queues of window minimum or maximum candidates
+    Parameters
+    ----------
+    candidates: Pandas dataframe, required
+        Candidate days and values per station and parameter of the previous window
+    daily: Pandas dataframe, required
+        State of the new day
+    stat: string, required
+        'min' or 'max'
+    day_number: int, required
+        Ordinal of the new day
+    window: int, required
+        Length of the window in days
+    Returns
+    -------
+    candidates: Pandas dataframe
+        Candidates of the window ending with the new day
+    """
+
+    import pandas as pd
+
+    # drop candidates of the day that left the window
+    candidates = candidates[candidates['day'] > day_number - window]
+    new = daily[STATE_KEY + [stat]].rename(columns={stat: 'value'})
+    merged = candidates.merge(new.rename(columns={'value': 'new'}), on=STATE_KEY, how='left')
+    # a candidate the new value beats can never become the window's extreme again
+    if stat == 'min':
+        keep = merged['new'].isna() | (merged['value'] < merged['new'])
+    else:
+        keep = merged['new'].isna() | (merged['value'] > merged['new'])
+    return pd.concat([merged.loc[keep, STATE_KEY + ['day', 'value']], new.assign(day=day_number)],
+                     ignore_index=True, sort=False)
+
+
+def update_rolling_state(state, daily, expired, day_number, window):
+    """Move a rolling window forward by one day
+    Parameters
+    ----------
+    state: dict, required
+        Rolling state of the window ending the day before
+    daily: Pandas dataframe, required
+        State of the new day
+    expired: Pandas dataframe, required
+        State of the day that leaves the window, None if there is none
+    day_number: int, required
+        Ordinal of the new day
+    window: int, required
+        Length of the window in days
+    Returns
+    -------
+    state: dict
+        Rolling state of the window ending with the new day
+    """
+
+    import pandas as pd
+
+    # sums and counts are updated by adding the new day and subtracting the expired one
+    totals = [state['totals'], daily[STATE_KEY + ['sum', 'count']]]
+    if expired is not None:
+        totals.append(expired[STATE_KEY + ['sum', 'count']].assign(
+            sum=-expired['sum'], count=-expired['count']))
+    totals = pd.concat(totals, ignore_index=True, sort=False).groupby(
+        STATE_KEY, sort=False)[['sum', 'count']].sum().reset_index()
+    return {
+        'totals': totals[totals['count'] > 0],
+        'min': push_candidates(state['min'], daily, 'min', day_number, window),
+        'max': push_candidates(state['max'], daily, 'max', day_number, window)}
+
+
+def apply_state_schema(df):
+    """Restore the dtypes of deserialized state
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Table of daily or rolling state
+    Returns
+    -------
+    df: Pandas dataframe
+        Table with string keys, float64 statistics and int64 counts and days
+    """
+
+    dtypes = {column: STATE_DTYPES.get(column, str) for column in df.columns}
+    return df.astype(dtypes)
+
+
+def empty_rolling_state():
+    """Rolling state of a window without any days
+    Returns
+    -------
+    state: dict
+        Empty totals and candidate queues
+    """
+
+    import pandas as pd
+
+    state = {
+        'totals': pd.DataFrame(columns=STATE_KEY + ['sum', 'count']),
+        'min': pd.DataFrame(columns=STATE_KEY + ['day', 'value']),
+        'max': pd.DataFrame(columns=STATE_KEY + ['day', 'value'])}
+    return {key: apply_state_schema(df) for key, df in state.items()}
+
+
+def summarize_rolling_state(state, day):
+    """Turn rolling state into the wide layout of the daily summary
+    Parameters
+    ----------
+    state: dict, required
+        Rolling state of a window
+    day: string, required
+        Last day of the window (YYYY-MM-DD)
+    Returns
+    -------
+    summary_stats: Pandas dataframe
+        Minimum, maximum and mean of each parameter per station over the window
+    """
+
+    totals = state['totals'].set_index(STATE_KEY)
+    stats = totals.assign(
+        min=state['min'].groupby(STATE_KEY)['value'].min(),
+        max=state['max'].groupby(STATE_KEY)['value'].max(),
+        mean=totals['sum'] / totals['count'])[['min', 'max', 'mean']].unstack('parameter')
+    parameters = sorted(stats.columns.get_level_values('parameter').unique())
+    stats = stats[[(stat, parameter) for parameter in parameters for stat in ('min', 'max', 'mean')]]
+    stats.columns = ["{}_{}".format(parameter, stat) for stat, parameter in stats.columns]
+    stats = stats.reset_index()
+    stats.insert(0, 'date', day)
+    return stats
+
+
+def read_covered_days(state):
+    """Daily states a rolling state was built from
+    Parameters
+    ----------
+    state: dict, required
+        Rolling state of a window
+    Returns
+    -------
+    days: dict
+        ETag of the daily state by day ordinal
+    """
+
+    if 'days' not in state:
+        # state written before the covered days were recorded
+        return None
+    return dict(zip(state['days']['day'], state['days']['etag']))
+
+
+def is_current(state, window, day_number, versions):
+    """Check that a rolling state was built from the daily states that exist now
+    Parameters
+    ----------
+    state: dict, required
+        Rolling state of the window ending with a day
+    window: int, required
+        Length of the window in days
+    day_number: int, required
+        Ordinal of the last day of the window
+    versions: dict, required
+        ETag of every daily state by day ordinal from get_daily_versions()
+    Returns
+    -------
+    current: bool
+        False if a day of the window was processed or reprocessed after the state was written
+    """
+
+    expected = {number: versions[number] for number in range(day_number - window + 1, day_number + 1)
+                if number in versions}
+    return read_covered_days(state) == expected
+
+
+def move_window(previous, window, day_number, versions):
+    """Compute the rolling state of a window from the state of the day before
+    Parameters
+    ----------
+    previous: dict, required
+        Rolling state of the window ending the day before, None if there is none
+    window: int, required
+        Length of the window in days
+    day_number: int, required
+        Ordinal of the last day of the window
+    versions: dict, required
+        ETag of every daily state by day ordinal from get_daily_versions()
+    Returns
+    -------
+    state: dict
+        Rolling state of the window ending with the day
+    """
+
+    import pandas as pd
+
+    if previous is not None and is_current(previous, window, day_number - 1, versions):
+        expired = read_daily_state(day_number - window) if day_number - window in versions else None
+        state = update_rolling_state(previous, read_daily_state(day_number), expired, day_number, window)
+    else:
+        # first run, a gap or days that finished out of order, rebuild the window from the daily states
+        log.info(f'Rebuilding the {window} day window ending {date.fromordinal(day_number).isoformat()}')
+        state = empty_rolling_state()
+        for number in range(day_number - window + 1, day_number + 1):
+            if number in versions:
+                state = update_rolling_state(state, read_daily_state(number), None, number, window)
+    days = {number: versions[number] for number in range(day_number - window + 1, day_number + 1)
+            if number in versions}
+    state['days'] = apply_state_schema(pd.DataFrame({'day': list(days), 'etag': list(days.values())}))
+    return state
+
+
+def read_daily_state(day_number):
+    """Read the state of a day, cached for the current run
+    Parameters
+    ----------
+    day_number: int, required
+        Ordinal of the day
+    Returns
+    -------
+    daily: Pandas dataframe
+        State of the day from compute_daily_state()
+    """
+
+    if day_number not in daily_states:
+        daily_states[day_number] = read_state(DAILY_STATE_TEMPLATE.format(date.fromordinal(day_number).isoformat()))['daily']
+    return daily_states[day_number]
+
+
+def update_rolling_aggregates(daily, day):
+    """Persist the state of a day and bring every rolling window that contains it up to date
+    Parameters
+    ----------
+    daily: Pandas dataframe, required
+        State of the day from compute_daily_state()
+    day: string, required
+        Day of the readings (YYYY-MM-DD)
+    Returns
+    -------
+    output_files: list
+        Names of the rolling summaries below the output folder
+    """
+
+    write_state(DAILY_STATE_TEMPLATE.format(day), {'daily': daily})
+    day_number = date.fromisoformat(day).toordinal()
+    daily_states.clear()
+    daily_states[day_number] = daily
+    span = max(ROLLING_WINDOWS)
+    # rolling states record the ETags of the daily states they cover, so stale windows can be found
+    versions = get_daily_versions(day_number - span, day_number + span - 1)
+
+    output_files = []
+    for window in ROLLING_WINDOWS:
+        previous = read_state(ROLLING_STATE_TEMPLATE.format(window, date.fromordinal(day_number - 1).isoformat()))
+        # windows of later days that already ran contain this day as well
+        for number in range(day_number, day_number + window):
+            if number not in versions:
+                # a day without state has no window, the next day is rebuilt
+                previous = None
+                continue
+            current = date.fromordinal(number).isoformat()
+            if number != day_number:
+                state = read_state(ROLLING_STATE_TEMPLATE.format(window, current))
+                if state is not None and is_current(state, window, number, versions):
+                    previous = state
+                    continue
+            state = move_window(previous, window, number, versions)
+            write_state(ROLLING_STATE_TEMPLATE.format(window, current), state)
+            output_files.extend(write_summary(
+                summarize_rolling_state(state, current), ROLLING_DATASET_TEMPLATE.format(window), current,
+                ROLLING_OUTPUT_TEMPLATE.format(window, current)))
+            previous = state
+    return output_files
+
+
+def to_parquet(df):
+    """Serialize a dataframe to Parquet in memory
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Data of one partition
+    Returns
+    -------
+    body: bytes
+        Parquet file with column statistics in its footer
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), sink,
+                   compression=PARQUET_COMPRESSION, write_statistics=True)
+    return sink.getvalue().to_pybytes()
+
+
+def describe_partition(df):
+    """Column statistics of a partition for the manifest
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Data of one partition
+    Returns
+    -------
+    columns: dict
+        Minimum, maximum and number of missing values by column
+    """
+
+    columns = {}
+    for column in df.columns:
+        values = df[column].dropna()
+        columns[column] = {
+            'min': values.min() if len(values) else None,
+            'max': values.max() if len(values) else None,
+            'null_count': int(len(df) - len(values))}
+    return columns
+
+
+def write_partition(folder, country, df):
+    """Write the rows of one country as a Parquet partition
+    Parameters
+    ----------
+    folder: string, required
+        Folder of the date partition below the output folder
+    country: string, required
+        Country of the rows
+    df: Pandas dataframe, required
+        Rows of the country without the partition columns
+    Returns
+    -------
+    partition: dict
+        Manifest entry with path, size and column statistics
+    """
+
+    name = '{}country={}/{}'.format(folder, quote(country, safe=''), PARTITION_FILE)
+    body = to_parquet(df)
+    upload_output(name, body)
+    return {
+        'path': name,
+        'country': country,
+        'rows': len(df),
+        'bytes': len(body),
+        'columns': describe_partition(df)}
+
+
+def write_partitioned_output(summary_stats, dataset, day):
+    """Write a summary as Parquet files partitioned by date and country with a manifest
+    Parameters
+    ----------
+    summary_stats: Pandas dataframe, required
+        Summary with one row per station
+    dataset: string, required
+        Name of the dataset, e.g. daily or rolling-7d
+    day: string, required
+        Day of the summary (YYYY-MM-DD)
+    Returns
+    -------
+    manifest_name: string
+        Name of the manifest below the output folder
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    import pyarrow as pa
+
+    folder = PARTITION_FOLDER_TEMPLATE.format(dataset, day)
+    # partition columns are encoded in the path only, as hive-style readers expect
+    data = summary_stats.drop(columns=['date']).astype({column: str for column in STATION_KEY})
+    # pyarrow sets up its pandas support on first use, which is not thread safe
+    pa.Table.from_pandas(data.head(0), preserve_index=False)
+    with ThreadPoolExecutor(max_workers=OUTPUT_WRITERS) as executor:
+        futures = [executor.submit(write_partition, folder, country, df.drop(columns=['country']))
+                   for country, df in data.groupby('country', sort=True)]
+        partitions = [future.result() for future in futures]
+
+    # readers use the manifest to prune partitions, so it is written after all of them
+    manifest = {
+        'dataset': dataset,
+        'date': day,
+        'format': 'parquet',
+        'partition_columns': ['date', 'country'],
+        'rows': sum(partition['rows'] for partition in partitions),
+        'partitions': partitions}
+    manifest_name = folder + MANIFEST_FILE
+    upload_output(manifest_name, json.dumps(manifest, default=lambda value: value.item()).encode())
+    return manifest_name
+
+
+def write_summary(summary_stats, dataset, day, csv_file_name):
+    """Write a summary in each of the configured output formats
+    Parameters
+    ----------
+    summary_stats: Pandas dataframe, required
+        Summary with one row per station
+    dataset: string, required
+        Name of the dataset, e.g. daily or rolling-7d
+    day: string, required
+        Day of the summary (YYYY-MM-DD)
+    csv_file_name: string, required
+        Name of the CSV file below the output folder
+    Returns
+    -------
+    output_files: list
+        Names of the manifest and the CSV file below the output folder
+    """
+
+    output_files = []
+    if 'parquet' in OUTPUT_FORMATS:
+        output_files.append(write_partitioned_output(summary_stats, dataset, day))
+    if 'csv' in OUTPUT_FORMATS:
+        upload_final_results(summary_stats, csv_file_name)
+        output_files.append(csv_file_name)
+    return output_files
+
+
+def read_state(name):
+    """Read state persisted by an earlier run from blob container
+    Parameters
+    ----------
+    name: string, required
+        Name of the state below the state folder
+    Returns
+    -------
+    state: dict
+        Pandas dataframes by table name, None if the state does not exist
+    """
+
+    import pandas as pd
+
+    try:
+        tables = json.loads(gzip.decompress(get_output_container().get(STATE_FOLDER_TEMPLATE.format(name))))
+    except storage.NotFound:
+        return None
+    except Exception as e:
+        log.error(f'Unable to read state: {name}')
+        log.debug(e)
+        raise
+    return {key: apply_state_schema(pd.DataFrame(table['data'], columns=table['columns']))
+            for key, table in tables.items()}
+
+
+def write_state(name, state):
+    """Persist state to blob container
+    Parameters
+    ----------
+    name: string, required
+        Name of the state below the state folder
+    state: dict, required
+        Pandas dataframes by table name
+    """
+
+    tables = {key: json.loads(df.to_json(orient='split', index=False)) for key, df in state.items()}
+    try:
+        get_output_container().put(STATE_FOLDER_TEMPLATE.format(name), gzip.compress(json.dumps(tables).encode()))
+    except Exception as e:
+        log.error(f'Unable to write state: {name}')
+        log.debug(e)
+        raise
+
+
+def get_daily_version(day_number):
+    """Read the ETag of the state of a day from blob container
+    Parameters
+    ----------
+    day_number: int, required
+        Ordinal of the day
+    Returns
+    -------
+    etag: string
+        ETag of the daily state, None if the day has no state
+    """
+
+    name = DAILY_STATE_TEMPLATE.format(date.fromordinal(day_number).isoformat())
+    try:
+        return get_output_container().head(STATE_FOLDER_TEMPLATE.format(name))['etag']
+    except storage.NotFound:
+        return None
+    except Exception as e:
+        log.error(f'Unable to read state: {name}')
+        log.debug(e)
+        raise
+
+
+def get_daily_versions(first, last):
+    """Find the days between two days that have a daily state
     Parameters
     ----------
+    first: int, required
+        Ordinal of the first day
+    last: int, required
+        Ordinal of the last day
+    Returns
+    -------
+    versions: dict
+        ETag of the daily state by day ordinal, for the days that have one
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    numbers = list(range(first, last + 1))
+    with ThreadPoolExecutor(max_workers=OUTPUT_WRITERS) as executor:
+        etags = list(executor.map(get_daily_version, numbers))
+    return {number: etag for number, etag in zip(numbers, etags) if etag is not None}
+
+
+def get_intermediate_files(item):
+    """Intermediate files a mapper or combining reducer result stands for
+    Parameters
+    ----------
+    item: dict, required
+        Mapper result, or combined result carrying the files it merged
+    Returns
+    -------
+    intermediate_files: list
+        Names of the files to delete once the day is written
+    """
+
+    return [item['processed_file']] + item.get('intermediate_files', [])
+
+
+def get_chunk_telemetry(item):
+    """Size and duration of the mapper chunks behind a result
+    Parameters
+    ----------
+    item: dict, required
+        Mapper result, or combined result carrying the chunks of the results it merged
+    Returns
+    -------
+    chunks: list of dicts
+        Bytes, rows, duration and memory of each chunk
+    """
+
+    if 'chunks' in item:
+        return item['chunks']
+    if 'duration' not in item:
+        return []
+    return [{"bytes": item['bytes'], "rows": item['rows'], "duration": item['duration'],
+             "memory": item['memory'], "files": item.get('files', 0)}]
+
+
+def upload_combined_results(df, results):
+    """Stream merged intermediate results to blob container as gzipped JSON
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Intermediate results of several mappers
     results: string, required
-        Name of the local file with final results
+        Name of the file with intermediate results
+    """
+
+    try:
+        with get_output_container().open_writer(TEMP_FOLDER_TEMPLATE.format(results), {'codec': 'gzip'}) as writer:
+            with gzip.GzipFile(fileobj=writer, mode='wb') as compressed, \
+                    io.TextIOWrapper(compressed, encoding='utf-8') as text:
+                df.to_json(text)
+    except Exception as e:
+        log.error(f'Unable to upload combined results: {results}')
+        log.debug(e)
+        raise
+
+
+def combine_intermediate_results(items, trace):
+    """Merge the results of several mappers into one intermediate file per day
+    Parameters
+    ----------
+    items: list, required
+        Mapper results, of one or more days
+    trace: Invocation, required
+        Spans of this invocation
+    Returns
+    -------
+    combined: list of dicts
+        One result per day in the format of a mapper result
+    """
+
+    import numpy as np
+
+    days = {}
+    for item in items:
+        days.setdefault(item['date'], []).append(item)
+    combined = []
+    for day, group in days.items():
+        layout = group[0].get('layout', 'wide')
+        # readings repeated across the merged results are dropped once here instead of by the final reducer
+        seen = np.empty(0, dtype=np.uint64)
+        dataframes = []
+        for item in group:
+            with trace.span('download', file=item['processed_file']):
+                path, codec = download_intermediate_results(item['processed_file'])
+            with trace.span('load', file=os.path.basename(path)):
+                df, seen = drop_seen_readings(read_intermediate(path, codec), seen, layout)
+                dataframes.append(df)
+            os.remove(path)
+        name = COMBINED_FILE_TEMPLATE.format(day, uuid.uuid4().hex)
+        with trace.span('upload', file=name):
+            df = concat_compact(dataframes).reset_index(drop=True)
+            upload_combined_results(df, name)
+        combined.append({
+            "message": "Combine phase complete",
+            "processed_file": name,
+            "date": day,
+            "layout": layout,
+            "rows": len(df),
+            # the final reducer deletes the merged files and records the chunks behind them
+            "intermediate_files": [key for item in group for key in get_intermediate_files(item)],
+            "chunks": [chunk for item in group for chunk in get_chunk_telemetry(item)],
+            "trace": trace.context()})
+    return combined
+
+
+def write_telemetry(day, items):
+    """Persist the size and duration of the mapper chunks of a run to the blob container
+    Parameters
+    ----------
+    day: string, required
+        Day processed by the mappers (YYYY-MM-DD)
+    items: list, required
+        Mapper or combined results with the bytes, rows, duration and memory of each chunk
     """
 
-    # upload to target Azure Blob Container
+    chunks = [chunk for item in items for chunk in get_chunk_telemetry(item)]
+    if not chunks:
+        return
+    # one object per run and day, so concurrent reducers never overwrite each other
+    name = '{}-{}.json'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S'), day)
     try:
-        results_path = os.path.join(tempfile.gettempdir(), results)
-        blob_name = OUTPUT_FOLDER_TEMPLATE.format(results)
-        blob = BlobClient.from_connection_string(
-            conn_str=connection_str, container_name=OUTPUT_BLOB_CONTAINER, blob_name=blob_name)
-        with open(results_path, "rb") as data:
-            blob.upload_blob(data)
+        get_output_container().put(TELEMETRY_FOLDER_TEMPLATE.format(name),
+                     json.dumps({"date": day, "chunks": chunks}).encode())
+    except Exception as e:
+        # telemetry only tunes later runs, it never fails this one
+        log.warning(f'Unable to write telemetry: {name}')
+        log.debug(e)
+
 
+def upload_final_results(df, results):
+    """Stream final results to blob container as gzipped CSV
+    Parameters
+    ----------
+    df: Pandas dataframe, required
+        Summary with one row per station
+    results: string, required
+        Name of the file with final results
+    """
+
+    # compressed straight into the upload parts, nothing is written to the temporary folder
+    try:
+        with get_output_container().open_writer(OUTPUT_FOLDER_TEMPLATE.format(results)) as writer:
+            with gzip.GzipFile(fileobj=writer, mode='wb') as compressed, io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+                df.to_csv(text, index=False, header=True)
         log.info("Uploaded final results to blob container {}, path: ".format(OUTPUT_BLOB_CONTAINER) + OUTPUT_FOLDER_TEMPLATE.format(results))
     except Exception as e:
         log.error(f'Unable to upload final results: {results}')
@@ -138,34 +1208,117 @@ def upload_final_results(results):
         raise
 
 
+def upload_output(name, body):
+    """Upload an output file held in memory to blob container
+    Parameters
+    ----------
+    name: string, required
+        Name of the file below the output folder
+    body: bytes, required
+        Content of the file
+    """
+
+    try:
+        get_output_container().put(OUTPUT_FOLDER_TEMPLATE.format(name), body)
+    except Exception as e:
+        log.error(f'Unable to upload output: {name}')
+        log.debug(e)
+        raise
+
+
 def main(event):
+    import numpy as np
+
+    if event.get('combine'):
+        # a tree reduce first merges groups of mapper results, the final reducer of each day reads fewer files
+        items = event['value']
+        trace = tracing.start(event, 'AggregateData', links=[item.get('trace') for item in items], combine=True)
+        try:
+            combined = combine_intermediate_results(items, trace)
+            trace.end(chunks=len(items))
+            return {
+                "message": "Combine phase complete",
+                "value": combined,
+                "trace": trace.context()}
+        except Exception as e:
+            # a failed invocation exports its spans as well
+            trace.end(error=type(e).__name__)
+            raise
+
     dataframes = []
     temp_files = []
-    # download files locally
-    for item in event:
-        temp_files.append(item['processed_file'])
-        intermediate_result = download_intermediate_results(item['processed_file'])
-        # read each file and store as Pandas dataframe
-        with gzip.GzipFile(intermediate_result, 'r') as data_file:
-            raw_json = json.loads(data_file.read())
-            df = pd.DataFrame.from_dict(raw_json)
-            dataframes.append(df)
-
-    summary_stats = process_intermediate_results(dataframes)
-    # write to file
-    output_file_name = '{}.csv.gz'.format(prev_day)
-    output_file = os.path.join(tempfile.gettempdir(), output_file_name)
-
-    summary_stats.to_csv(
-        output_file,
-        compression='gzip',
-        index=False,
-        header=True)
-
-    upload_final_results(output_file_name)
+    # key hashes of the readings received so far
+    seen = np.empty(0, dtype=np.uint64)
+    # a backfill starts one reducer per day, each keeps the mapper results of its day
+    day = event.get('date') or get_previous_day()
+    items = [item for item in event['value'] if item.get('date', day) == day]
+    # without mapper results the day was transformed incrementally and is only finalized
+    finalize = not items
+    # the reducer continues the trace of the run and links the mappers that fed it
+    trace = tracing.start(event, 'AggregateData', links=[item.get('trace') for item in items], date=day)
+    try:
+        if finalize:
+            with trace.span('list'):
+                items = list_partial_results(day)
+        if not items:
+            log.warning(f'No data for {day}')
+            trace.end()
+            return {
+                "message": "No data for {}".format(day),
+                "date": day,
+                "intermediate_files": [],
+                "trace": trace.context(),
+                "output_file": None}
+        # all mappers of a run write the same layout
+        layout = items[0].get('layout', 'wide')
+        # download files locally
+        downloads = []
+        for item in items:
+            temp_files.extend(get_intermediate_files(item))
+            with trace.span('download', file=item['processed_file']):
+                downloads.append(download_intermediate_results(item['processed_file']))
 
-    return {
-        "message": "Successfully processed data for {}".format(prev_day),
-        "intermediate_files": temp_files,
-        "output_file": "{}/".format(OUTPUT_BLOB_CONTAINER) + OUTPUT_FOLDER_TEMPLATE.format(output_file_name)
-        }
+        size = estimate_aggregation_size([path for path, _ in downloads])
+        if size > get_aggregation_budget():
+            # days of unusual volume take the slower path instead of running out of memory
+            with trace.span('aggregate', spilled=True):
+                summary_stats, daily = aggregate_external(downloads, day, layout, size)
+        else:
+            for path, codec in downloads:
+                # read each file and store as Pandas dataframe
+                with trace.span('load', file=os.path.basename(path)):
+                    df = read_intermediate(path, codec)
+                    # chunks overlap, so drop readings before they reach the aggregation
+                    df, seen = drop_seen_readings(df, seen, layout)
+                    dataframes.append(df)
+                # the dataframe takes the place of the intermediate file on disk
+                os.remove(path)
+
+            with trace.span('aggregate'):
+                summary_stats = process_intermediate_results(dataframes, day, layout)
+                daily = compute_daily_state(dataframes, day, layout) if ROLLING_WINDOWS else None
+        # a manifest indexes the partitions, the CSV file is only written on request
+        with trace.span('write'):
+            output_files = write_summary(summary_stats, 'daily', day, '{}.csv.gz'.format(day))
+        # 7 and 30 day station statistics are updated from compact state instead of daily outputs
+        with trace.span('rolling'):
+            rolling_files = update_rolling_aggregates(daily, day) if ROLLING_WINDOWS else []
+        # a finalized day carries no mapper timings
+        if not finalize:
+            write_telemetry(day, items)
+        trace.end(chunks=len(items))
+
+        return {
+            "message": "Successfully processed data for {}".format(day),
+            "date": day,
+            # partials are kept, so a day can be finalized again when late files arrive
+            "intermediate_files": [] if finalize else temp_files,
+            "trace": trace.context(),
+            # without output formats no summary is written
+            "output_file": "{}/".format(OUTPUT_BLOB_CONTAINER) + OUTPUT_FOLDER_TEMPLATE.format(output_files[0]) if output_files else None,
+            "rolling_files": ["{}/".format(OUTPUT_BLOB_CONTAINER) + OUTPUT_FOLDER_TEMPLATE.format(name) for name in rolling_files]
+            }
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
@@ -1,16 +1,16 @@
-from azure.storage.blob import ContainerClient
-
 import os
 import logging
 
+import storage
+import tracing
+
 connection_str = os.environ["AzureWebJobsStorage"]
 OUTPUT_BLOB_CONTAINER = 'openaq-output'
 TEMP_FOLDER_TEMPLATE = 'openaq/temp/{}'
 
-container_client = ContainerClient.from_connection_string(conn_str=connection_str, container_name=OUTPUT_BLOB_CONTAINER)
-
 log = logging.getLogger()
 
+
 def delete_intermediate_results(intermediate_files):
     """Delete files from Blob Container
     Parameters
@@ -20,17 +20,30 @@ def delete_intermediate_results(intermediate_files):
     """
 
     try:
-        for filename in intermediate_files:
-            blob_name = TEMP_FOLDER_TEMPLATE.format(filename)
-            container_client.delete_blob(blob=blob_name)
+        # blob batches delete up to 256 blobs per request
+        storage.open_container(connection_str, OUTPUT_BLOB_CONTAINER).delete_batch(
+            [TEMP_FOLDER_TEMPLATE.format(filename) for filename in intermediate_files])
     except Exception as e:
         log.error(f'Unable to delete intermediate results')
         log.debug(e)
         raise
 
 def main(event):
-    delete_intermediate_results(event['intermediate_files'])
-
-    return {
-        "message": "Successfully deleted intermediate files", 
-        "results": f'Download results from {event["output_file"]}'}
\ No newline at end of file
+    # a backfill passes the results of one reducer per day
+    results = event.get('value', [event])
+    # the last step of the run links the reducers it cleans up after
+    trace = tracing.start(event, 'CleanUp', links=[result.get('trace') for result in results])
+    try:
+        with trace.span('delete'):
+            delete_intermediate_results([item for result in results for item in result['intermediate_files']])
+
+        # days without data have no result
+        output_files = [result['output_file'] for result in results if result['output_file']]
+        trace.end()
+        return {
+            "message": "Successfully deleted intermediate files", 
+            "results": f'Download results from {", ".join(output_files)}'}
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
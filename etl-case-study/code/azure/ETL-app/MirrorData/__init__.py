@@ -0,0 +1,19 @@
+import logging
+from datetime import datetime, timedelta
+
+import azure.functions as func
+
+from ..ListFiles import MIRROR_PREFIX, mirror_day
+
+log = logging.getLogger()
+
+
+def main(mytimer: func.TimerRequest) -> None:
+    if not MIRROR_PREFIX:
+        log.info('MIRROR_PREFIX is not set, nothing to mirror')
+        return
+
+    # files of the previous day still arrive shortly after midnight
+    today = datetime.utcnow().date()
+    for day in (today - timedelta(days=1), today):
+        mirror_day(day.isoformat())
@@ -0,0 +1,23 @@
+import os
+import tempfile
+import logging
+
+import azure.functions as func
+
+from ..ListFiles import MIRROR_PREFIX
+from ..TransformData import update_partial_results
+
+log = logging.getLogger()
+
+
+def main(myblob: func.InputStream):
+    # the trigger watches the mirror MirrorData fills, blob names start with the container
+    # and the mirror prefix, the rest follows the OpenAQ key layout
+    filename = myblob.name.split('/', 1)[1][len(MIRROR_PREFIX.strip('/')) + 1:]
+    data_file = os.path.join(tempfile.gettempdir(), os.path.basename(filename))
+    with open(data_file, 'wb') as f:
+        f.write(myblob.read())
+
+    partial = update_partial_results(filename, data_file)
+    if partial is not None:
+        log.info(f"Updated partial results of {partial['date']}: {partial['partial_file']}")
@@ -6,13 +6,36 @@ from azure.storage.queue import QueueClient
 
 connection_str = os.environ["AzureWebJobsStorage"]
 QUEUE_NAME = "results-queue"
+# only blobs with these suffixes are announced, e.g. not every partition of an output, empty for all
+NOTIFY_SUFFIXES = tuple(suffix.strip() for suffix in os.environ.get('NOTIFY_SUFFIXES', '_manifest.json,.csv.gz').split(',') if suffix.strip())
+
+# created on first use and reused by warm workers, keeps its connections open
+queue_client = None
+
+
+def get_queue_client():
+    """Create the queue client on first use
+    Returns
+    -------
+    queue_client: QueueClient
+        Queue client cached for subsequent invocations
+    """
+
+    global queue_client
+    if queue_client is None:
+        queue_client = QueueClient.from_connection_string(connection_str, QUEUE_NAME)
+    return queue_client
+
 
 def main(myblob: func.InputStream):
-    queue_client = QueueClient.from_connection_string(connection_str, QUEUE_NAME)
+    if NOTIFY_SUFFIXES and not myblob.name.endswith(NOTIFY_SUFFIXES):
+        logging.debug(f'Not announcing {myblob.name}')
+        return
+
     message = {
         "name": myblob.name,
         "uri": myblob.uri,
         "message": "The blob was successfully uploaded"
     }    
 
-    queue_client.send_message(message)
\ No newline at end of file
+    get_queue_client().send_message(message)
\ No newline at end of file
@@ -1,54 +1,275 @@
-import ibm_boto3
-from ibm_botocore import UNSIGNED
-from ibm_botocore.client import Config
-
 import logging
 import os
-from datetime import datetime, timedelta
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
-s3 = ibm_boto3.client('s3', config=Config(signature_version=UNSIGNED))
+import planning
+import storage
+import tracing
 
 OPENAQ_BUCKET = 'openaq-fetches'
 DATA_PREFIX = 'realtime-gzipped'
+# finalize the partial results of the event-driven TransformData instead of listing files
+INCREMENTAL_MODE = os.environ.get('INCREMENTAL_MODE', 'false').lower() == 'true'
+# files per chunk if the input sets no chunk size and there is no telemetry yet
+CHUNK_SIZE = 12
+# parallel actions the composition runs, the chunks are planned in waves of this size
+MAX_CONCURRENCY = 40
+# telemetry of the reducers, one object per run and day
+TELEMETRY_FOLDER = 'openaq/telemetry/'
+TELEMETRY_RUNS = int(os.environ.get('TELEMETRY_RUNS', 7))
+# provider-local copy of the OpenAQ objects, unset to read the OpenAQ bucket directly
+MIRROR_PREFIX = os.environ.get('MIRROR_PREFIX')
+MIRROR_MANIFEST_TEMPLATE = '_manifest/{}.json.gz'
+MIRROR_WORKERS = int(os.environ.get('MIRROR_WORKERS', 16))
 
-# look for all files from previous day
-prev_day = datetime.utcnow() - timedelta(days=1)
-prev_day = prev_day.strftime('%Y-%m-%d')
-prefix = '{}/{}/'.format(DATA_PREFIX, prev_day)
+IAM_API_KEY = os.environ.get('__OW_IAM_NAMESPACE_API_KEY')
+ENDPOINT = 'https://s3.private.eu-de.cloud-object-storage.appdomain.cloud'
+COS_OUTPUT_BUCKET = 'openaq-output'
 
 log = logging.getLogger()
 
 
-def get_file_inventory():
-    """List files in OpenAQ bucket for previous day
+def get_source_bucket():
+    """Open the OpenAQ bucket with anonymous requests
+    Returns
+    -------
+    source: Storage
+        Storage of the OpenAQ bucket, with connections for the mirror copies
+    """
+
+    return storage.open_ibm_bucket(OPENAQ_BUCKET, concurrency=MIRROR_WORKERS)
+
+
+def get_output_bucket():
+    """Open the output bucket
+    Returns
+    -------
+    output: Storage
+        Storage of the IBM COS output bucket, with connections for the mirror copies
+    """
+
+    return storage.open_ibm_bucket(COS_OUTPUT_BUCKET, IAM_API_KEY, ENDPOINT, concurrency=MIRROR_WORKERS)
+
+
+def get_target_days(event):
+    """Days to process, read from the input object at invocation time
+    Parameters
+    ----------
+    event: dict, required
+        Input object with an optional 'date' or 'start_date' and 'end_date' (YYYY-MM-DD)
     Returns
     -------
-    file_names: list
-        List of air quality files to be processed
+    days: list
+        Days in the range, both ends included, the previous day by default
     """
 
+    if 'start_date' in event:
+        start = date.fromisoformat(event['start_date'])
+        end = date.fromisoformat(event.get('end_date', event['start_date']))
+    elif 'date' in event:
+        start = end = date.fromisoformat(event['date'])
+    else:
+        start = end = datetime.utcnow().date() - timedelta(days=1)
+    if end < start:
+        log.error(f'Backfill ends before it starts: {start} to {end}')
+        raise ValueError(f'end_date {end} is before start_date {start}')
+    return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+
+def get_file_inventory(day):
+    """List files in OpenAQ bucket for one day
+    Parameters
+    ----------
+    day: string, required
+        Day to list (YYYY-MM-DD)
+    Returns
+    -------
+    objects: list of dicts
+        Name, size and ETag of the air quality files to be processed
+    """
+
+    objects = list_source_objects(day)
+    log.info(f"Total files to process for {day}: {len(objects)}")
+    return objects
+
+
+def list_source_objects(day):
+    """List the objects in OpenAQ bucket for one day
+    Parameters
+    ----------
+    day: string, required
+        Day to list (YYYY-MM-DD)
+    Returns
+    -------
+    objects: list of dicts
+        Name, size and ETag of each object
+    """
+
+    prefix = '{}/{}/'.format(DATA_PREFIX, day)
     try:
-        response = s3.list_objects_v2(Bucket=OPENAQ_BUCKET, Prefix=prefix)
-        file_names = [item['Key'] for item in response['Contents']]
-        log.info(f"Total files to process: {len(file_names)}")
+        objects = list(get_source_bucket().list(prefix))
     except Exception as e:
-        log.error(f'Unable to list OpenAQ files: {response}')
+        log.error(f'Unable to list OpenAQ files: {prefix}')
         log.debug(e)
         raise
-    return file_names
+    return objects
+
+
+def mirror_day(day):
+    """Copy the objects of a day that are new or changed since the last run to the mirror
+    Parameters
+    ----------
+    day: string, required
+        Day to mirror (YYYY-MM-DD)
+    Returns
+    -------
+    objects: list of dicts
+        Name, size and ETag of the air quality files to be processed
+    """
+
+    from concurrent.futures import as_completed
+
+    objects = list_source_objects(day)
+    manifest = read_mirror_manifest(day)
+    # the manifest maps each copied key to the ETag and size of its source object
+    new = [item for item in objects if manifest.get(item['key'], [None])[0] != item['etag']]
+    error = None
+    with ThreadPoolExecutor(max_workers=MIRROR_WORKERS) as executor:
+        futures = {executor.submit(copy_to_mirror, item['key']): item for item in new}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                future.result()
+                manifest[item['key']] = [item['etag'], item['size']]
+            except Exception as e:
+                log.error(f'Unable to mirror OpenAQ file: {item["key"]}')
+                log.debug(e)
+                error = e
+    # copies that succeeded are kept even if others failed, a rerun only retries the rest
+    if new:
+        write_mirror_manifest(day, manifest)
+    if error is not None:
+        raise error
+    log.info(f"Mirrored {len(new)} new files, total files to process for {day}: {len(objects)}")
+    return objects
+
+
+def read_mirror_manifest(day):
+    """Read the keys mirrored so far for a day
+    Parameters
+    ----------
+    day: string, required
+        Day of the manifest (YYYY-MM-DD)
+    Returns
+    -------
+    manifest: dict
+        ETag and size of the source object by key, empty if nothing was mirrored
+    """
+
+    try:
+        body = get_output_bucket().get('{}/{}'.format(MIRROR_PREFIX, MIRROR_MANIFEST_TEMPLATE.format(day)))
+    except storage.NotFound:
+        return {}
+    return json.loads(gzip.decompress(body))
+
+
+def write_mirror_manifest(day, manifest):
+    """Persist the keys mirrored for a day
+    Parameters
+    ----------
+    day: string, required
+        Day of the manifest (YYYY-MM-DD)
+    manifest: dict, required
+        ETag and size of the source object by key
+    """
+
+    get_output_bucket().put(
+        '{}/{}'.format(MIRROR_PREFIX, MIRROR_MANIFEST_TEMPLATE.format(day)),
+        gzip.compress(json.dumps(manifest, separators=(',', ':')).encode()))
+
+
+def read_telemetry():
+    """Read the mapper chunks of the latest runs from the telemetry written by the reducers
+    Returns
+    -------
+    chunks: list of dicts
+        Bytes, rows, duration and memory of each chunk, oldest first, empty without telemetry
+    """
+
+    try:
+        bucket = get_output_bucket()
+        keys = sorted(item['key'] for item in bucket.list(TELEMETRY_FOLDER))
+        chunks = []
+        for key in keys[-TELEMETRY_RUNS:]:
+            chunks.extend(json.loads(bucket.get(key))['chunks'])
+    except Exception as e:
+        log.warning('Unable to read telemetry, chunks keep the static size')
+        log.debug(e)
+        return []
+    return chunks
+
+
+def copy_to_mirror(key):
+    """Stream an OpenAQ object into the mirror
+    Parameters
+    ----------
+    key: string, required
+        Name of the file in OpenAQ bucket
+    """
+
+    storage.copy(get_source_bucket(), key, get_output_bucket(), '{}/{}'.format(MIRROR_PREFIX, key))
 
 
 def main(params):
-    # default chunk size if no value is provided in the input
-    chunk_size = 12
+    # a chunk size in the input overrides the sizing from the telemetry of earlier runs
+    chunk_size = None
 
     if 'chunk_size' in params and type(params['chunk_size']) == int:
         chunk_size = params['chunk_size']
 
-    file_names = get_file_inventory()
-    chunks = [file_names[i:i + chunk_size]
-              for i in range(0, len(file_names), chunk_size)]
+    max_concurrency = params.get('max_concurrency', MAX_CONCURRENCY)
+    days = get_target_days(params)
+    # the run starts here, its trace context travels with every chunk and result
+    trace = tracing.start(params, 'ListFiles', days=len(days))
+    try:
+        if params.get('incremental', INCREMENTAL_MODE):
+            # TransformData already wrote partial results as the files arrived,
+            # so the reducers only finalize the days
+            trace.end()
+            return {
+                "value": [],
+                "days": days,
+                "max_concurrency": max_concurrency,
+                "trace": trace.context(),
+                "message": "Init phase complete, finalizing partial results"}
+
+        # a backfill lists each day with its own request, with a mirror new files are copied first
+        inventory = mirror_day if MIRROR_PREFIX else get_file_inventory
+        with trace.span('list'), ThreadPoolExecutor(max_workers=max(1, min(len(days), 8))) as executor:
+            inventories = list(executor.map(inventory, days))
 
-    return {
-        "value": chunks,
-        "message": "Init phase complete"}
+        with trace.span('telemetry'):
+            model = None if chunk_size else planning.estimate_mapper_model(read_telemetry())
+        if model:
+            planned = planning.plan_chunks(days, inventories, model, max_concurrency)
+        else:
+            chunk_size = chunk_size or CHUNK_SIZE
+            planned = planning.fixed_chunks(days, inventories, chunk_size)
+        # chunks never mix days, so every mapper reports the day it worked on
+        chunks = [{"date": day, "files": files, "mirror": MIRROR_PREFIX, "trace": trace.context()}
+                  for day, files in planned]
+        trace.end(chunks=len(chunks))
+
+        return {
+            "value": chunks,
+            "days": [day for day, objects in zip(days, inventories) if objects],
+            "max_concurrency": max_concurrency,
+            "trace": trace.context(),
+            "message": "Init phase complete"}
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
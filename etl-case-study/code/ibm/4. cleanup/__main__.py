@@ -1,24 +1,19 @@
-import ibm_boto3
-import ibm_botocore
-from ibm_botocore.client import Config
-from ibm_botocore import UNSIGNED
+import ibm_botocore.exceptions
 
 import os
 import logging
 
+import storage
+import tracing
+
 IAM_API_KEY = os.environ.get('__OW_IAM_NAMESPACE_API_KEY')
 ACTIVATION_ID = os.environ.get('__OW_ACTIVATION_ID')
 ENDPOINT = 'https://s3.private.eu-de.cloud-object-storage.appdomain.cloud'
 COS_OUTPUT_BUCKET = 'openaq-output'
 
-ibm_cos = ibm_boto3.client("s3",
-    ibm_api_key_id=IAM_API_KEY,
-    config=Config(signature_version="oauth"),
-    endpoint_url=ENDPOINT
-)
-
 log = logging.getLogger()
 
+
 def delete_intermediate_results(intermediate_files):
     """Delete files from IBM Cloud Object Storage
     Parameters
@@ -28,20 +23,31 @@ def delete_intermediate_results(intermediate_files):
     """
 
     try:
-        log.info(
-            ibm_cos.delete_objects(
-                Bucket=COS_OUTPUT_BUCKET,
-                Delete={'Objects': intermediate_files}))
+        storage.open_ibm_bucket(COS_OUTPUT_BUCKET, IAM_API_KEY, ENDPOINT).delete_batch(
+            [item['Key'] for item in intermediate_files])
     except ibm_botocore.exceptions.ClientError as e:
         log.error(f'Unable to delete intermediate results')
         log.debug(e)
         raise
 
 def main(event):
-    # delete from COS bucket
-    delete_intermediate_results(event['intermediate_files'])
-
-    return {
-        "message": "Successfully deleted intermediate files", 
-        "results": f'Download results here {event["output_file"]}'
-    }
\ No newline at end of file
+    # a backfill passes the results of one reducer per day
+    results = event.get('value', [event])
+    # the last step of the run links the reducers it cleans up after
+    trace = tracing.start(event, 'CleanUp', links=[result.get('trace') for result in results])
+    try:
+        # delete from COS bucket
+        with trace.span('delete'):
+            delete_intermediate_results([item for result in results for item in result['intermediate_files']])
+
+        # days without data have no result
+        output_files = [result['output_file'] for result in results if result['output_file']]
+        trace.end()
+        return {
+            "message": "Successfully deleted intermediate files", 
+            "results": f'Download results here {", ".join(output_files)}'
+        }
+    except Exception as e:
+        # a failed invocation exports its spans as well
+        trace.end(error=type(e).__name__)
+        raise
@@ -1,7 +1,19 @@
 import requests
 import sys
 
+# only objects with these suffixes are announced, e.g. not every partition of an output, empty for all
+NOTIFY_SUFFIXES = ('_manifest.json', '.csv.gz')
+
+# reused by warm containers, keeps the connection to the queue manager open
+session = requests.Session()
+
 def main(params):
+    suffixes = NOTIFY_SUFFIXES
+    if 'NOTIFY_SUFFIXES' in params and type(params['NOTIFY_SUFFIXES']) == str:
+        suffixes = tuple(suffix.strip() for suffix in params['NOTIFY_SUFFIXES'].split(',') if suffix.strip())
+    if suffixes and 'key' in params and not params['key'].endswith(suffixes):
+        return { "result": "Not announcing " + params['key'] }
+
     host = 'host_name'
     queue_manager = 'queue_manager_name'
     queue_name = 'queue_name'
@@ -31,7 +43,7 @@ def main(params):
     if 'notification' in params:
         payload = params['notification']
 
-    response = requests.post(endpoint, headers=req_headers, json=payload)
+    response = session.post(endpoint, headers=req_headers, json=payload)
     message = response.text
     if not message:
         message = "Message successfully sent to the queue " + queue_name
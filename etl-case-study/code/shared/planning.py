@@ -0,0 +1,122 @@
+"""Chunk planning shared by ListFiles of all providers and the simulator
+
+ListFiles splits the files of a run into the chunks the mappers process. Without
+telemetry, or with a chunk size in the input, every chunk gets the same number of
+files. With telemetry, the duration of a mapper is fitted as a fixed overhead plus
+a time per byte, and the files are spread over chunks that take a mapper
+TARGET_MAPPER_SECONDS, in full waves of the concurrency of the run. The module is
+packaged next to the entry point of ListFiles, and tools/simulator.py plans its
+chunks with it.
+"""
+import heapq
+import logging
+import math
+import os
+
+# duration a mapper should take, chunks are sized from the throughput of earlier runs
+TARGET_MAPPER_SECONDS = int(os.environ.get('TARGET_MAPPER_SECONDS', 60))
+
+log = logging.getLogger()
+
+
+def fixed_chunks(days, inventories, chunk_size):
+    """Split the files of each day into chunks of the same number of files
+    Parameters
+    ----------
+    days: list, required
+        Days of the run (YYYY-MM-DD)
+    inventories: list, required
+        Name and size of the files of each day
+    chunk_size: int, required
+        Files per chunk
+    Returns
+    -------
+    chunks: list of tuples
+        Day and file names of each chunk, in the order of the days
+    """
+
+    return [(day, [item['key'] for item in objects[i:i + chunk_size]])
+            for day, objects in zip(days, inventories)
+            for i in range(0, len(objects), chunk_size)]
+
+
+def estimate_mapper_model(chunks):
+    """Fit the duration of a mapper as a fixed overhead plus a time per byte of input
+    Parameters
+    ----------
+    chunks: list, required
+        Bytes, duration and memory of earlier chunks, oldest first
+    Returns
+    -------
+    model: tuple
+        Overhead in seconds and seconds per byte, None without usable telemetry
+    """
+
+    # throughput follows the memory size, so only chunks of the current setting count
+    memory = chunks[-1]['memory'] if chunks else None
+    samples = [(chunk['bytes'], chunk['duration']) for chunk in chunks
+               if chunk['memory'] == memory and chunk['bytes'] > 0 and chunk['duration'] > 0]
+    if not samples:
+        return None
+    mean_bytes = sum(size for size, _ in samples) / len(samples)
+    mean_duration = sum(duration for _, duration in samples) / len(samples)
+    variance = sum((size - mean_bytes) ** 2 for size, _ in samples)
+    if variance > 0:
+        seconds_per_byte = sum((size - mean_bytes) * (duration - mean_duration) for size, duration in samples) / variance
+        overhead = mean_duration - seconds_per_byte * mean_bytes
+        if seconds_per_byte > 0 and overhead >= 0:
+            return overhead, seconds_per_byte
+    # chunks of similar size give no usable fit, so the whole duration is charged to the bytes
+    return 0.0, sum(duration for _, duration in samples) / sum(size for size, _ in samples)
+
+
+def plan_chunks(days, inventories, model, max_concurrency):
+    """Split the files of each day into chunks a mapper processes in the target duration
+    Parameters
+    ----------
+    days: list, required
+        Days of the run (YYYY-MM-DD)
+    inventories: list, required
+        Name and size of the files of each day
+    model: tuple, required
+        Overhead in seconds and seconds per byte of a mapper
+    max_concurrency: int, required
+        Mappers running at the same time
+    Returns
+    -------
+    chunks: list of tuples
+        Day and file names of each chunk, the largest chunks first
+    """
+
+    overhead, seconds_per_byte = model
+    total_bytes = sum(item['size'] for objects in inventories for item in objects)
+    total_files = sum(len(objects) for objects in inventories)
+    # bytes a mapper gets through in the target duration after its fixed overhead
+    target_bytes = max(TARGET_MAPPER_SECONDS - overhead, 1) / seconds_per_byte
+    count = max(math.ceil(total_bytes / target_bytes), 1)
+    if count > max_concurrency:
+        # a partly used last wave takes as long as a full one, so the files are spread over full waves
+        count = math.ceil(count / max_concurrency) * max_concurrency
+    count = min(count, total_files)
+
+    chunks = []
+    for day, objects in zip(days, inventories):
+        if not objects:
+            continue
+        # chunks never mix days, each day gets its share of the chunks
+        day_bytes = sum(item['size'] for item in objects)
+        share = day_bytes / total_bytes if total_bytes else len(objects) / total_files
+        bins = [(0, i, []) for i in range(min(len(objects), max(round(count * share), 1)))]
+        # the largest file goes to the lightest chunk, which keeps the chunks even
+        for item in sorted(objects, key=lambda item: item['size'], reverse=True):
+            size, i, files = heapq.heappop(bins)
+            files.append(item['key'])
+            heapq.heappush(bins, (size + item['size'], i, files))
+        chunks.extend((size, day, sorted(files)) for size, _, files in bins)
+    chunks.sort(key=lambda chunk: chunk[0], reverse=True)
+
+    if chunks:
+        waves = math.ceil(len(chunks) / max_concurrency)
+        longest = overhead + chunks[0][0] * seconds_per_byte
+        log.info(f"Planned {len(chunks)} chunks in {waves} waves, estimated mapper makespan up to {waves * longest:.0f}s")
+    return [(day, files) for _, day, files in chunks]
@@ -0,0 +1,977 @@
+"""Storage access shared by the ETL functions of all providers
+
+Buckets and containers are opened through this module, so clients, connection
+pools, ranged downloads, streaming uploads and batched deletes are implemented
+once for S3, IBM Cloud Object Storage and Azure Blob Storage. Clients are
+created on first use and kept for warm invocations. The module is packaged next
+to the entry point of every function.
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+
+# objects are streamed to storage in parts of this size while they are written
+UPLOAD_PART_SIZE = int(os.environ.get('UPLOAD_PART_SIZE', 8 * 1024 * 1024))
+# parts uploaded concurrently per stream, each holds one part in memory
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+# objects above this size are downloaded with concurrent ranged GETs
+RANGED_GET_THRESHOLD = int(os.environ.get('RANGED_GET_THRESHOLD', 16 * 1024 * 1024))
+DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+# connections per client, 0 sizes the pool to the concurrency the function asks for
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', 0))
+# default pool size of botocore and requests
+MIN_POOL_CONNECTIONS = 10
+# keys per delete request, S3 and IBM COS accept 1000, a blob batch 256
+S3_DELETE_BATCH_SIZE = 1000
+AZURE_DELETE_BATCH_SIZE = 256
+# local folder replacing all buckets and containers, for tests and benchmarks
+STORAGE_ROOT = os.environ.get('STORAGE_ROOT')
+
+# clients and storages by configuration, reused by warm containers
+clients = {}
+storages = {}
+
+log = logging.getLogger()
+
+
+class NotFound(Exception):
+    """The requested object does not exist"""
+
+
+def discard_file(path):
+    """Remove what a failed download left of a local file
+    Parameters
+    ----------
+    path: string, required
+        Local path of the download
+    """
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get_pool_size(concurrency=0):
+    """Number of connections a client keeps open
+    Parameters
+    ----------
+    concurrency: int, optional
+        Requests the function issues in parallel, besides the part uploads of a stream
+    Returns
+    -------
+    pool_size: int
+        MAX_POOL_CONNECTIONS if set, otherwise enough for the requests in flight
+    """
+
+    return MAX_POOL_CONNECTIONS or max(MIN_POOL_CONNECTIONS, concurrency + UPLOAD_WORKERS)
+
+
+def get_s3_client(concurrency=0, unsigned=False):
+    """Create an S3 client on first use
+    Parameters
+    ----------
+    concurrency: int, optional
+        Requests the function issues in parallel
+    unsigned: bool, optional
+        Send anonymous requests, for public buckets
+    Returns
+    -------
+    s3: boto3 client
+        S3 client cached for subsequent invocations
+    """
+
+    key = ('s3', unsigned, get_pool_size(concurrency))
+    if key not in clients:
+        import boto3
+        from botocore import UNSIGNED
+        from botocore.client import Config
+        config = Config(max_pool_connections=key[2])
+        if unsigned:
+            config = config.merge(Config(signature_version=UNSIGNED))
+        clients[key] = boto3.client('s3', config=config)
+    return clients[key]
+
+
+def get_ibm_cos_client(api_key=None, endpoint=None, concurrency=0):
+    """Create an IBM Cloud Object Storage client on first use
+    Parameters
+    ----------
+    api_key: string, optional
+        IAM API key, anonymous requests are sent without it
+    endpoint: string, optional
+        Endpoint of the service instance
+    concurrency: int, optional
+        Requests the function issues in parallel
+    Returns
+    -------
+    ibm_cos: ibm_boto3 client
+        IBM COS client cached for subsequent invocations
+    """
+
+    key = ('ibm', api_key, endpoint, get_pool_size(concurrency))
+    if key not in clients:
+        import ibm_boto3
+        from ibm_botocore import UNSIGNED
+        from ibm_botocore.client import Config
+        if api_key is None:
+            clients[key] = ibm_boto3.client('s3', endpoint_url=endpoint, config=Config(
+                signature_version=UNSIGNED, max_pool_connections=key[3]))
+        else:
+            clients[key] = ibm_boto3.client('s3', ibm_api_key_id=api_key, endpoint_url=endpoint, config=Config(
+                signature_version='oauth', max_pool_connections=key[3]))
+    return clients[key]
+
+
+def get_container_client(connection_str, container, concurrency=0):
+    """Create an Azure Blob Storage container client on first use
+    Parameters
+    ----------
+    connection_str: string, required
+        Connection string of the storage account
+    container: string, required
+        Name of the container
+    concurrency: int, optional
+        Requests the function issues in parallel
+    Returns
+    -------
+    container_client: ContainerClient
+        Container client cached for subsequent invocations
+    """
+
+    key = ('azure', connection_str, container, get_pool_size(concurrency))
+    if key not in clients:
+        import requests
+        from azure.core.pipeline.transport import RequestsTransport
+        from azure.storage.blob import ContainerClient
+        # requests keeps 10 connections per host unless the adapter is sized
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=key[3], pool_maxsize=key[3])
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        clients[key] = ContainerClient.from_connection_string(
+            conn_str=connection_str, container_name=container,
+            transport=RequestsTransport(session=session, session_owner=False))
+    return clients[key]
+
+
+def open_bucket(bucket, concurrency=0, unsigned=False):
+    """Open an S3 bucket
+    Parameters
+    ----------
+    bucket: string, required
+        Name of the bucket
+    concurrency: int, optional
+        Requests the function issues in parallel
+    unsigned: bool, optional
+        Send anonymous requests, for public buckets
+    Returns
+    -------
+    bucket: Storage
+        Storage of the bucket, a local folder if STORAGE_ROOT is set
+    """
+
+    if STORAGE_ROOT:
+        return open_local(os.path.join(STORAGE_ROOT, bucket))
+    key = ('s3', bucket, concurrency, unsigned)
+    if key not in storages:
+        storages[key] = S3Storage(get_s3_client(concurrency, unsigned), bucket)
+    return storages[key]
+
+
+def open_ibm_bucket(bucket, api_key=None, endpoint=None, concurrency=0):
+    """Open an IBM Cloud Object Storage bucket
+    Parameters
+    ----------
+    bucket: string, required
+        Name of the bucket
+    api_key: string, optional
+        IAM API key, anonymous requests are sent without it
+    endpoint: string, optional
+        Endpoint of the service instance
+    concurrency: int, optional
+        Requests the function issues in parallel
+    Returns
+    -------
+    bucket: Storage
+        Storage of the bucket, a local folder if STORAGE_ROOT is set
+    """
+
+    if STORAGE_ROOT:
+        return open_local(os.path.join(STORAGE_ROOT, bucket))
+    key = ('ibm', bucket, api_key, endpoint, concurrency)
+    if key not in storages:
+        storages[key] = S3Storage(get_ibm_cos_client(api_key, endpoint, concurrency), bucket)
+    return storages[key]
+
+
+def open_container(connection_str, container, concurrency=0):
+    """Open an Azure Blob Storage container
+    Parameters
+    ----------
+    connection_str: string, required
+        Connection string of the storage account
+    container: string, required
+        Name of the container
+    concurrency: int, optional
+        Requests the function issues in parallel
+    Returns
+    -------
+    container: Storage
+        Storage of the container, a local folder if STORAGE_ROOT is set
+    """
+
+    if STORAGE_ROOT:
+        return open_local(os.path.join(STORAGE_ROOT, container))
+    key = ('azure', connection_str, container, concurrency)
+    if key not in storages:
+        storages[key] = AzureBlobStorage(get_container_client(connection_str, container, concurrency))
+    return storages[key]
+
+
+def open_local(root):
+    """Open a local folder as storage
+    Parameters
+    ----------
+    root: string, required
+        Folder holding the objects, created if missing
+    Returns
+    -------
+    folder: LocalStorage
+        Storage of the folder
+    """
+
+    key = ('local', root)
+    if key not in storages:
+        storages[key] = LocalStorage(root)
+    return storages[key]
+
+
+def copy(source, key, target, target_key=None):
+    """Stream an object from one storage into another
+    Parameters
+    ----------
+    source: Storage, required
+        Storage holding the object
+    key: string, required
+        Name of the object
+    target: Storage, required
+        Storage to copy to
+    target_key: string, optional
+        Name of the copy, the name of the object by default
+    """
+
+    from contextlib import closing
+
+    with closing(source.open_reader(key)) as reader, target.open_writer(target_key or key) as writer:
+        shutil.copyfileobj(reader, writer, UPLOAD_PART_SIZE)
+
+
+class Storage:
+    """Objects of one bucket or container
+
+    Keys are names relative to the bucket or container. Missing objects raise
+    NotFound, other errors are raised as the provider SDK reports them.
+    """
+
+    def get(self, key):
+        """Read an object
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        Returns
+        -------
+        body: bytes
+            Content of the object
+        """
+
+        raise NotImplementedError
+
+    def head(self, key):
+        """Read the properties of an object
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        Returns
+        -------
+        properties: dict
+            Size, ETag and user metadata of the object
+        """
+
+        raise NotImplementedError
+
+    def download(self, key, path, part_size=DOWNLOAD_PART_SIZE, workers=1):
+        """Download an object into a local file
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        path: string, required
+            Local path to write to
+        part_size: int, optional
+            Bytes per request
+        workers: int, optional
+            Requests in flight for objects above RANGED_GET_THRESHOLD
+        Returns
+        -------
+        properties: dict
+            Size, ETag and user metadata of the downloaded object
+        """
+
+        raise NotImplementedError
+
+    def put(self, key, body, metadata=None):
+        """Write an object held in memory
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        body: bytes, required
+            Content of the object
+        metadata: dict, optional
+            User metadata of the object
+        """
+
+        raise NotImplementedError
+
+    def upload(self, key, path):
+        """Upload a local file
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        path: string, required
+            Local path to read from
+        """
+
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """List objects by name
+        Parameters
+        ----------
+        prefix: string, optional
+            Common beginning of the names
+        Returns
+        -------
+        objects: iterator of dicts
+            Name, size and ETag of each object, requested page by page
+        """
+
+        raise NotImplementedError
+
+    def delete_batch(self, keys):
+        """Delete objects with as few requests as the service allows
+        Parameters
+        ----------
+        keys: list, required
+            Names of the objects, missing ones are skipped
+        """
+
+        raise NotImplementedError
+
+    def open_reader(self, key):
+        """Open a stream that downloads an object while it is read
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        Returns
+        -------
+        reader: file object
+            Binary stream of the content
+        """
+
+        raise NotImplementedError
+
+    def open_writer(self, key, metadata=None):
+        """Open a stream that uploads an object while it is written
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        metadata: dict, optional
+            User metadata of the object
+        Returns
+        -------
+        writer: file object
+            Binary stream, the object is complete when it is closed. Leaving a
+            with block on an exception discards what was uploaded.
+        """
+
+        raise NotImplementedError
+
+
+class S3Storage(Storage):
+    """Objects of an S3 or IBM Cloud Object Storage bucket
+    Parameters
+    ----------
+    client: boto3 or ibm_boto3 client, required
+        Client for the bucket
+    bucket: string, required
+        Name of the bucket
+    """
+
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def is_not_found(self, e):
+        # head requests carry no error body, only the status code
+        return e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.client.exceptions.ClientError as e:
+            if self.is_not_found(e):
+                raise NotFound(key) from e
+            raise
+
+    def head(self, key):
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError as e:
+            if self.is_not_found(e):
+                raise NotFound(key) from e
+            raise
+        return {'size': response['ContentLength'], 'etag': response['ETag'], 'metadata': response.get('Metadata', {})}
+
+    def fetch_range(self, key, etag, fd, start, end):
+        """Download a byte range of an object into its place in a local file
+        Parameters
+        ----------
+        key: string, required
+            Name of the object
+        etag: string, required
+            ETag of the object, the range is only read from this version
+        fd: int, required
+            Descriptor of the local file
+        start: int, required
+            First byte of the range
+        end: int, required
+            Last byte of the range
+        """
+
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=key, Range='bytes={}-{}'.format(start, end), IfMatch=etag)
+        os.pwrite(fd, response['Body'].read(), start)
+
+    def download(self, key, path, part_size=DOWNLOAD_PART_SIZE, workers=1):
+        from concurrent.futures import ThreadPoolExecutor
+
+        # the first part tells the size of the object, small objects need no further request
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key, Range='bytes=0-{}'.format(part_size - 1))
+        except self.client.exceptions.ClientError as e:
+            if self.is_not_found(e):
+                raise NotFound(key) from e
+            # ranges of empty objects are not satisfiable
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        size = int(response.get('ContentRange', '/0').split('/')[-1])
+        # large objects are read in parallel, others with a single request for the rest
+        if size > RANGED_GET_THRESHOLD and workers > 1:
+            ranges = [(start, min(start + part_size, size) - 1) for start in range(part_size, size, part_size)]
+        else:
+            ranges = [(part_size, size - 1)] if size > part_size else []
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        try:
+            os.pwrite(fd, response['Body'].read(), 0)
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = [executor.submit(self.fetch_range, key, response['ETag'], fd, start, end)
+                           for start, end in ranges]
+                for future in futures:
+                    future.result()
+        except Exception:
+            # e.g. the object changed between the ranges, no partial file is left behind
+            os.close(fd)
+            discard_file(path)
+            raise
+        os.close(fd)
+        return {'size': size, 'etag': response['ETag'], 'metadata': response.get('Metadata', {})}
+
+    def put(self, key, body, metadata=None):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body, Metadata=metadata or {})
+
+    def upload(self, key, path):
+        self.client.upload_file(path, self.bucket, key)
+
+    def list(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield {'key': item['Key'], 'size': item['Size'], 'etag': item['ETag']}
+
+    def delete_batch(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in keys[i:i + S3_DELETE_BATCH_SIZE]], 'Quiet': True})
+            for error in response.get('Errors', []):
+                log.warning(f'Unable to delete {error["Key"]}: {error["Code"]}')
+
+    def open_reader(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        except self.client.exceptions.ClientError as e:
+            if self.is_not_found(e):
+                raise NotFound(key) from e
+            raise
+
+    def open_writer(self, key, metadata=None):
+        return MultipartWriter(self, key, metadata)
+
+
+class AzureBlobStorage(Storage):
+    """Blobs of an Azure Blob Storage container
+    Parameters
+    ----------
+    container_client: ContainerClient, required
+        Client for the container
+    """
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+
+    def properties(self, blob):
+        return {'size': blob.size, 'etag': blob.etag, 'metadata': blob.metadata or {}}
+
+    def get(self, key):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            return self.container_client.download_blob(key).readall()
+        except ResourceNotFoundError as e:
+            raise NotFound(key) from e
+
+    def head(self, key):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            return self.properties(self.container_client.get_blob_client(key).get_blob_properties())
+        except ResourceNotFoundError as e:
+            raise NotFound(key) from e
+
+    def download(self, key, path, part_size=DOWNLOAD_PART_SIZE, workers=1):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            with open(path, 'wb') as f:
+                downloader = self.container_client.download_blob(key, max_concurrency=max(1, workers))
+                downloader.readinto(f)
+        except ResourceNotFoundError as e:
+            # the file is opened before the blob is requested
+            discard_file(path)
+            raise NotFound(key) from e
+        except Exception:
+            discard_file(path)
+            raise
+        return self.properties(downloader.properties)
+
+    def put(self, key, body, metadata=None):
+        self.container_client.upload_blob(key, body, overwrite=True, metadata=metadata)
+
+    def upload(self, key, path):
+        with open(path, 'rb') as data:
+            self.container_client.upload_blob(key, data, overwrite=True, max_concurrency=UPLOAD_WORKERS)
+
+    def list(self, prefix=''):
+        for blob in self.container_client.list_blobs(name_starts_with=prefix):
+            yield {'key': blob.name, 'size': blob.size, 'etag': blob.etag}
+
+    def delete_batch(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), AZURE_DELETE_BATCH_SIZE):
+            responses = self.container_client.delete_blobs(
+                *keys[i:i + AZURE_DELETE_BATCH_SIZE], raise_on_any_failure=False)
+            for key, response in zip(keys[i:i + AZURE_DELETE_BATCH_SIZE], responses):
+                if response.status_code not in (202, 404):
+                    log.warning(f'Unable to delete {key}: {response.status_code}')
+
+    def open_reader(self, key):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            return ChunkReader(self.container_client.download_blob(key).chunks())
+        except ResourceNotFoundError as e:
+            raise NotFound(key) from e
+
+    def open_writer(self, key, metadata=None):
+        return BlockBlobWriter(self, key, metadata)
+
+
+class MemoryStorage(Storage):
+    """Objects held in memory, for tests and benchmarks
+    Parameters
+    ----------
+    objects: dict, optional
+        Initial objects, content by name
+    """
+
+    def __init__(self, objects=None):
+        self.objects = {}
+        for key, body in (objects or {}).items():
+            self.put(key, body)
+
+    def load(self, key):
+        try:
+            return self.objects[key]
+        except KeyError:
+            raise NotFound(key) from None
+
+    def store(self, key, body, metadata):
+        self.objects[key] = {'body': bytes(body), 'metadata': dict(metadata or {})}
+
+    def remove(self, key):
+        self.objects.pop(key, None)
+
+    def keys(self, prefix):
+        return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def get(self, key):
+        return self.load(key)['body']
+
+    def head(self, key):
+        item = self.load(key)
+        return {
+            'size': len(item['body']),
+            'etag': '"{}"'.format(hashlib.md5(item['body']).hexdigest()),
+            'metadata': item['metadata']}
+
+    def download(self, key, path, part_size=DOWNLOAD_PART_SIZE, workers=1):
+        properties = self.head(key)
+        with open(path, 'wb') as f:
+            f.write(self.get(key))
+        return properties
+
+    def put(self, key, body, metadata=None):
+        self.store(key, body, metadata)
+
+    def upload(self, key, path):
+        with open(path, 'rb') as f:
+            self.store(key, f.read(), None)
+
+    def list(self, prefix=''):
+        for key in self.keys(prefix):
+            properties = self.head(key)
+            yield {'key': key, 'size': properties['size'], 'etag': properties['etag']}
+
+    def delete_batch(self, keys):
+        for key in keys:
+            self.remove(key)
+
+    def open_reader(self, key):
+        return io.BytesIO(self.get(key))
+
+    def open_writer(self, key, metadata=None):
+        return BufferWriter(self, key, metadata)
+
+
+class LocalStorage(MemoryStorage):
+    """Objects kept as files in a local folder, for tests and benchmarks
+    Parameters
+    ----------
+    root: string, required
+        Folder holding the objects, user metadata is kept below root/.metadata
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        super().__init__()
+
+    def metadata_path(self, key):
+        return os.path.join(self.root, '.metadata', key + '.json')
+
+    def load(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                body = f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise NotFound(key) from None
+        try:
+            with open(self.metadata_path(key)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            metadata = {}
+        return {'body': body, 'metadata': metadata}
+
+    def store(self, key, body, metadata):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(body)
+        if metadata:
+            os.makedirs(os.path.dirname(self.metadata_path(key)), exist_ok=True)
+            with open(self.metadata_path(key), 'w') as f:
+                json.dump(metadata, f)
+        else:
+            self.remove_metadata(key)
+
+    def remove_metadata(self, key):
+        try:
+            os.remove(self.metadata_path(key))
+        except FileNotFoundError:
+            pass
+
+    def remove(self, key):
+        try:
+            os.remove(os.path.join(self.root, key))
+        except FileNotFoundError:
+            pass
+        self.remove_metadata(key)
+
+    def keys(self, prefix):
+        keys = []
+        for folder, folders, files in os.walk(self.root):
+            if folder == self.root and '.metadata' in folders:
+                folders.remove('.metadata')
+            for name in files:
+                key = os.path.relpath(os.path.join(folder, name), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def upload(self, key, path):
+        target = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target)
+        self.remove_metadata(key)
+
+
+class ChunkReader(io.RawIOBase):
+    """Readable stream over the chunks of a blob download
+    Parameters
+    ----------
+    chunks: iterator of bytes, required
+        Chunks in order, requested as they are read
+    """
+
+    def __init__(self, chunks):
+        super().__init__()
+        self.chunks = chunks
+        self.chunk = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            self.chunk = next(self.chunks, None)
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+class PartWriter(io.RawIOBase):
+    """Writable stream that uploads parts in the background while it is written
+    Parameters
+    ----------
+    storage: Storage, required
+        Storage the object is written to
+    key: string, required
+        Name of the object
+    metadata: dict, optional
+        User metadata of the object
+
+    Objects smaller than one part are uploaded with a single request.
+    """
+
+    def __init__(self, storage, key, metadata=None):
+        super().__init__()
+        self.storage = storage
+        self.key = key
+        self.metadata = metadata or {}
+        self.buffer = bytearray()
+        self.executor = None
+        # futures of the uploaded parts, in order
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= UPLOAD_PART_SIZE:
+            self.submit_part(bytes(self.buffer[:UPLOAD_PART_SIZE]))
+            del self.buffer[:UPLOAD_PART_SIZE]
+        return len(data)
+
+    def submit_part(self, body):
+        """Upload a part in the background
+        Parameters
+        ----------
+        body: bytes, required
+            Content of the part
+        """
+
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        if self.executor is None:
+            self.start()
+            self.executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+        # the writer waits for a free worker, so memory stays bounded by the number of workers
+        pending = [part for part in self.parts if not part.done()]
+        if len(pending) >= UPLOAD_WORKERS:
+            wait(pending, return_when=FIRST_COMPLETED)
+        self.parts.append(self.executor.submit(self.upload_part, len(self.parts) + 1, body))
+
+    def start(self):
+        """Prepare the upload of the first part"""
+
+    def upload_part(self, number, body):
+        """Upload a part
+        Parameters
+        ----------
+        number: int, required
+            Number of the part, starting at 1
+        body: bytes, required
+            Content of the part
+        Returns
+        -------
+        part: object
+            Reference to the part for complete
+        """
+
+        raise NotImplementedError
+
+    def complete(self, parts):
+        """Assemble the object from its parts
+        Parameters
+        ----------
+        parts: list, required
+            References returned by upload_part, in order
+        """
+
+        raise NotImplementedError
+
+    def discard(self):
+        """Discard the parts uploaded so far"""
+
+    def close(self):
+        """Upload the remaining data and complete the object"""
+
+        if self.closed:
+            return
+        try:
+            if self.executor is None:
+                self.storage.put(self.key, bytes(self.buffer), self.metadata)
+            else:
+                if self.buffer:
+                    self.submit_part(bytes(self.buffer))
+                self.complete([part.result() for part in self.parts])
+                self.executor.shutdown()
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            super().close()
+
+    def abort(self):
+        """Stop uploading and discard the parts uploaded so far"""
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.discard()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class MultipartWriter(PartWriter):
+    """Writable stream that uploads to S3 or IBM COS with a multipart upload"""
+
+    upload_id = None
+
+    def start(self):
+        self.upload_id = self.storage.client.create_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.key, Metadata=self.metadata)['UploadId']
+
+    def upload_part(self, number, body):
+        response = self.storage.client.upload_part(
+            Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=body)
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def complete(self, parts):
+        self.storage.client.complete_multipart_upload(
+            Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+
+    def discard(self):
+        if self.upload_id is not None:
+            self.storage.client.abort_multipart_upload(
+                Bucket=self.storage.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+class BlockBlobWriter(PartWriter):
+    """Writable stream that stages the blocks of an Azure block blob
+
+    Blocks that are never committed are discarded by the service.
+    """
+
+    def start(self):
+        self.blob = self.storage.container_client.get_blob_client(self.key)
+
+    def upload_part(self, number, body):
+        # identifiers of a blob have to be base64 strings of equal length
+        block_id = base64.b64encode('{:08d}'.format(number).encode()).decode()
+        self.blob.stage_block(block_id, body)
+        return block_id
+
+    def complete(self, parts):
+        from azure.storage.blob import BlobBlock
+
+        self.blob.commit_block_list([BlobBlock(block_id=block_id) for block_id in parts], metadata=self.metadata)
+
+
+class BufferWriter(io.BytesIO):
+    """Writable stream that stores the object when it is closed
+    Parameters
+    ----------
+    storage: Storage, required
+        Storage the object is written to
+    key: string, required
+        Name of the object
+    metadata: dict, optional
+        User metadata of the object
+    """
+
+    def __init__(self, storage, key, metadata=None):
+        super().__init__()
+        self.storage = storage
+        self.key = key
+        self.metadata = metadata
+
+    def close(self):
+        if not self.closed:
+            self.storage.put(self.key, self.getvalue(), self.metadata)
+        super().close()
+
+    def abort(self):
+        """Discard the data written so far"""
+
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
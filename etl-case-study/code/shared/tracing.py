@@ -0,0 +1,245 @@
+"""Trace context and spans shared by the ETL functions of all providers
+
+A run gets a trace when it starts, and the trace context travels through the
+input and output of every function under the 'trace' key. Each invocation
+records a span for itself and for its I/O and compute phases. Mapper results
+carry their span, so a reducer links the mappers that fed it and the critical
+path of a run can be followed across invocations. Spans go to the exporter
+named by TRACE_EXPORTER when the invocation ends, also when it fails, with
+the name of the exception in the 'error' attribute. The module is packaged next
+to the entry point of every function.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# where spans go: 'none', 'log' (one JSON line per span in the function log) or 'jsonl'
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'none').lower()
+# file the 'jsonl' exporter appends to
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/openaq-traces.jsonl')
+# key of the trace context in function inputs and outputs
+TRACE_KEY = 'trace'
+
+log = logging.getLogger()
+
+
+class LogExporter:
+    """Write spans to the function log, where the log service of the provider keeps them"""
+
+    def export(self, spans):
+        for span in spans:
+            log.info('span ' + json.dumps(span, separators=(',', ':')))
+
+
+class JsonLinesExporter:
+    """Append spans to a local JSON-lines file"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span, separators=(',', ':')) + '\n' for span in spans)
+        with self.lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+# exporters by name, register_exporter() adds more
+exporters = {'log': LogExporter, 'jsonl': JsonLinesExporter}
+exporter = None
+
+
+def register_exporter(name, factory):
+    """Make an exporter available to TRACE_EXPORTER
+    Parameters
+    ----------
+    name: string, required
+        Value of TRACE_EXPORTER that selects the exporter
+    factory: callable, required
+        Returns an object with an export(spans) method
+    """
+
+    exporters[name] = factory
+
+
+def set_exporter(instance):
+    """Replace the exporter of all later invocations, None selects it from TRACE_EXPORTER again
+    Parameters
+    ----------
+    instance: object, required
+        Object with an export(spans) method
+    """
+
+    global exporter
+    exporter = instance
+
+
+def get_exporter():
+    """Exporter of the spans, created on first use
+    Returns
+    -------
+    exporter: object
+        Exporter with an export(spans) method, None if tracing is off
+    """
+
+    global exporter
+    if exporter is None and TRACE_EXPORTER in exporters:
+        exporter = exporters[TRACE_EXPORTER]()
+    return exporter
+
+
+def get_memory_size():
+    """Memory available to the function
+    Returns
+    -------
+    memory: int
+        Memory limit in bytes
+    """
+
+    # Lambda announces the configured memory, elsewhere the limit of the container applies
+    memory = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 0)) * 1024 * 1024
+    if memory:
+        return memory
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory
+
+
+def get_memory_usage():
+    """Configured and peak memory of the function
+    Returns
+    -------
+    memory: int
+        Memory of the function in MB, the container limit outside Lambda
+    peak_memory: int
+        Largest resident memory of the process in MB, None where it is not reported
+    """
+
+    memory = get_memory_size() // (1024 * 1024)
+    try:
+        import resource
+        # kilobytes on Linux, a warm container keeps the peak of earlier invocations
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+    except (ImportError, OSError):
+        peak_memory = None
+    return memory, peak_memory
+
+
+def new_id():
+    """Random span ID"""
+
+    return uuid.uuid4().hex[:16]
+
+
+class Invocation:
+    """Spans of one function invocation within the trace of a run"""
+
+    def __init__(self, function, trace_id, parent_id=None, links=None, **attributes):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.root = {
+            "trace_id": trace_id,
+            "span_id": new_id(),
+            "parent_id": parent_id,
+            "name": function,
+            "function": function,
+            "start": time.time(),
+            "end": None,
+            "links": links or [],
+            "attributes": attributes}
+
+    def context(self):
+        """Trace context to pass on in the input or output of the invocation
+        Returns
+        -------
+        context: dict
+            Trace ID and the span of this invocation as parent of the next step
+        """
+
+        return {"trace_id": self.root['trace_id'], "parent_id": self.root['span_id']}
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Record a phase of the invocation, attributes may be added to the yielded dict
+        Parameters
+        ----------
+        name: string, required
+            Name of the phase, e.g. 'download' or 'parse'
+        """
+
+        span = {
+            "trace_id": self.root['trace_id'],
+            "span_id": new_id(),
+            "parent_id": self.root['span_id'],
+            "name": name,
+            "function": self.root['function'],
+            "start": time.time(),
+            "end": None,
+            "links": [],
+            "attributes": attributes}
+        try:
+            yield span['attributes']
+        except Exception as e:
+            span['attributes']['error'] = type(e).__name__
+            raise
+        finally:
+            span['end'] = time.time()
+            with self.lock:
+                self.spans.append(span)
+
+    def end(self, **attributes):
+        """Close the invocation span and export all spans of the invocation, only the first call counts"""
+
+        if self.root['end'] is not None:
+            return
+        self.root['end'] = time.time()
+        self.root['attributes'].update(attributes)
+        target = get_exporter()
+        if target is None:
+            return
+        # the sizing tool picks memory and timeout of each function from these
+        memory, peak_memory = get_memory_usage()
+        self.root['attributes'].setdefault('memory', memory)
+        self.root['attributes'].setdefault('peak_memory', peak_memory)
+        with self.lock:
+            spans, self.spans = [self.root] + self.spans, []
+        try:
+            target.export(spans)
+        except Exception as e:
+            # tracing never fails the run
+            log.warning('Unable to export spans')
+            log.debug(e)
+
+
+def start(event, function, links=None, **attributes):
+    """Continue the trace of the run from the input, or start the trace of a new run
+    Parameters
+    ----------
+    event: dict, required
+        Input of the function, with the trace context under 'trace' after the first step
+    function: string, required
+        Name of the function
+    links: list, optional
+        Trace contexts of further inputs, e.g. the mappers that fed a reducer
+    Returns
+    -------
+    invocation: Invocation
+        Spans of this invocation
+    """
+
+    # steps that only receive the results of earlier steps continue the trace of their first input
+    context = (event or {}).get(TRACE_KEY) or next((link for link in links or [] if link), {})
+    return Invocation(function, context.get('trace_id') or uuid.uuid4().hex, context.get('parent_id'),
+                      [link['parent_id'] for link in links or [] if link and link.get('parent_id')],
+                      **attributes)
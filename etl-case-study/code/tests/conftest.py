@@ -0,0 +1,139 @@
+"""Shared setup of the tests of the ETL functions
+
+Functions are loaded from their folders the way the providers load them, with
+the modules of code/shared next to them. Missing cloud SDKs are stubbed and
+storage is a local folder per test.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED = os.path.join(CODE, 'shared')
+TESTS = os.path.join(CODE, 'tests')
+# settings the functions read at import
+ENVIRONMENT = {
+    'RESULTS_BUCKET': 'results',
+    'QUEUE_NAME': 'notifications',
+    'REGION': 'eu-central-1',
+    'AzureWebJobsStorage': 'UseDevelopmentStorage=true'}
+
+sys.path[:0] = [SHARED, TESTS]
+for name, value in ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+import stubs  # noqa: E402
+import storage  # noqa: E402
+
+stubs.install()
+
+
+def load_function(path):
+    """Import the entry point of a function
+    Parameters
+    ----------
+    path: string, required
+        Path of the module relative to code/, e.g. 'aws/3. reduce/__main__.py'
+    Returns
+    -------
+    module: module
+        Freshly imported module of the function
+    """
+
+    name = 'function_' + ''.join(c if c.isalnum() else '_' for c in path)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(CODE, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def storage_root(tmp_path, monkeypatch):
+    """Local folder replacing every bucket and container"""
+
+    monkeypatch.setattr(storage, 'STORAGE_ROOT', str(tmp_path / 'storage'))
+    monkeypatch.setattr(storage, 'storages', {})
+    return tmp_path / 'storage'
+
+
+# parameters the reducers name in the daily summary
+PARAMETERS = ['co', 'no2', 'o3', 'pm10', 'pm25']
+
+
+def make_readings(day, stations=6, hours=24, seed=0):
+    """Hourly OpenAQ readings of a day, one per station, parameter and hour
+    Parameters
+    ----------
+    day: string, required
+        Day of the readings (YYYY-MM-DD)
+    stations: int, optional
+        Number of stations, spread over two countries
+    hours: int, optional
+        Readings per station and parameter
+    seed: int, optional
+        Seed of the values
+    Returns
+    -------
+    readings: list of dicts
+        Records in the format of the OpenAQ fetch files
+    """
+
+    import random
+
+    rng = random.Random('{}-{}'.format(day, seed))
+    return [{
+        "country": 'DE' if station % 2 else 'FR',
+        "city": 'city-{}'.format(station % 3),
+        "location": 'station-{}'.format(station),
+        "parameter": parameter,
+        "value": round(rng.uniform(0, 100), 2),
+        "unit": 'µg/m³',
+        "date": {"utc": '{}T{:02d}:00:00.000Z'.format(day, hour)}}
+        for station in range(stations) for parameter in PARAMETERS for hour in range(hours)]
+
+
+def write_fetch_file(path, readings):
+    """Write readings as a gzipped ndjson fetch file"""
+
+    import gzip
+    import json
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(path, 'wt') as f:
+        f.write('\n'.join(json.dumps(reading) for reading in readings))
+
+
+def split_overlapping(readings, files, seed=0):
+    """Assign each reading to one or two files by a hash of its key
+
+    The parameters of one station and hour end up in different files, and about
+    a third of the readings is repeated in a second file.
+    """
+
+    import random
+
+    rng = random.Random(seed)
+    chunks = [[] for _ in range(files)]
+    for reading in readings:
+        first = rng.randrange(files)
+        chunks[first].append(reading)
+        if rng.random() < 0.35:
+            chunks[(first + 1 + rng.randrange(files - 1)) % files].append(reading)
+    return chunks
+
+
+def expected_summary(readings):
+    """Minimum, maximum and mean of each parameter per station from unique readings"""
+
+    import pandas as pd
+
+    df = pd.DataFrame([{
+        "country": reading['country'], "city": reading['city'], "location": reading['location'],
+        "parameter": reading['parameter'], "date.utc": reading['date']['utc'], "value": reading['value']}
+        for reading in readings]).drop_duplicates(['country', 'city', 'location', 'parameter', 'date.utc'])
+    summary = df.groupby(['country', 'city', 'location', 'parameter'])['value'].agg(['min', 'max', 'mean']).unstack()
+    summary.columns = ['{}_{}'.format(parameter, stat) for stat, parameter in summary.columns]
+    return summary.sort_index(axis=1)
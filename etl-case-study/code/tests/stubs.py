@@ -0,0 +1,56 @@
+"""Stand-ins for the cloud SDKs where they are not installed
+
+The functions import their SDK lazily, but some modules name SDK exceptions at
+import. A stub package answers every attribute with a new exception class, so
+the functions can be imported and run against local storage.
+"""
+
+import importlib.abc
+import importlib.machinery
+import sys
+import types
+
+# top-level packages replaced by a stub when no installed package is found
+STUBBED = ('azure', 'boto3', 'botocore', 'ibm_boto3', 'ibm_botocore', 'requests')
+
+
+class StubType(type):
+    """Class of stubbed SDK names, its attributes are functions that do nothing"""
+
+    def __getattr__(cls, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+class StubModule(types.ModuleType):
+    """Package whose attributes are created on first access"""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = StubType(name, (Exception,), {'__module__': self.__name__})
+        setattr(self, name, value)
+        return value
+
+
+class StubFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """Finder consulted after the regular ones, for the packages in STUBBED"""
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname.split('.')[0] not in STUBBED:
+            return None
+        return importlib.machinery.ModuleSpec(fullname, self, is_package=True)
+
+    def create_module(self, spec):
+        return StubModule(spec.name)
+
+    def exec_module(self, module):
+        module.__path__ = []
+
+
+def install():
+    """Stub the SDKs that cannot be imported, installed ones are left alone"""
+
+    if not any(isinstance(finder, StubFinder) for finder in sys.meta_path):
+        sys.meta_path.append(StubFinder())
@@ -0,0 +1,75 @@
+"""Readings repeated across mapper chunks are counted once in both layouts"""
+
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import expected_summary, load_function, make_readings, split_overlapping, write_fetch_file
+
+DAY = '2021-06-01'
+REDUCERS = ['aws/3. reduce/__main__.py', 'ibm/3. reduce/__main__.py', 'azure/ETL-app/AggregateData/__init__.py']
+
+
+def map_chunks(tmp_path, chunks, layout):
+    """Run the mapper steps on each chunk and write the intermediate files like TransformData"""
+
+    transform = load_function('aws/2. transform/__main__.py')
+    window = (pd.Timestamp(DAY, tz='UTC').value // 10**9, pd.Timestamp(DAY, tz='UTC').value // 10**9 + 86400)
+    paths = []
+    for i, chunk in enumerate(chunks):
+        source = str(tmp_path / 'fetches' / '{}.ndjson.gz'.format(i))
+        write_fetch_file(source, chunk)
+        df, _ = transform.parse_data(source, window)
+        path = str(tmp_path / '{}-{}.json.gz'.format(layout, i))
+        with gzip.open(path, 'wt') as f:
+            f.write(transform.process_data([df], layout).to_json())
+        paths.append(path)
+    return paths
+
+
+def reduce_files(reducer, paths, layout):
+    """Drop repeated readings across the intermediate files and summarize the day"""
+
+    seen = np.empty(0, dtype=np.uint64)
+    dataframes = []
+    for path in paths:
+        df, seen = reducer.drop_seen_readings(reducer.read_intermediate(path, 'gzip'), seen, layout)
+        dataframes.append(df)
+    summary = reducer.process_intermediate_results(dataframes, DAY, layout)
+    summary = summary.astype({column: str for column in ['country', 'city', 'location']})
+    return summary.set_index(['country', 'city', 'location']).drop(columns='date').sort_index().sort_index(axis=1)
+
+
+@pytest.mark.parametrize('path', REDUCERS)
+def test_overlapping_chunks_give_the_same_summary_in_both_layouts(tmp_path, path):
+    reducer = load_function(path)
+    readings = make_readings(DAY)
+    chunks = split_overlapping(readings, 4)
+    assert sum(len(chunk) for chunk in chunks) > len(readings)
+
+    expected = expected_summary(readings)
+    summaries = {layout: reduce_files(reducer, map_chunks(tmp_path, chunks, layout), layout)
+                 for layout in ('wide', 'long')}
+    for layout, summary in summaries.items():
+        pd.testing.assert_frame_equal(summary.astype('float64'), expected, check_names=False, rtol=1e-5,
+                                      obj='{} layout'.format(layout))
+    pd.testing.assert_frame_equal(summaries['wide'].astype('float64'), summaries['long'].astype('float64'),
+                                  rtol=1e-5)
+
+
+def test_wide_rows_split_across_chunks_keep_their_new_readings():
+    reducer = load_function('aws/3. reduce/__main__.py')
+    first = pd.DataFrame({'country': ['DE'], 'city': ['a'], 'location': ['s'], 'date.utc': [0],
+                          'o3': [1.0], 'pm25': [np.nan]})
+    second = pd.DataFrame({'country': ['DE'], 'city': ['a'], 'location': ['s'], 'date.utc': [0],
+                           'o3': [1.0], 'pm25': [2.0]})
+    seen = np.empty(0, dtype=np.uint64)
+    _, seen = reducer.drop_seen_readings(reducer.apply_schema(first), seen)
+    df, seen = reducer.drop_seen_readings(reducer.apply_schema(second), seen)
+    assert len(seen) == 2
+    assert np.isnan(df['o3'].iloc[0]) and df['pm25'].iloc[0] == 2.0
+    df, _ = reducer.drop_seen_readings(reducer.apply_schema(second), seen)
+    assert df.empty
@@ -0,0 +1,74 @@
+"""Import-time budget of every function
+
+Each entry point is imported in a fresh interpreter, as on a cold start. The
+import has to stay within IMPORT_BUDGET and must not load the heavy modules,
+which the functions import where they are used.
+"""
+
+import glob
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import CODE, ENVIRONMENT, SHARED, TESTS
+
+# seconds an import of a function may take, stubbed SDKs excluded
+IMPORT_BUDGET = float(os.environ.get('IMPORT_BUDGET', 0.25))
+# modules only the code paths that need them import
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'boto3', 'ibm_boto3', 'azure.storage.blob')
+
+# imports the function like its runtime does and reports the time and the loaded modules
+PROBE = '''
+import importlib, importlib.util, json, os, sys, time, types
+sys.path[:0] = [{shared!r}, {tests!r}]
+import stubs
+stubs.install()
+start = time.perf_counter()
+path = {path!r}
+if os.path.basename(path) == '__init__.py':
+    # Azure functions are packages of their function app and may import their siblings
+    app = types.ModuleType('app')
+    app.__path__ = [os.path.dirname(os.path.dirname(path))]
+    sys.modules['app'] = app
+    importlib.import_module('app.' + os.path.basename(os.path.dirname(path)))
+else:
+    spec = importlib.util.spec_from_file_location('handler', path)
+    spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(json.dumps({{"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}}))
+'''
+
+FUNCTIONS = sorted(
+    glob.glob(os.path.join(CODE, 'aws', '*', '__main__.py')) +
+    glob.glob(os.path.join(CODE, 'ibm', '*', '__main__.py')) +
+    glob.glob(os.path.join(CODE, 'azure', '*', '*', '__init__.py')))
+
+
+def import_function(path):
+    """Import a function in a new interpreter
+    Parameters
+    ----------
+    path: string, required
+        Entry point of the function
+    Returns
+    -------
+    report: dict
+        Seconds the import took and names of the loaded modules
+    """
+
+    environment = dict(ENVIRONMENT, **os.environ)
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE.format(shared=SHARED, tests=TESTS, path=path)],
+        capture_output=True, text=True, env=environment, cwd=os.path.dirname(path))
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+@pytest.mark.parametrize('path', FUNCTIONS, ids=[os.path.relpath(path, CODE) for path in FUNCTIONS])
+def test_import_within_budget(path):
+    report = import_function(path)
+    assert report['seconds'] < IMPORT_BUDGET
+    loaded = [name for name in HEAVY_MODULES if name in report['modules']]
+    assert not loaded, f'imported at module load: {", ".join(loaded)}'
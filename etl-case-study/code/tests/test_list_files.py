@@ -0,0 +1,30 @@
+"""Days a run of ListFiles covers"""
+
+import pytest
+
+from conftest import load_function
+
+LIST_FILES = ['aws/1. list-files/__main__.py', 'ibm/1. list-files/__main__.py', 'azure/ETL-app/ListFiles/__init__.py']
+
+
+@pytest.mark.parametrize('path', LIST_FILES)
+def test_backfill_includes_both_ends(path):
+    list_files = load_function(path)
+    assert list_files.get_target_days({'start_date': '2021-02-27', 'end_date': '2021-03-01'}) == [
+        '2021-02-27', '2021-02-28', '2021-03-01']
+    assert list_files.get_target_days({'date': '2021-03-01'}) == ['2021-03-01']
+
+
+@pytest.mark.parametrize('path', LIST_FILES)
+def test_reversed_backfill_is_rejected(path):
+    list_files = load_function(path)
+    with pytest.raises(ValueError, match='before start_date'):
+        list_files.get_target_days({'start_date': '2021-03-01', 'end_date': '2021-02-27'})
+
+
+def test_empty_day_is_logged_as_a_warning(storage_root, caplog, capsys):
+    list_files = load_function('aws/1. list-files/__main__.py')
+    assert list_files.get_file_inventory('2021-03-01') == []
+    assert [(record.levelname, record.message) for record in caplog.records] == [
+        ('WARNING', 'No OpenAQ files for 2021-03-01')]
+    assert capsys.readouterr().out == ''
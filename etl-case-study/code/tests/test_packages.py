@@ -0,0 +1,31 @@
+"""The committed function zips contain the current sources"""
+
+import os
+import zipfile
+
+import pytest
+
+from conftest import load_function
+
+package = load_function('tools/package.py')
+
+
+def test_committed_zips_match_their_sources():
+    stale = package.find_stale()
+    assert not stale, 'rebuild with python code/tools/package.py: {}'.format(', '.join(stale))
+
+
+@pytest.mark.parametrize('name', [name for name, entries in package.PACKAGES.items()
+                                  if ('shared/storage.py', 'storage.py') in entries])
+def test_functions_that_access_storage_ship_the_shared_modules(name):
+    with zipfile.ZipFile(os.path.join(package.TEMPLATES, name)) as archive:
+        assert {'storage.py', 'tracing.py'} <= set(archive.namelist())
+
+
+def test_rebuilding_unchanged_sources_gives_identical_zips(tmp_path):
+    name = next(iter(package.PACKAGES))
+    first, second = str(tmp_path / 'first.zip'), str(tmp_path / 'second.zip')
+    package.write_package(first, package.read_sources(package.PACKAGES[name]))
+    package.write_package(second, package.read_sources(package.PACKAGES[name]))
+    with open(first, 'rb') as a, open(second, 'rb') as b:
+        assert a.read() == b.read()
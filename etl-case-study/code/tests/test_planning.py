@@ -0,0 +1,64 @@
+"""ListFiles of every provider plans its chunks with the shared planning"""
+
+import pytest
+
+import planning
+from conftest import load_function
+
+LIST_FILES = ['aws/1. list-files/__main__.py', 'ibm/1. list-files/__main__.py', 'azure/ETL-app/ListFiles/__init__.py']
+
+DAYS = ['2021-06-01', '2021-06-02']
+
+
+def make_inventories(sizes_by_day):
+    """Inventories as get_file_inventory() returns them"""
+
+    return [[{'key': '{}/{:02d}.ndjson.gz'.format(day, i), 'size': size} for i, size in enumerate(sizes)]
+            for day, sizes in zip(DAYS, sizes_by_day)]
+
+
+def test_fit_recovers_overhead_and_rate_of_the_current_memory_size():
+    chunks = [{'bytes': size, 'memory': 2048, 'duration': 100.0} for size in (1000, 2000)]
+    chunks += [{'bytes': size, 'memory': 1024, 'duration': 2.0 + size * 1e-6} for size in (1000000, 3000000)]
+
+    overhead, seconds_per_byte = planning.estimate_mapper_model(chunks)
+
+    assert overhead == pytest.approx(2.0) and seconds_per_byte == pytest.approx(1e-6)
+
+
+def test_chunks_of_one_size_charge_the_duration_to_the_bytes():
+    chunks = [{'bytes': 1000000, 'memory': 1024, 'duration': 4.0}] * 3
+    assert planning.estimate_mapper_model(chunks) == (0.0, pytest.approx(4e-6))
+    assert planning.estimate_mapper_model([]) is None
+
+
+def test_planned_chunks_fill_full_waves_without_mixing_days():
+    inventories = make_inventories([[100000 + 5000 * i for i in range(40)], [50000] * 20])
+    # a mapper gets through 590 kB in the target minute, so the 8.9 MB need more than one wave
+    model = (1.0, 1e-4)
+
+    planned = planning.plan_chunks(DAYS, inventories, model, 8)
+
+    assert len(planned) == 16
+    keys = sorted(key for _, files in planned for key in files)
+    assert keys == sorted(item['key'] for objects in inventories for item in objects)
+    assert all(key.startswith(day) for day, files in planned for key in files)
+    sizes = {item['key']: item['size'] for objects in inventories for item in objects}
+    loads = [sum(sizes[key] for key in files) for day, files in planned if day == DAYS[0]]
+    assert max(loads) - min(loads) <= max(sizes.values())
+
+
+def test_fixed_chunks_keep_the_order_of_the_files():
+    inventories = make_inventories([[1] * 5, [1] * 2])
+
+    planned = planning.fixed_chunks(DAYS, inventories, 2)
+
+    assert [(day, len(files)) for day, files in planned] == [(DAYS[0], 2), (DAYS[0], 2), (DAYS[0], 1), (DAYS[1], 2)]
+    assert planned[0][1] == [inventories[0][0]['key'], inventories[0][1]['key']]
+
+
+@pytest.mark.parametrize('path', LIST_FILES)
+def test_list_files_uses_the_shared_planning(path):
+    list_files = load_function(path)
+    assert list_files.planning is planning
+    assert not hasattr(list_files, 'plan_chunks') and not hasattr(list_files, 'estimate_mapper_model')
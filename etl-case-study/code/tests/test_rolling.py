@@ -0,0 +1,73 @@
+"""Rolling windows do not depend on the order in which the days finish"""
+
+from datetime import date
+
+import pandas as pd
+import pytest
+
+from conftest import expected_summary, load_function, make_readings
+
+DAYS = ['2021-06-01', '2021-06-02', '2021-06-03', '2021-06-04', '2021-06-05']
+REDUCERS = ['aws/3. reduce/__main__.py', 'ibm/3. reduce/__main__.py', 'azure/ETL-app/AggregateData/__init__.py']
+
+
+def to_intermediate(reducer, readings):
+    """Readings in the long layout of the intermediate results"""
+
+    df = pd.DataFrame([{
+        "country": reading['country'], "city": reading['city'], "location": reading['location'],
+        "parameter": reading['parameter'],
+        "date.utc": pd.Timestamp(reading['date']['utc']).value // 10**9,
+        "value": reading['value']} for reading in readings])
+    return reducer.apply_schema(df)
+
+
+def run_days(reducer, order, readings):
+    """Finalize the rolling windows of each day in the given order"""
+
+    for day in order:
+        daily = reducer.compute_daily_state([to_intermediate(reducer, readings[day])], day, 'long')
+        reducer.update_rolling_aggregates(daily, day)
+
+
+def read_window(reducer, window, day):
+    """Summary of the persisted state of a window"""
+
+    state = reducer.read_state(reducer.ROLLING_STATE_TEMPLATE.format(window, day))
+    summary = reducer.summarize_rolling_state(state, day)
+    return summary.set_index(['country', 'city', 'location']).drop(columns='date').sort_index().sort_index(axis=1)
+
+
+@pytest.mark.parametrize('path', REDUCERS)
+@pytest.mark.parametrize('order', [[0, 1, 3, 2, 4], [4, 3, 2, 1, 0], [0, 2, 4, 1, 3]])
+def test_days_finishing_out_of_order_give_the_windows_of_an_ordered_run(storage_root, monkeypatch, path, order):
+    reducer = load_function(path)
+    monkeypatch.setattr(reducer, 'ROLLING_WINDOWS', [2, 3])
+    monkeypatch.setattr(reducer, 'OUTPUT_FORMATS', ['csv'])
+    readings = {day: make_readings(day) for day in DAYS}
+
+    run_days(reducer, [DAYS[i] for i in order], readings)
+
+    for window in (2, 3):
+        for day in DAYS:
+            number = date.fromisoformat(day).toordinal()
+            covered = [date.fromordinal(n).isoformat() for n in range(number - window + 1, number + 1)]
+            expected = expected_summary([reading for past in covered if past in readings
+                                         for reading in readings[past]])
+            pd.testing.assert_frame_equal(read_window(reducer, window, day), expected, check_names=False,
+                                          rtol=1e-5, obj='{} day window ending {}'.format(window, day))
+
+
+def test_reprocessed_day_refreshes_the_windows_after_it(storage_root, monkeypatch):
+    reducer = load_function('aws/3. reduce/__main__.py')
+    monkeypatch.setattr(reducer, 'ROLLING_WINDOWS', [3])
+    monkeypatch.setattr(reducer, 'OUTPUT_FORMATS', ['csv'])
+    readings = {day: make_readings(day) for day in DAYS}
+    run_days(reducer, DAYS, readings)
+
+    # late files change the second day after the later days finished
+    readings[DAYS[1]] = make_readings(DAYS[1], seed=1)
+    run_days(reducer, [DAYS[1]], readings)
+
+    expected = expected_summary(readings[DAYS[1]] + readings[DAYS[2]] + readings[DAYS[3]])
+    pd.testing.assert_frame_equal(read_window(reducer, 3, DAYS[3]), expected, check_names=False, rtol=1e-5)
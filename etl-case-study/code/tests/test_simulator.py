@@ -0,0 +1,45 @@
+"""The simulator follows the workflows and the chunk planning that are deployed"""
+
+from collections import OrderedDict
+
+import planning
+from conftest import load_function
+
+simulator = load_function('tools/simulator.py')
+
+INVENTORY = OrderedDict(('2021-06-0{}'.format(day), [100000 + 5000 * i for i in range(40)]) for day in (1, 2))
+
+
+def test_every_provider_honors_max_concurrency():
+    results = simulator.sweep(['aws', 'azure', 'ibm'], INVENTORY, simulator.load_model(), [4], [5, 20], [1024], ['wide'])
+    assert sorted((result['provider'], result['concurrency']) for result in results) == [
+        ('aws', 5), ('aws', 20), ('azure', 5), ('azure', 20), ('ibm', 5), ('ibm', 20)]
+    for provider in ('aws', 'azure', 'ibm'):
+        by_limit = {result['concurrency']: result for result in results if result['provider'] == provider}
+        assert by_limit[5]['map_seconds'] > by_limit[20]['map_seconds']
+
+
+def test_telemetry_is_fitted_like_list_files():
+    chunks = [{'bytes': size, 'rows': 10, 'memory': 1024, 'duration': 2.0 + size * 1e-6}
+              for size in (1000000, 2000000, 4000000)]
+    transform, _ = simulator.fit_transform_model(chunks)
+    assert tuple(transform['1024'].values()) == planning.estimate_mapper_model(chunks)
+
+
+def test_adaptive_chunks_are_planned_like_list_files():
+    model = (1.0, 1e-5)
+    chunks = simulator.chunk_inventory(INVENTORY, 0, model, 8)
+    inventories = [[{'key': '{}/{}'.format(day, i), 'size': size} for i, size in enumerate(sizes)]
+                   for day, sizes in INVENTORY.items()]
+    planned = planning.plan_chunks(list(INVENTORY), inventories, model, 8)
+    assert [(day, count) for day, _, count in chunks] == [(day, len(files)) for day, files in planned]
+    assert sum(size for _, size, _ in chunks) == sum(sum(sizes) for sizes in INVENTORY.values())
+
+
+def test_more_results_than_the_fan_in_add_a_combine_level():
+    model = simulator.load_model()
+    direct = simulator.simulate('aws', INVENTORY, model, 2, 40, 1024, 'wide', fan_in=0)
+    combined = simulator.simulate('aws', INVENTORY, model, 2, 40, 1024, 'wide', fan_in=16)
+    assert direct['combiners'] == 0
+    assert combined['combiners'] == 3
+    assert simulator.simulate('aws', INVENTORY, model, 8, 40, 1024, 'wide', fan_in=16)['combiners'] == 0
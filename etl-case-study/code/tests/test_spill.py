@@ -0,0 +1,77 @@
+"""Days spilled to disk give the summary of the in-memory aggregation"""
+
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import storage
+from conftest import expected_summary, load_function, make_readings, split_overlapping
+from test_dedup import DAY, REDUCERS, map_chunks
+
+
+def aggregate_in_memory(reducer, paths, layout):
+    """Summary and daily state the reducer computes for a day within its budget"""
+
+    seen = np.empty(0, dtype=np.uint64)
+    dataframes = []
+    for path in paths:
+        df, seen = reducer.drop_seen_readings(reducer.read_intermediate(path, 'gzip'), seen, layout)
+        dataframes.append(df)
+    return (reducer.process_intermediate_results(dataframes, DAY, layout),
+            reducer.compute_daily_state(dataframes, DAY, layout))
+
+
+def with_string_keys(df, columns):
+    """Keys as plain strings, categoricals of different files do not compare"""
+
+    return df.astype({column: str for column in columns})
+
+
+@pytest.mark.parametrize('layout', ['wide', 'long'])
+@pytest.mark.parametrize('path', REDUCERS)
+def test_spilled_day_matches_the_in_memory_aggregation(tmp_path, monkeypatch, path, layout):
+    reducer = load_function(path)
+    monkeypatch.setattr(reducer, 'SPILL_FOLDER', str(tmp_path))
+    monkeypatch.setattr(reducer, 'ROLLING_WINDOWS', [7])
+    # a budget of a quarter of the estimate spreads the stations over eight partitions
+    monkeypatch.setattr(reducer, 'AGGREGATION_MEMORY_BUDGET', 1000)
+    readings = make_readings(DAY, stations=12)
+    paths = map_chunks(tmp_path, split_overlapping(readings, 4), layout)
+    summary, daily = aggregate_in_memory(reducer, paths, layout)
+
+    spilled, spilled_daily = reducer.aggregate_external([(path, 'gzip') for path in paths], DAY, layout, 4000)
+
+    keys = ['country', 'city', 'location']
+    pd.testing.assert_frame_equal(with_string_keys(spilled, keys), with_string_keys(summary, keys))
+    pd.testing.assert_frame_equal(
+        spilled_daily.sort_values(reducer.STATE_KEY).reset_index(drop=True),
+        daily.sort_values(reducer.STATE_KEY).reset_index(drop=True))
+    expected = expected_summary(readings)
+    pd.testing.assert_frame_equal(
+        with_string_keys(spilled, keys).set_index(keys).drop(columns='date').sort_index(axis=1).astype('float64'),
+        expected, check_names=False, rtol=1e-5)
+    # the intermediate files and the spill folder are gone
+    assert sorted(os.listdir(tmp_path)) == ['fetches']
+
+
+@pytest.mark.parametrize('formats', [['csv'], []])
+def test_reducer_removes_the_downloaded_intermediate_results(storage_root, tmp_path, monkeypatch, formats):
+    reducer = load_function('aws/3. reduce/__main__.py')
+    monkeypatch.setattr(reducer, 'ROLLING_WINDOWS', [])
+    monkeypatch.setattr(reducer, 'OUTPUT_FORMATS', formats)
+    results = storage.open_bucket(reducer.RESULTS_BUCKET)
+    items = []
+    for path in map_chunks(tmp_path, split_overlapping(make_readings(DAY), 2), 'long'):
+        name = '{}-{}'.format(uuid.uuid4().hex, os.path.basename(path))
+        with open(path, 'rb') as f:
+            results.put(reducer.TEMP_FOLDER_TEMPLATE.format(name), f.read(), {'codec': 'gzip'})
+        items.append({"processed_file": name, "date": DAY, "layout": 'long'})
+
+    result = reducer.main({"value": items, "date": DAY}, None)
+
+    assert not any(os.path.exists(os.path.join('/tmp', item['processed_file'])) for item in items)
+    # without output formats the day has no result to point to
+    assert (result['result_path'] is None) == (not formats)
@@ -0,0 +1,331 @@
+"""Listings, streamed uploads and ranged downloads of the shared storage layer"""
+
+import hashlib
+import io
+import os
+import random
+
+import pytest
+
+import storage
+from conftest import load_function, make_readings, write_fetch_file
+
+
+class ClientError(Exception):
+    """Error of the fake client, shaped like botocore's"""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    """The part of an S3 client the storage layer uses, over objects in memory"""
+
+    exceptions = type('Exceptions', (), {'ClientError': ClientError})
+
+    def __init__(self, objects=None, page_size=1000, fail_part=None):
+        self.objects = dict(objects or {})
+        self.page_size = page_size
+        self.fail_part = fail_part
+        self.requests = []
+        self.uploads = {}
+        self.aborted = []
+        # size of every uploaded part by upload and part number
+        self.part_sizes = {}
+
+    def etag(self, key):
+        return '"{}"'.format(hashlib.md5(self.objects[key]).hexdigest())
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self.requests.append(('get_object', Range))
+        if Key not in self.objects:
+            raise ClientError('NoSuchKey')
+        body, etag = self.objects[Key], self.etag(Key)
+        if IfMatch is not None and IfMatch != etag:
+            raise ClientError('PreconditionFailed')
+        response = {'ETag': etag, 'Metadata': {}}
+        if Range is not None:
+            start, end = (int(value) for value in Range[len('bytes='):].split('-'))
+            if start >= len(body):
+                raise ClientError('InvalidRange')
+            end = min(end, len(body) - 1)
+            response['ContentRange'] = 'bytes {}-{}/{}'.format(start, end, len(body))
+            body = body[start:end + 1]
+        response['Body'] = io.BytesIO(body)
+        return response
+
+    def put_object(self, Bucket, Key, Body, Metadata):
+        self.requests.append(('put_object', None))
+        self.objects[Key] = bytes(Body)
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        # like S3, an empty listing is one page without contents
+        yield {'Contents': [{'Key': key, 'Size': len(self.objects[key]), 'ETag': self.etag(key)}
+                            for key in keys[:self.page_size]]} if keys else {}
+        for i in range(self.page_size, len(keys), self.page_size):
+            yield {'Contents': [{'Key': key, 'Size': len(self.objects[key]), 'ETag': self.etag(key)}
+                                for key in keys[i:i + self.page_size]]}
+
+    def create_multipart_upload(self, Bucket, Key, Metadata):
+        upload_id = 'upload-{}'.format(len(self.uploads) + len(self.aborted))
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise ClientError('InternalError')
+        self.uploads[UploadId][PartNumber] = bytes(Body)
+        self.part_sizes[UploadId, PartNumber] = len(Body)
+        return {'ETag': '"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(UploadId)
+
+
+class ChangingS3Client(FakeS3Client):
+    """Client whose object is overwritten right after the first ranged GET"""
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        response = super().get_object(Bucket, Key, Range, IfMatch)
+        self.objects[Key] = self.objects[Key][::-1]
+        return response
+
+
+@pytest.fixture(params=['memory', 'local'])
+def local_storage(request, tmp_path):
+    """Storage of the backends that run without a cloud account"""
+
+    if request.param == 'memory':
+        return storage.MemoryStorage()
+    return storage.LocalStorage(str(tmp_path / 'bucket'))
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def test_list_follows_every_page():
+    objects = {'day/{:02d}.gz'.format(i): random_bytes(i) for i in range(7)}
+    objects['other/00.gz'] = b'x'
+    client = FakeS3Client(objects, page_size=3)
+
+    listed = list(storage.S3Storage(client, 'bucket').list('day/'))
+
+    assert [item['key'] for item in listed] == sorted(key for key in objects if key.startswith('day/'))
+    assert [item['size'] for item in listed] == list(range(7))
+    assert list(storage.S3Storage(client, 'bucket').list('missing/')) == []
+
+
+def test_local_listings_filter_by_prefix_and_skip_metadata(local_storage):
+    local_storage.put('day/b.gz', b'bb', {'codec': 'gzip'})
+    local_storage.put('day/a.gz', b'a')
+    local_storage.put('dayafter/c.gz', b'c')
+
+    listed = list(local_storage.list('day/'))
+
+    assert [item['key'] for item in listed] == ['day/a.gz', 'day/b.gz']
+    assert [item['size'] for item in listed] == [1, 2]
+    assert local_storage.head('day/b.gz')['metadata'] == {'codec': 'gzip'}
+
+
+def test_etag_changes_with_the_content(local_storage):
+    local_storage.put('key', b'first')
+    etag = local_storage.head('key')['etag']
+    local_storage.put('key', b'second')
+    assert local_storage.head('key')['etag'] != etag
+    with pytest.raises(storage.NotFound):
+        local_storage.head('missing')
+
+
+@pytest.mark.parametrize('writes,parts', [
+    ([3, 15, 7, 1], [10, 10, 6]),
+    ([20], [10, 10]),
+    ([10, 0, 11], [10, 10, 1]),
+])
+def test_multipart_parts_are_cut_at_the_part_size(monkeypatch, writes, parts):
+    monkeypatch.setattr(storage, 'UPLOAD_PART_SIZE', 10)
+    client = FakeS3Client()
+    body = random_bytes(sum(writes))
+
+    with storage.S3Storage(client, 'bucket').open_writer('key') as writer:
+        offset = 0
+        for size in writes:
+            writer.write(body[offset:offset + size])
+            offset += size
+
+    assert client.objects['key'] == body
+    assert not client.uploads and not client.aborted
+    # only the last part may be shorter, and no empty part is uploaded
+    assert [client.part_sizes['upload-0', number] for number in range(1, len(parts) + 1)] == parts
+    assert len(client.part_sizes) == len(parts)
+
+
+def test_objects_smaller_than_a_part_are_put_with_one_request(monkeypatch):
+    monkeypatch.setattr(storage, 'UPLOAD_PART_SIZE', 10)
+    client = FakeS3Client()
+
+    with storage.S3Storage(client, 'bucket').open_writer('key') as writer:
+        writer.write(b'123456789')
+
+    assert client.objects['key'] == b'123456789'
+    assert client.requests == [('put_object', None)]
+    assert not client.uploads
+
+
+def test_error_while_writing_aborts_the_multipart_upload(monkeypatch):
+    monkeypatch.setattr(storage, 'UPLOAD_PART_SIZE', 10)
+    client = FakeS3Client()
+
+    with pytest.raises(RuntimeError):
+        with storage.S3Storage(client, 'bucket').open_writer('key') as writer:
+            writer.write(random_bytes(25))
+            raise RuntimeError('transform failed')
+
+    assert 'key' not in client.objects
+    assert client.aborted == ['upload-0'] and not client.uploads
+
+
+def test_failed_part_aborts_the_multipart_upload(monkeypatch):
+    monkeypatch.setattr(storage, 'UPLOAD_PART_SIZE', 10)
+    client = FakeS3Client(fail_part=2)
+
+    with pytest.raises(ClientError):
+        with storage.S3Storage(client, 'bucket').open_writer('key') as writer:
+            writer.write(random_bytes(35))
+
+    assert 'key' not in client.objects
+    assert client.aborted == ['upload-0'] and not client.uploads
+
+
+def test_local_writer_discards_the_object_on_error(local_storage):
+    with pytest.raises(RuntimeError):
+        with local_storage.open_writer('key') as writer:
+            writer.write(b'partial')
+            raise RuntimeError('transform failed')
+
+    with pytest.raises(storage.NotFound):
+        local_storage.get('key')
+
+
+@pytest.mark.parametrize('size', [0, 1, 63, 64, 65, 1000])
+def test_ranged_download_reassembles_the_object(monkeypatch, tmp_path, size):
+    monkeypatch.setattr(storage, 'RANGED_GET_THRESHOLD', 0)
+    body = random_bytes(size)
+    client = FakeS3Client({'key': body})
+    path = str(tmp_path / 'download')
+
+    properties = storage.S3Storage(client, 'bucket').download('key', path, part_size=64, workers=4)
+
+    with open(path, 'rb') as f:
+        assert f.read() == body
+    assert properties == {'size': size, 'etag': client.etag('key'), 'metadata': {}}
+    ranged = [request for request in client.requests if request[1] is not None]
+    assert len(ranged) == max(1, -(-size // 64))
+
+
+def test_download_below_the_threshold_takes_two_requests(tmp_path):
+    body = random_bytes(1000)
+    client = FakeS3Client({'key': body})
+    path = str(tmp_path / 'download')
+
+    storage.S3Storage(client, 'bucket').download('key', path, part_size=64, workers=4)
+
+    with open(path, 'rb') as f:
+        assert f.read() == body
+    assert client.requests == [('get_object', 'bytes=0-63'), ('get_object', 'bytes=64-999')]
+
+
+def test_object_changing_during_a_download_leaves_no_file(monkeypatch, tmp_path):
+    monkeypatch.setattr(storage, 'RANGED_GET_THRESHOLD', 0)
+    client = ChangingS3Client({'key': random_bytes(1000)})
+    path = str(tmp_path / 'download')
+
+    with pytest.raises(ClientError):
+        storage.S3Storage(client, 'bucket').download('key', path, part_size=64, workers=4)
+
+    assert not os.path.exists(path)
+
+
+def test_missing_object_leaves_no_file(tmp_path):
+    path = str(tmp_path / 'download')
+    with pytest.raises(storage.NotFound):
+        storage.S3Storage(FakeS3Client(), 'bucket').download('key', path)
+    assert not os.path.exists(path)
+
+
+def test_missing_blob_leaves_no_file(tmp_path):
+    from azure.core.exceptions import ResourceNotFoundError
+
+    class ContainerClient:
+        def download_blob(self, key, max_concurrency=1):
+            raise ResourceNotFoundError(key)
+
+    path = str(tmp_path / 'download')
+    with pytest.raises(storage.NotFound):
+        storage.AzureBlobStorage(ContainerClient()).download('key', path)
+    assert not os.path.exists(path)
+
+
+def test_cached_source_is_downloaded_again_when_its_etag_changes(storage_root, monkeypatch, tmp_path):
+    transform = load_function('aws/2. transform/__main__.py')
+    monkeypatch.setattr(transform, 'CACHE_FOLDER', str(tmp_path / 'cache'))
+    source = storage.open_bucket(transform.OPENAQ_BUCKET)
+    key = 'realtime-gzipped/2021-06-01/1.ndjson.gz'
+    source.put(key, b'first')
+
+    path = transform.download_data(key)
+    with open(path, 'rb') as f:
+        assert f.read() == b'first'
+    # an unchanged source is served from the cache without downloading it
+    with open(path, 'wb') as f:
+        f.write(b'cached')
+    assert transform.download_data(key) == path
+    with open(path, 'rb') as f:
+        assert f.read() == b'cached'
+
+    source.put(key, b'second')
+    path = transform.download_data(key)
+    with open(path, 'rb') as f:
+        assert f.read() == b'second'
+    assert transform.cache[key]['etag'] == source.head(key)['etag']
+
+
+def test_ibm_incremental_object_goes_through_the_download_cache(storage_root, monkeypatch, tmp_path):
+    transform = load_function('ibm/2. transform/__main__.py')
+    monkeypatch.setattr(transform, 'CACHE_FOLDER', str(tmp_path / 'cache'))
+    key = 'realtime-gzipped/2021-06-01/1.ndjson.gz'
+    fetch = tmp_path / 'fetch.ndjson.gz'
+    write_fetch_file(str(fetch), make_readings('2021-06-01', stations=2, hours=2))
+    incoming = storage.open_ibm_bucket('incoming')
+    incoming.put(key, fetch.read_bytes())
+
+    result = transform.main({"notification": {}, "bucket": 'incoming', "key": key})
+
+    assert [partial['date'] for partial in result['partials']] == ['2021-06-01']
+    assert transform.cache[key]['etag'] == incoming.head(key)['etag']
+    assert transform.cache[key]['path'].startswith(str(tmp_path / 'cache'))
+
+
+@pytest.mark.parametrize('path', ['aws/2. transform/__main__.py', 'ibm/2. transform/__main__.py',
+                                  'azure/ETL-app/TransformData/__init__.py'])
+@pytest.mark.parametrize('setting, workers', [('64', 16), ('4', 4), (None, 16)])
+def test_ranged_get_workers_stay_below_the_cap(monkeypatch, path, setting, workers):
+    if setting is None:
+        monkeypatch.delenv('RANGED_GET_WORKERS', raising=False)
+    else:
+        monkeypatch.setenv('RANGED_GET_WORKERS', setting)
+    transform = load_function(path)
+
+    assert transform.DOWNLOAD_CONCURRENCY == workers
+    if setting:
+        assert transform.get_ranged_get_parts()[1] == workers
@@ -0,0 +1,50 @@
+"""Spans of failed invocations are exported like those of successful ones"""
+
+import pytest
+
+import tracing
+from conftest import load_function
+
+CLEANUPS = ['aws/4. cleanup/__main__.py', 'ibm/4. cleanup/__main__.py', 'azure/ETL-app/CleanUp/__init__.py']
+
+
+class ListExporter:
+    """Keep the exported spans in memory"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    exporter = ListExporter()
+    monkeypatch.setattr(tracing, 'exporter', exporter)
+    return exporter.spans
+
+
+@pytest.mark.parametrize('path', CLEANUPS)
+def test_failed_invocation_exports_its_spans(storage_root, exported, path):
+    cleanup = load_function(path)
+    # a reducer result without its intermediate files fails the cleanup
+    event = {"result_path": None, "trace": {"trace_id": "run", "parent_id": "reducer"}}
+
+    with pytest.raises(KeyError):
+        cleanup.main(event, None) if path.startswith('aws') else cleanup.main(event)
+
+    root, delete = exported
+    assert (root['name'], root['trace_id'], root['parent_id']) == ('CleanUp', 'run', 'reducer')
+    assert root['end'] is not None and root['attributes']['error'] == 'KeyError'
+    assert root['attributes']['memory'] == tracing.get_memory_size() // (1024 * 1024)
+    assert delete['name'] == 'delete' and delete['attributes']['error'] == 'KeyError'
+
+
+def test_invocation_is_exported_once(exported):
+    trace = tracing.start({}, 'ListFiles')
+    trace.end(days=1)
+    trace.end(error='KeyError')
+
+    assert len(exported) == 1
+    assert exported[0]['attributes']['days'] == 1 and 'error' not in exported[0]['attributes']
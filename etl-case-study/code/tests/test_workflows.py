@@ -0,0 +1,122 @@
+"""The compiled workflows run the functions as the BPMN model says"""
+
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import storage
+from conftest import CODE, load_function
+
+COMPOSITION = os.path.join(CODE, 'ibm', 'main-orchestrator', 'main-orchestrator.js')
+
+# the combinators of @ibm-functions/composer the compiled module uses, run synchronously in node
+COMPOSER = r"""
+// functions see the variables of the enclosing composer.let, as in Composer
+const scope = (fn, vars) => new Function('vars', 'with (vars) { return (' + fn.toString() + ') }')(vars || {})
+const run = (step, params, vars) => step(params, vars)
+module.exports = {
+    function: fn => (params, vars) => {
+        const result = scope(fn, vars)(params)
+        return result === undefined ? params : result
+    },
+    action: (name, options) => params => global.invoke(name, params),
+    sequence: (...steps) => (params, vars) => steps.reduce((value, step) => run(step, value, vars), params),
+    let: (declarations, ...steps) => (params, vars) => {
+        const own = Object.assign(Object.create(null), declarations)
+        return steps.reduce((value, step) => run(step, value, own), params)
+    },
+    while: (test, body) => (params, vars) => {
+        for (let i = 0; scope(test, vars)(params); i++) {
+            if (i === 1000) throw new Error('the loop does not end')
+            params = run(body, params, vars)
+        }
+        return params
+    },
+    if: (test, consequent) => (params, vars) => scope(test, vars)(params) ? run(consequent, params, vars) : params,
+    retain: body => (params, vars) => ({ params: params, result: run(body, params, vars) }),
+    retry: (count, body) => (params, vars) => run(body, params, vars),
+    map: body => (params, vars) => {
+        global.waves.push(params.value.length)
+        return { value: params.value.map(item => run(body, item, vars)) }
+    }
+}
+"""
+
+# runs the composition with fake actions, ListFiles returns the output given on stdin
+RUNNER = r"""
+const listFiles = JSON.parse(require('fs').readFileSync(0, 'utf8'))
+const calls = {}
+global.waves = []
+global.invoke = (name, params) => {
+    calls[name] = (calls[name] || 0) + 1
+    if (name === 'ListFiles') return listFiles
+    if (name === 'TransformData') return { date: params.date, processed_file: params.files.join(',') }
+    if (name === 'AggregateData' && params.combine) return { value: [{ date: params.value[0].date }] }
+    if (name === 'AggregateData') return { date: params.date, chunks: params.value.length }
+    return { message: 'Processing complete', reducers: params.value }
+}
+const result = require(process.argv[2])({})
+console.log(JSON.stringify({ calls: calls, waves: global.waves, result: result }))
+"""
+
+
+def run_composition(tmp_path, list_files_output):
+    """Run the compiled IBM composition on the output of ListFiles"""
+
+    package = tmp_path / 'node_modules' / '@ibm-functions' / 'composer'
+    package.mkdir(parents=True)
+    (package / 'index.js').write_text(COMPOSER)
+    shutil.copy(COMPOSITION, tmp_path / 'composition.js')
+    (tmp_path / 'runner.js').write_text(RUNNER)
+    process = subprocess.run(['node', str(tmp_path / 'runner.js'), str(tmp_path / 'composition.js')],
+                             input=json.dumps(list_files_output), capture_output=True, text=True, timeout=60)
+    assert process.returncode == 0, process.stderr
+    return json.loads(process.stdout)
+
+
+@pytest.fixture
+def list_files(storage_root):
+    """IBM ListFiles over a day of 30 OpenAQ files"""
+
+    list_files = load_function('ibm/1. list-files/__main__.py')
+    source = storage.open_bucket(list_files.OPENAQ_BUCKET)
+    for i in range(30):
+        source.put('{}/2021-06-01/{:02d}.ndjson.gz'.format(list_files.DATA_PREFIX, i), b'{}')
+    return list_files
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node to run the composition')
+@pytest.mark.parametrize('max_concurrency', [4, None])
+def test_ibm_composition_runs_every_chunk_in_waves(tmp_path, list_files, max_concurrency):
+    params = {"date": '2021-06-01', "chunk_size": 2}
+    if max_concurrency:
+        params['max_concurrency'] = max_concurrency
+    output = list_files.main(params)
+    assert output['max_concurrency'] == (max_concurrency or list_files.MAX_CONCURRENCY)
+
+    run = run_composition(tmp_path, output)
+
+    assert run['calls'] == {'ListFiles': 1, 'TransformData': 15, 'AggregateData': 1, 'CleanUp': 1}
+    budget = max_concurrency or list_files.MAX_CONCURRENCY
+    assert run['waves'][:-1] == [min(budget, 15 - i) for i in range(0, 15, budget)]
+    assert run['result']['reducers'] == [{'date': '2021-06-01', 'chunks': 15}]
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node to run the composition')
+def test_ibm_composition_ends_without_max_concurrency(tmp_path, list_files):
+    output = list_files.main({"date": '2021-06-01', "chunk_size": 2})
+    del output['max_concurrency']
+
+    run = run_composition(tmp_path, output)
+
+    assert run['calls']['TransformData'] == 15
+    assert run['result']['reducers'] == [{'date': '2021-06-01', 'chunks': 15}]
+
+
+def test_ibm_list_files_passes_max_concurrency_when_finalizing(storage_root):
+    list_files = load_function('ibm/1. list-files/__main__.py')
+    output = list_files.main({"date": '2021-06-01', "incremental": True, "max_concurrency": 8})
+    assert output['value'] == [] and output['max_concurrency'] == 8
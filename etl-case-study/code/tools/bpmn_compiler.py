@@ -0,0 +1,572 @@
+"""Compile the BPMN model of the ETL into the workflow of each provider
+
+Reads the sequence of tasks of a BPMN process and the performance attributes of
+the tasks in the perf namespace, and writes the AWS Step Functions definition,
+the Azure Durable Functions orchestrator and the IBM Composer module.
+
+    python bpmn_compiler.py ../../orchestration-models/OpenAQ-ETL.bpmn
+    python bpmn_compiler.py model.bpmn --aws ETL.asl --ibm main-orchestrator.js
+    python bpmn_compiler.py model.bpmn --host ../azure/ETL-app/host.json
+
+Durable Functions activities take no timeout of their own, --host sets
+functionTimeout of the function app to the longest task timeout instead.
+
+Attributes of a task (xmlns:perf="urn:iaas:bpmn:performance"):
+
+    perf:timeout        seconds before an invocation is abandoned
+    perf:retry          retries after a failed invocation
+    perf:retryInterval  seconds before the first retry
+    perf:backoffRate    factor of the interval between consecutive retries
+    perf:batchSize      input files per mapper, instead of the sizing from telemetry
+
+Attributes of the multiInstanceLoopCharacteristics of a task:
+
+    perf:maxConcurrency     instances at a time, 'input' takes max_concurrency of the run
+    perf:collection         field of the state with the items, value by default
+    perf:elementVariable    field each instance receives its item in, the instance then
+                            gets all upstream results and picks its own
+    perf:fanIn              most upstream results per instance, larger inputs are first
+                            merged in groups by instances of the task with combine set
+"""
+
+import argparse
+import json
+import os
+import sys
+import textwrap
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+BPMN_NS = 'http://www.omg.org/spec/BPMN/20100524/MODEL'
+PERF_NS = 'urn:iaas:bpmn:performance'
+# BPMN elements compiled into an invocation of the function of the same name
+TASK_TAGS = ('task', 'serviceTask')
+DEFAULT_RETRY_INTERVAL = 1
+DEFAULT_BACKOFF_RATE = 2.0
+# extension of the workflow of each provider
+MODELS = OrderedDict([('aws', '.asl'), ('azure', '.py'), ('ibm', '.js')])
+# instances at a time when neither the model nor the run sets max_concurrency, as in ListFiles
+DEFAULT_MAX_CONCURRENCY = 40
+INDENT = ' ' * 4
+
+
+def get_attribute(element, name, cast, default=None):
+    """Performance attribute of a BPMN element
+    Parameters
+    ----------
+    element: Element, required
+        Task or loop characteristics
+    name: string, required
+        Attribute in the perf namespace
+    cast: callable, required
+        Type of the value
+    default: optional
+        Value of a missing attribute
+    Returns
+    -------
+    value:
+        Attribute converted to its type
+    """
+
+    value = element.get('{{{}}}{}'.format(PERF_NS, name))
+    if value is None:
+        return default
+    try:
+        value = cast(value)
+    except ValueError:
+        raise ValueError(f"perf:{name} of {element.get('id') or element.tag} is not a {cast.__name__}: {value}")
+    if isinstance(value, (int, float)) and value < 0:
+        raise ValueError(f"perf:{name} of {element.get('id') or element.tag} is negative")
+    return value
+
+
+def read_tasks(path):
+    """Read the tasks of a BPMN process in the order they run
+    Parameters
+    ----------
+    path: string, required
+        BPMN file with one process, a sequence of tasks between a start and an end event
+    Returns
+    -------
+    tasks: list of dicts
+        Name, ID, loop and performance attributes of each task
+    """
+
+    ns = {'bpmn': BPMN_NS}
+    process = ET.parse(path).getroot().find('bpmn:process', ns)
+    if process is None:
+        raise ValueError(f'No process in {path}')
+    elements = {element.get('id'): element for element in process}
+    flows = {}
+    for flow in process.findall('bpmn:sequenceFlow', ns):
+        if flow.get('sourceRef') in flows:
+            raise ValueError(f"{flow.get('sourceRef')} has more than one outgoing flow, only a sequence compiles")
+        flows[flow.get('sourceRef')] = flow.get('targetRef')
+    starts = process.findall('bpmn:startEvent', ns)
+    if len(starts) != 1:
+        raise ValueError('The process needs exactly one start event')
+
+    tasks = []
+    node = flows.get(starts[0].get('id'))
+    while node is not None:
+        element = elements.get(node)
+        tag = element.tag.split('}')[-1] if element is not None else None
+        if tag == 'endEvent':
+            break
+        if tag not in TASK_TAGS:
+            raise ValueError(f'{tag or "Missing element"} {node} is not supported, only a sequence of tasks compiles')
+        if any(task['id'] == node for task in tasks):
+            raise ValueError(f'{node} is part of a loop, only a sequence compiles')
+        tasks.append(read_task(element))
+        node = flows.get(node)
+    else:
+        raise ValueError(f'The sequence ends without an end event after {tasks[-1]["id"] if tasks else "the start"}')
+    if not tasks:
+        raise ValueError('The process has no tasks')
+    if sum(1 for task in tasks if task['batch_size']) > 1:
+        raise ValueError('perf:batchSize is set on more than one task')
+    return tasks
+
+
+def read_task(element):
+    """Name, loop and performance attributes of one task"""
+
+    name = element.get('name')
+    if not name or not name.isidentifier():
+        raise ValueError(f"Task {element.get('id')} needs the function name as its name")
+    loop = element.find('bpmn:multiInstanceLoopCharacteristics', {'bpmn': BPMN_NS})
+    task = {
+        "id": element.get('id'),
+        "name": name,
+        "multi": loop is not None,
+        "timeout": get_attribute(element, 'timeout', int),
+        "retry": get_attribute(element, 'retry', int, 0),
+        "retry_interval": get_attribute(element, 'retryInterval', int, DEFAULT_RETRY_INTERVAL),
+        "backoff_rate": get_attribute(element, 'backoffRate', float, DEFAULT_BACKOFF_RATE),
+        "batch_size": get_attribute(element, 'batchSize', int),
+        # None follows max_concurrency of the run
+        "max_concurrency": None,
+        "collection": 'value',
+        "element": None,
+        "fan_in": None}
+    if loop is None:
+        return task
+    concurrency = get_attribute(loop, 'maxConcurrency', str, 'input')
+    if loop.get('isSequential') == 'true':
+        concurrency = '1'
+    if concurrency != 'input':
+        task['max_concurrency'] = get_attribute(loop, 'maxConcurrency', int, 1)
+        if not task['max_concurrency']:
+            raise ValueError(f'perf:maxConcurrency of {name} must be at least 1')
+    task['collection'] = get_attribute(loop, 'collection', str, 'value')
+    task['element'] = get_attribute(loop, 'elementVariable', str)
+    for field in filter(None, [task['collection'], task['element']]):
+        if not field.isidentifier():
+            raise ValueError(f'{field} of {name} is not a valid field name')
+    if task['element'] and task['collection'] == 'value':
+        raise ValueError(f'perf:elementVariable of {name} needs a perf:collection other than value')
+    task['fan_in'] = get_attribute(loop, 'fanIn', int)
+    if task['fan_in'] is not None:
+        if not task['element']:
+            raise ValueError(f'perf:fanIn of {name} needs perf:elementVariable, only reducers merge results')
+        if task['fan_in'] < 2:
+            raise ValueError(f'perf:fanIn of {name} must be at least 2')
+    return task
+
+
+def asl_task(task, **transition):
+    """Task state that invokes the function of a task"""
+
+    state = OrderedDict([('Type', 'Task'), ('Resource', '{}_ARN'.format(task['name']))])
+    if task['timeout']:
+        state['TimeoutSeconds'] = task['timeout']
+    retrier = OrderedDict([('ErrorEquals', ['States.ALL'])])
+    if task['retry']:
+        retrier['IntervalSeconds'] = task['retry_interval']
+        retrier['MaxAttempts'] = task['retry']
+        retrier['BackoffRate'] = task['backoff_rate']
+    else:
+        retrier['MaxAttempts'] = 0
+    state['Retry'] = [retrier]
+    state.update(transition)
+    return state
+
+
+def asl_map(task, items_path, parameters, inner, result_path, result_selector=None, **transition):
+    """Map state that runs the function of a task on each item"""
+
+    state = OrderedDict([('Type', 'Map'), ('ItemsPath', items_path)])
+    if parameters:
+        state['Parameters'] = parameters
+    if result_selector:
+        state['ResultSelector'] = result_selector
+    state['ResultPath'] = result_path
+    if task['max_concurrency'] is None:
+        state['MaxConcurrencyPath'] = '$.max_concurrency'
+    else:
+        state['MaxConcurrency'] = task['max_concurrency']
+    state['Iterator'] = OrderedDict([
+        ('StartAt', inner),
+        ('States', OrderedDict([(inner, asl_task(task, End=True))]))])
+    state.update(transition)
+    return state
+
+
+def compile_asl(tasks, source):
+    """AWS Step Functions definition of the tasks
+    Parameters
+    ----------
+    tasks: list, required
+        Output of read_tasks()
+    source: string, required
+        Name of the BPMN file, noted in the definition
+    Returns
+    -------
+    definition: string
+        ASL document, function ARNs are placeholders named <function>_ARN
+    """
+
+    def entry(task):
+        suffix = task['name'], task['id']
+        if task['fan_in']:
+            return '{}FanIn{}'.format(*suffix)
+        if task['multi']:
+            return '{}Fanout{}'.format(*suffix)
+        return '{}{}'.format(*suffix)
+
+    states = OrderedDict()
+    batched = next((task for task in tasks if task['batch_size']), None)
+    if batched:
+        # the run input wins over the defaults of the model, braces are escaped in intrinsic function strings
+        defaults = json.dumps({"chunk_size": batched['batch_size']}).replace('{', '\\{').replace('}', '\\}')
+        states['Defaults'] = OrderedDict([
+            ('Type', 'Pass'),
+            ('Parameters', {"input.$": "States.JsonMerge(States.StringToJson('{}'), $, false)".format(defaults)}),
+            ('OutputPath', '$.input'),
+            ('Next', entry(tasks[0]))])
+    for i, task in enumerate(tasks):
+        transition = {'Next': entry(tasks[i + 1])} if i + 1 < len(tasks) else {'End': True}
+        name = '{}{}'.format(task['name'], task['id'])
+        if not task['multi']:
+            states[name] = asl_task(task, **transition)
+            continue
+        if not task['element']:
+            states[entry(task)] = asl_map(task, '$.' + task['collection'], None, name, '$.value', **transition)
+            continue
+        fanout = '{}Fanout{}'.format(task['name'], task['id'])
+        value = '$.value'
+        if task['fan_in']:
+            partition = '{}Partition{}'.format(task['name'], task['id'])
+            combine = '{}CombineFanout{}'.format(task['name'], task['id'])
+            skip = '{}SkipCombine{}'.format(task['name'], task['id'])
+            states[entry(task)] = OrderedDict([
+                ('Type', 'Choice'),
+                ('Choices', [OrderedDict([
+                    ('Variable', '$.value[{}]'.format(task['fan_in'])),
+                    ('IsPresent', True),
+                    ('Next', partition)])]),
+                ('Default', skip)])
+            states[partition] = OrderedDict([
+                ('Type', 'Pass'),
+                ('Parameters', {"groups.$": "States.ArrayPartition($.value, {})".format(task['fan_in'])}),
+                ('ResultPath', '$.combine'),
+                ('Next', combine)])
+            states[combine] = asl_map(
+                task, '$.combine.groups',
+                OrderedDict([("combine", True), ("value.$", "$$.Map.Item.Value"), ("trace.$", "$.trace")]),
+                '{}Combine{}'.format(task['name'], task['id']), '$.combine',
+                result_selector={"value.$": "$[*].value[*]"}, Next=fanout)
+            states[skip] = OrderedDict([
+                ('Type', 'Pass'),
+                ('Parameters', {"value.$": "$.value"}),
+                ('ResultPath', '$.combine'),
+                ('Next', fanout)])
+            value = '$.combine.value'
+        states[fanout] = asl_map(
+            task, '$.' + task['collection'],
+            OrderedDict([(task['element'] + '.$', '$$.Map.Item.Value'), ('value.$', value), ('trace.$', '$.trace')]),
+            name, '$.value', **transition)
+    definition = OrderedDict([
+        ('Comment', 'Compiled from {} by code/tools/bpmn_compiler.py'.format(source)),
+        ('StartAt', next(iter(states))),
+        ('States', states)])
+    return json.dumps(definition, indent=2) + '\n'
+
+
+def function_timeout(tasks):
+    """Longest task timeout of the model in seconds, None if no task has one"""
+
+    return max((task['timeout'] for task in tasks if task['timeout']), default=None)
+
+
+def update_host(tasks, path):
+    """Set functionTimeout in the host.json of an Azure function app to the longest task timeout
+    Parameters
+    ----------
+    tasks: list, required
+        Output of read_tasks()
+    path: string, required
+        host.json of the function app that runs the activities
+    """
+
+    seconds = function_timeout(tasks)
+    with open(path) as f:
+        host = json.load(f, object_pairs_hook=OrderedDict)
+    if seconds is None:
+        host.pop('functionTimeout', None)
+    else:
+        host['functionTimeout'] = '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+    with open(path, 'w') as f:
+        f.write(json.dumps(host, indent=2) + '\n')
+
+
+def retry_options(task):
+    """Variable of the retry options of a task in the orchestrator, e.g. retry_transform_data"""
+
+    return 'retry' + ''.join('_' + c.lower() if c.isupper() else c for c in task['name'])
+
+
+def compile_durable(tasks, source):
+    """Azure Durable Functions orchestrator of the tasks
+    Parameters
+    ----------
+    tasks: list, required
+        Output of read_tasks()
+    source: string, required
+        Name of the BPMN file, noted in the module
+    Returns
+    -------
+    module: string
+        Python module of the orchestrator function
+    """
+
+    def call(task, argument):
+        if task['retry']:
+            return 'context.call_activity_with_retry("{}", {}, {})'.format(task['name'], retry_options(task), argument)
+        return 'context.call_activity("{}", {})'.format(task['name'], argument)
+
+    body = []
+    if any(task['timeout'] for task in tasks):
+        body.append('# functionTimeout in host.json bounds every activity to the longest timeout of the model, '
+                    '{} seconds'.format(function_timeout(tasks)))
+    if any(task['retry'] and task['backoff_rate'] != 1 for task in tasks):
+        body.append('# retries wait a fixed interval, the Python SDK takes no backoff rate')
+    for task in tasks:
+        if task['retry']:
+            body.append('{} = df.RetryOptions({}, {})'.format(
+                retry_options(task), task['retry_interval'] * 1000, task['retry'] + 1))
+    body.append('result = context.get_input()')
+    batched = next((task for task in tasks if task['batch_size']), None)
+    if batched:
+        body.append('# the run input wins over the defaults of the model')
+        body.append('result = dict({{"chunk_size": {}}}, **(result or {{}}))'.format(batched['batch_size']))
+    for task in tasks:
+        if not task['multi']:
+            body.append('result = yield {}'.format(call(task, 'result')))
+            continue
+        budget = "result['max_concurrency']" if task['max_concurrency'] is None else str(task['max_concurrency'])
+        body.append('# at most {} {} activities at a time'.format(
+            'max_concurrency' if task['max_concurrency'] is None else task['max_concurrency'], task['name']))
+        body.append('budget = {}'.format(budget))
+        if not task['element']:
+            body.extend([
+                "items = result['{}']".format(task['collection']),
+                'outputs = []',
+                'for i in range(0, len(items), budget):',
+                INDENT + 'tasks = [{} for item in items[i:i + budget]]'.format(call(task, 'item')),
+                INDENT + 'outputs.extend((yield context.task_all(tasks)))',
+                "result['value'] = outputs"])
+            continue
+        body.append("value = result['value']")
+        if task['fan_in']:
+            k = task['fan_in']
+            body.extend([
+                '# a combine level merges groups of {} results, so no {} reads more of them'.format(k, task['name']),
+                'if len(value) > {}:'.format(k),
+                INDENT + 'groups = [value[i:i + {0}] for i in range(0, len(value), {0})]'.format(k),
+                INDENT + 'combined = []',
+                INDENT + 'for i in range(0, len(groups), budget):',
+                INDENT * 2 + 'tasks = [{} for group in groups[i:i + budget]]'.format(
+                    call(task, '{"combine": True, "value": group, "trace": result[\'trace\']}')),
+                INDENT * 2 + 'for output in (yield context.task_all(tasks)):',
+                INDENT * 3 + "combined.extend(output['value'])",
+                INDENT + 'value = combined'])
+        element = task['element']
+        body.extend([
+            '# one {} per {}, each with the results of its {}'.format(task['name'], element, element),
+            "{0} = result['{0}']".format(task['collection']),
+            'outputs = []',
+            'for i in range(0, len({}), budget):'.format(task['collection']),
+            INDENT + 'tasks = []',
+            INDENT + 'for {} in {}[i:i + budget]:'.format(element, task['collection']),
+            INDENT * 2 + "items = [item for item in value if item.get('{0}') == {0}]".format(element),
+            INDENT * 2 + 'tasks.append({})'.format(
+                call(task, '{{"{0}": {0}, "value": items, "trace": result[\'trace\']}}'.format(element))),
+            INDENT + 'outputs.extend((yield context.task_all(tasks)))',
+            "result['value'] = outputs"])
+    body.append('return result')
+    lines = [
+        'import azure.functions as func',
+        'import azure.durable_functions as df',
+        '',
+        '# compiled from {} by code/tools/bpmn_compiler.py'.format(source),
+        '',
+        'def orchestrator_function(context: df.DurableOrchestrationContext):']
+    lines.extend(INDENT + line for line in body)
+    lines.extend(['', 'main = df.Orchestrator.create(orchestrator_function)'])
+    return '\n'.join(lines) + '\n'
+
+
+def js_call(function, *arguments):
+    """Composer call, on one line when its arguments are"""
+
+    if all('\n' not in argument for argument in arguments) and \
+            len(function) + sum(len(argument) + 2 for argument in arguments) < 100:
+        return '{}({})'.format(function, ', '.join(arguments))
+    return '{}(\n{})'.format(function, ',\n'.join(textwrap.indent(argument, INDENT) for argument in arguments))
+
+
+# runs a composition on the items of params.value with a bounded number at a time
+WINDOWED = """\
+// runs body on the items of params.value, at most budget of them at a time,
+// max_concurrency of the run when budget is 0 and {0} without it
+const windowed = (budget, body) => composer.let(
+    {{ items: [], results: [], budget: budget }},
+    composer.function(params => {{ items = params.value; budget = budget || params.max_concurrency || {0} }}),
+    composer.while(
+        () => items.length > 0,
+        composer.sequence(
+            composer.function(() => ({{ value: items.splice(0, budget) }})),
+            composer.map(body),
+            composer.function(({{ value }}) => {{ results = results.concat(value) }}))),
+    composer.function(() => ({{ value: results }})))
+""".format(DEFAULT_MAX_CONCURRENCY)
+
+# keeps the state of the run and replaces its value with the result of a retained composition
+MERGE_VALUE = 'composer.function(({ params, result }) => Object.assign(params, { value: result.value }))'
+
+
+def compile_composer(tasks, source):
+    """IBM Composer module of the tasks
+    Parameters
+    ----------
+    tasks: list, required
+        Output of read_tasks()
+    source: string, required
+        Name of the BPMN file, noted in the module
+    Returns
+    -------
+    module: string
+        JavaScript module of the composition
+    """
+
+    def action(task):
+        if task['timeout']:
+            call = "composer.action('{}', {{ limits: {{ timeout: {} }} }})".format(task['name'], task['timeout'] * 1000)
+        else:
+            call = "composer.action('{}')".format(task['name'])
+        if task['retry']:
+            return js_call('composer.retry', str(task['retry']), call)
+        return call
+
+    def windowed(task):
+        return js_call('windowed', str(task['max_concurrency'] or 0), action(task))
+
+    steps = []
+    batched = next((task for task in tasks if task['batch_size']), None)
+    if batched:
+        steps.append('// the run input wins over the defaults of the model\n'
+                     'composer.function(params => Object.assign({{ chunk_size: {} }}, params))'.format(batched['batch_size']))
+    for task in tasks:
+        if not task['multi']:
+            steps.append(action(task))
+            continue
+        if not task['element']:
+            if task['collection'] == 'value':
+                retained = windowed(task)
+            else:
+                retained = js_call('composer.sequence', 'composer.function(params => ({{ value: params.{}, '
+                                   'max_concurrency: params.max_concurrency }}))'.format(task['collection']),
+                                   windowed(task))
+            steps.append(js_call('composer.retain', retained))
+            steps.append(MERGE_VALUE)
+            continue
+        element = task['element']
+        if task['fan_in']:
+            k = task['fan_in']
+            groups = ('composer.function(params => ({{\n'
+                      '    value: Array.from({{ length: Math.ceil(params.value.length / {0}) }}, (_, i) => ({{\n'
+                      '        combine: true, value: params.value.slice(i * {0}, i * {0} + {0}), trace: params.trace\n'
+                      '    }})),\n'
+                      '    max_concurrency: params.max_concurrency\n'
+                      '}}))').format(k)
+            flatten = ('composer.function(({ params, result }) => Object.assign(params, {\n'
+                       '    value: [].concat(...result.value.map(output => output.value))\n'
+                       '}))')
+            steps.append('// a combine level merges groups of {} results, so no {} reads more of them\n'.format(
+                k, task['name']) + js_call(
+                'composer.if',
+                'params => params.value.length > {}'.format(k),
+                js_call('composer.sequence',
+                        js_call('composer.retain', js_call('composer.sequence', groups, windowed(task))),
+                        flatten)))
+        instances = ('composer.function(params => ({{\n'
+                     '    value: params.{1}.map({0} => ({{\n'
+                     '        {0}: {0}, value: params.value.filter(item => item.{0} === {0}), trace: params.trace\n'
+                     '    }})),\n'
+                     '    max_concurrency: params.max_concurrency\n'
+                     '}}))').format(element, task['collection'])
+        steps.append('// one {} per {}, each with the results of its {}\n'.format(task['name'], element, element) +
+                     js_call('composer.retain', js_call('composer.sequence', instances, windowed(task))))
+        steps.append(MERGE_VALUE)
+    notes = []
+    if any(task['retry'] and task['retry_interval'] for task in tasks):
+        notes.append('// composer.retry retries at once, retryInterval and backoffRate only apply on AWS\n')
+    module = "const composer = require('@ibm-functions/composer')\n\n"
+    module += '// compiled from {} by code/tools/bpmn_compiler.py\n'.format(source)
+    if any(task['multi'] for task in tasks):
+        module += '\n' + WINDOWED
+    module += '\n' + ''.join(notes) + 'module.exports = ' + js_call('composer.sequence', *steps) + '\n'
+    return module
+
+
+COMPILERS = {'aws': compile_asl, 'azure': compile_durable, 'ibm': compile_composer}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a BPMN model into the workflow of each provider')
+    parser.add_argument('model', help='BPMN file')
+    for provider, extension in MODELS.items():
+        parser.add_argument('--' + provider, metavar='FILE', action='append', default=[],
+                            help='write the {} workflow here, [{}]<model>{} next to the model by default'.format(
+                                provider, provider, extension))
+    parser.add_argument('--host', metavar='FILE', action='append', default=[],
+                        help='set functionTimeout in this host.json of an Azure function app')
+    args = parser.parse_args()
+
+    try:
+        tasks = read_tasks(args.model)
+    except (ValueError, ET.ParseError) as e:
+        sys.exit(str(e))
+    source = os.path.basename(args.model)
+    outputs = {provider: getattr(args, provider) for provider in MODELS}
+    if not any(outputs.values()):
+        # the orchestration models sit next to the BPMN model, named after it
+        stem = os.path.splitext(args.model)[0]
+        outputs = {provider: [os.path.join(os.path.dirname(stem), '[{}]{}{}'.format(
+            provider, os.path.basename(stem), extension))] for provider, extension in MODELS.items()}
+    for provider, paths in outputs.items():
+        if not paths:
+            continue
+        workflow = COMPILERS[provider](tasks, source)
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write(workflow)
+            print('{}: {}'.format(provider, path))
+    for path in args.host:
+        update_host(tasks, path)
+        print('host: {}'.format(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Parallel deployment plan of a TOSCA service template
+
+Derives the dependency DAG of the node templates from their requirements (a node
+is deployed after every node it requires) and groups the nodes into waves that
+can be created concurrently. With durations per node, the plan compares deploying
+one node after another with deploying every node as soon as its requirements are
+met, which is what xOpera does with more than one worker.
+
+    python deploy_plan.py ../../../definitions-tosca/servicetemplates/iaas.blueprints.aws/ETL-FunctionOrchestration/ServiceTemplate.tosca
+    python deploy_plan.py <csar>/ServiceTemplate.tosca --durations durations.json --deploy <csar>
+
+--deploy runs `opera deploy` with as many workers as nodes are deployed at the same time.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from collections import OrderedDict
+
+import yaml
+
+# seconds assumed for a node without a measured duration
+DEFAULT_DURATION = 30.0
+# command of the TOSCA orchestrator
+OPERA = 'opera'
+
+
+def load_topology(path):
+    """Read the node templates of a service template and the nodes each one requires
+    Parameters
+    ----------
+    path: string, required
+        ServiceTemplate.tosca file
+    Returns
+    -------
+    nodes: OrderedDict
+        Node template name to its type, display name and required node names
+    """
+
+    with open(path) as f:
+        template = yaml.safe_load(f)
+    node_templates = (template.get('topology_template') or {}).get('node_templates') or {}
+    nodes = OrderedDict()
+    for name, node in node_templates.items():
+        requires = []
+        for requirement in node.get('requirements') or []:
+            for target in requirement.values():
+                target = target.get('node') if isinstance(target, dict) else target
+                if target and target not in requires:
+                    requires.append(target)
+        nodes[name] = {
+            "type": node.get('type'),
+            "display_name": (node.get('metadata') or {}).get('displayName', name),
+            "requires": requires}
+    for name, node in nodes.items():
+        unknown = [target for target in node['requires'] if target not in nodes]
+        if unknown:
+            raise ValueError(f"{name} requires unknown nodes {', '.join(unknown)}")
+    return nodes
+
+
+def plan_waves(nodes):
+    """Group the nodes into waves whose nodes only require nodes of earlier waves
+    Parameters
+    ----------
+    nodes: dict, required
+        Output of load_topology()
+    Returns
+    -------
+    waves: list of lists
+        Node names by wave, the nodes of one wave are independent of each other
+    """
+
+    waves = []
+    done = set()
+    pending = list(nodes)
+    while pending:
+        wave = [name for name in pending if all(target in done for target in nodes[name]['requires'])]
+        if not wave:
+            raise ValueError(f"Dependency cycle between {', '.join(pending)}")
+        waves.append(wave)
+        done.update(wave)
+        pending = [name for name in pending if name not in done]
+    return waves
+
+
+def load_durations(path, nodes):
+    """Deploy durations of the nodes, by node template name or display name
+    Parameters
+    ----------
+    path: string, optional
+        JSON object of seconds per node, nodes not listed take DEFAULT_DURATION
+    nodes: dict, required
+        Output of load_topology()
+    Returns
+    -------
+    durations: dict
+        Seconds by node template name
+    """
+
+    measured = {}
+    if path:
+        with open(path) as f:
+            measured = json.load(f)
+    return {name: float(measured.get(name, measured.get(node['display_name'], DEFAULT_DURATION)))
+            for name, node in nodes.items()}
+
+
+def schedule(nodes, waves, durations):
+    """Finish times of the nodes when each one starts as soon as its requirements are deployed
+    Parameters
+    ----------
+    nodes: dict, required
+        Output of load_topology()
+    waves: list, required
+        Output of plan_waves()
+    durations: dict, required
+        Seconds by node template name
+    Returns
+    -------
+    finish: dict
+        Seconds from the start of the deployment to the end of each node
+    """
+
+    finish = {}
+    for wave in waves:
+        for name in wave:
+            finish[name] = max([finish[target] for target in nodes[name]['requires']], default=0.0) + durations[name]
+    return finish
+
+
+def critical_path(nodes, finish):
+    """Chain of nodes that determines the parallel deploy time
+    Parameters
+    ----------
+    nodes: dict, required
+        Output of load_topology()
+    finish: dict, required
+        Output of schedule()
+    Returns
+    -------
+    path: list
+        Node names from the first to the last deployed node
+    """
+
+    if not finish:
+        return []
+    name = max(finish, key=finish.get)
+    path = [name]
+    while nodes[name]['requires']:
+        name = max(nodes[name]['requires'], key=finish.get)
+        path.append(name)
+    return path[::-1]
+
+
+def peak_workers(finish, durations):
+    """Most nodes deployed at the same time when each one starts as soon as its requirements are deployed
+    Parameters
+    ----------
+    finish: dict, required
+        Output of schedule()
+    durations: dict, required
+        Seconds by node template name
+    Returns
+    -------
+    workers: int
+        Workers that never hold back a node whose requirements are deployed
+    """
+
+    # a node that ends when another one starts frees its worker first
+    events = sorted([(end, -1) for end in finish.values()] +
+                    [(end - durations[name], 1) for name, end in finish.items()])
+    workers = running = 0
+    for _, change in events:
+        running += change
+        workers = max(workers, running)
+    return max(workers, 1)
+
+
+def print_plan(nodes, waves, durations):
+    """Print the waves, the sequential and the parallel deploy time and the critical path"""
+
+    finish = schedule(nodes, waves, durations)
+    labels = {name: f"{name} ({node['display_name']})" if node['display_name'] != name else name
+              for name, node in nodes.items()}
+    column = max((len(label) for label in labels.values()), default=0)
+    type_column = max((len(str(node['type'])) for node in nodes.values()), default=0)
+    for i, wave in enumerate(waves):
+        print(f'wave {i + 1}:')
+        for name in wave:
+            print('  {}  {}  {:>7.1f}s'.format(
+                labels[name].ljust(column), str(nodes[name]['type']).ljust(type_column), durations[name]))
+    print()
+    print('sequential: {:.1f}s, parallel: {:.1f}s with {} workers'.format(
+        sum(durations.values()), max(finish.values(), default=0.0), peak_workers(finish, durations)))
+    print('critical path: ' + ' -> '.join(nodes[name]['display_name'] for name in critical_path(nodes, finish)))
+
+
+def deploy(csar, workers, inputs=None):
+    """Deploy with xOpera, which creates every node as soon as its requirements are deployed
+    Parameters
+    ----------
+    csar: string, required
+        Exported CSAR directory or service template
+    workers: int, required
+        Nodes deployed at the same time
+    inputs: string, optional
+        Inputs file of the deployment
+    Returns
+    -------
+    code: int
+        Exit code of opera
+    """
+
+    command = [OPERA, 'deploy', '--workers', str(workers)]
+    if inputs:
+        command += ['--inputs', inputs]
+    command.append(csar)
+    print(' '.join(command))
+    return subprocess.run(command).returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel deployment plan of a TOSCA service template')
+    parser.add_argument('template', help='ServiceTemplate.tosca file')
+    parser.add_argument('--durations', help='JSON object of deploy seconds per node template or display name')
+    parser.add_argument('--json', action='store_true', help='print the plan as JSON')
+    parser.add_argument('--deploy', metavar='CSAR', help='run opera deploy on this CSAR with the planned workers')
+    parser.add_argument('--inputs', help='inputs file passed to opera deploy')
+    args = parser.parse_args()
+
+    try:
+        nodes = load_topology(args.template)
+        waves = plan_waves(nodes)
+    except ValueError as e:
+        sys.exit(str(e))
+    durations = load_durations(args.durations, nodes)
+    finish = schedule(nodes, waves, durations)
+    workers = peak_workers(finish, durations)
+    if args.json:
+        print(json.dumps({
+            "waves": waves,
+            "sequential": sum(durations.values()),
+            "parallel": max(finish.values(), default=0.0),
+            "workers": workers,
+            "critical_path": critical_path(nodes, finish)}, indent=2))
+    else:
+        print_plan(nodes, waves, durations)
+    if args.deploy:
+        try:
+            sys.exit(deploy(args.deploy, workers, args.inputs))
+        except FileNotFoundError:
+            sys.exit(f'{OPERA} not found, install xOpera with pip install opera')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Gantt view and critical path of a traced run
+
+Reads the spans of the 'jsonl' exporter, or function logs of the 'log' exporter,
+and draws every invocation of a run with its phases on one time axis. The
+critical path follows the inputs of the invocation that ended last back to
+ListFiles: each invocation waits for its parent and its links (the mappers of a
+reducer, the reducers of CleanUp), and the one that ended last held it up.
+
+    python gantt.py /tmp/openaq-traces.jsonl
+    python gantt.py cloudwatch.log --trace <trace_id> --chrome run.json
+
+--chrome writes the spans as Chrome trace events, for chrome://tracing or Perfetto.
+"""
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+
+# characters of the time axis
+DEFAULT_WIDTH = 80
+# prefix of the spans in function logs
+LOG_MARKER = 'span {'
+
+
+def read_spans(paths):
+    """Read spans from JSON-lines files or function logs
+    Parameters
+    ----------
+    paths: list, required
+        Files with one span per line, other lines are skipped
+    Returns
+    -------
+    spans: list of dicts
+        Spans of all traces
+    """
+
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if LOG_MARKER in line:
+                    line = line[line.index(LOG_MARKER) + len(LOG_MARKER) - 1:]
+                if not line.startswith('{'):
+                    continue
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if 'span_id' in span and span.get('end') is not None:
+                    spans.append(span)
+    return spans
+
+
+def is_invocation(span):
+    """Whether the span covers a whole invocation rather than a phase of it"""
+
+    return span['name'] == span['function']
+
+
+def describe(span):
+    """Function and day of an invocation"""
+
+    return ' '.join(filter(None, [span['function'], span['attributes'].get('date')]))
+
+
+def critical_path(invocations):
+    """Follow the inputs of the invocation that ended last back to the start of the run
+    Parameters
+    ----------
+    invocations: dict, required
+        Invocation spans of one trace by span ID
+    Returns
+    -------
+    path: list of dicts
+        Invocation spans from the start of the run to its end
+    """
+
+    if not invocations:
+        return []
+    span = max(invocations.values(), key=lambda span: span['end'])
+    path = [span]
+    while True:
+        inputs = [invocations[span_id] for span_id in [span['parent_id']] + span['links'] if span_id in invocations]
+        if not inputs:
+            break
+        span = max(inputs, key=lambda span: span['end'])
+        if span in path:
+            break
+        path.append(span)
+    return path[::-1]
+
+
+def draw(spans, width=DEFAULT_WIDTH):
+    """Print the invocations and their phases of one trace on a common time axis
+    Parameters
+    ----------
+    spans: list, required
+        Spans of one trace
+    width: int, optional
+        Characters of the time axis
+    """
+
+    start = min(span['start'] for span in spans)
+    end = max(span['end'] for span in spans)
+    scale = width / max(end - start, 1e-6)
+    invocations = {span['span_id']: span for span in spans if is_invocation(span)}
+    phases = defaultdict(list)
+    for span in spans:
+        if not is_invocation(span):
+            phases[span['parent_id']].append(span)
+    critical = {span['span_id'] for span in critical_path(invocations)}
+
+    def bar(span, fill):
+        left = int((span['start'] - start) * scale)
+        right = max(int((span['end'] - start) * scale), left + 1)
+        return ' ' * left + fill * (right - left)
+
+    labels = []
+    for span in sorted(invocations.values(), key=lambda span: span['start']):
+        labels.append((('*' if span['span_id'] in critical else ' ') + describe(span), span, '#'))
+        for phase in sorted(phases[span['span_id']], key=lambda phase: phase['start']):
+            labels.append(('    ' + phase['name'], phase, '='))
+    column = max(len(label) for label, _, _ in labels)
+    print(f"trace {spans[0]['trace_id']}, {end - start:.1f}s, * marks the critical path")
+    for label, span, fill in labels:
+        print('{}  {:>8.2f}s |{}'.format(label.ljust(column), span['end'] - span['start'], bar(span, fill).ljust(width)))
+
+
+def print_critical_path(spans):
+    """Print where the time of the critical path goes
+    Parameters
+    ----------
+    spans: list, required
+        Spans of one trace
+    """
+
+    invocations = {span['span_id']: span for span in spans if is_invocation(span)}
+    phases = defaultdict(list)
+    for span in spans:
+        if not is_invocation(span):
+            phases[span['parent_id']].append(span)
+    previous = None
+    print('critical path:')
+    for span in critical_path(invocations):
+        # the gap to the input is spent in the orchestrator and in cold starts
+        wait = span['start'] - previous['end'] if previous else 0.0
+        longest = max(phases[span['span_id']], key=lambda phase: phase['end'] - phase['start'], default=None)
+        detail = ', longest phase {} {:.2f}s'.format(
+            longest['name'], longest['end'] - longest['start']) if longest else ''
+        print('  {}: waited {:.2f}s, ran {:.2f}s{}'.format(describe(span), wait, span['end'] - span['start'], detail))
+        previous = span
+
+
+def write_chrome_trace(spans, path):
+    """Write spans as Chrome trace events, one row per invocation
+    Parameters
+    ----------
+    spans: list, required
+        Spans of one trace
+    path: string, required
+        Output JSON file
+    """
+
+    rows = {span['span_id']: i for i, span in enumerate(sorted(
+        (span for span in spans if is_invocation(span)), key=lambda span: span['start']))}
+    events = [{
+        "name": span['name'],
+        "cat": span['function'],
+        "ph": "X",
+        "ts": span['start'] * 1e6,
+        "dur": (span['end'] - span['start']) * 1e6,
+        "pid": span['function'],
+        "tid": rows.get(span['span_id'], rows.get(span['parent_id'], 0)),
+        "args": dict(span['attributes'], span_id=span['span_id'], links=span['links'])}
+        for span in spans]
+    with open(path, 'w') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Gantt view and critical path of a traced run')
+    parser.add_argument('files', nargs='+', help='JSON-lines span files or function logs')
+    parser.add_argument('--trace', help='trace ID, the latest run by default')
+    parser.add_argument('--width', default=DEFAULT_WIDTH, type=int, help='characters of the time axis')
+    parser.add_argument('--chrome', help='also write Chrome trace events to this file')
+    args = parser.parse_args()
+
+    spans = read_spans(args.files)
+    if not spans:
+        sys.exit('No spans found')
+    trace_id = args.trace or max(spans, key=lambda span: span['start'])['trace_id']
+    spans = [span for span in spans if span['trace_id'] == trace_id]
+    if not spans:
+        sys.exit(f'No spans of trace {trace_id}')
+    draw(spans, args.width)
+    print()
+    print_critical_path(spans)
+    if args.chrome:
+        write_chrome_trace(spans, args.chrome)
+
+
+if __name__ == "__main__":
+    main()
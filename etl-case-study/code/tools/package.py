@@ -0,0 +1,194 @@
+"""Deployment packages of the functions
+
+Builds the zip files the service templates deploy from the sources below code/.
+AWS Lambda and IBM Cloud Functions load the handler and the shared modules it
+imports (storage.py, tracing.py, and planning.py for ListFiles) from the root of
+the zip. Azure Functions load them from the root of the function app, which the
+AzureFunctionApp node unpacks from the dependencies zip, so the shared modules
+are packaged there next to requirements.txt.
+
+Entries get a fixed timestamp, so rebuilding unchanged sources gives identical
+zips and only real changes show up in the history.
+
+    python package.py
+    python package.py --check
+
+--check rebuilds nothing and exits with an error if a zip does not match its
+sources, e.g. after a change to a handler without rebuilding.
+"""
+
+import argparse
+import os
+import sys
+import zipfile
+
+# code/ folder with the sources of the functions
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# folder of the service templates the zips are deployed from
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(CODE)), 'definitions-tosca', 'servicetemplates')
+# modules every function that accesses storage imports
+SHARED = [('shared/storage.py', 'storage.py'), ('shared/tracing.py', 'tracing.py')]
+# chunk planning ListFiles imports
+PLANNING = [('shared/planning.py', 'planning.py')]
+# timestamp of every entry, the earliest a zip can store
+ENTRY_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def handler(folder):
+    """Sources of a function whose handler is __main__.py"""
+    return [('{}/__main__.py'.format(folder), '__main__.py')] + SHARED
+
+
+def azure_function(folder):
+    """Sources of an Azure function, unpacked into a folder of its app"""
+    return [('{}/function.json'.format(folder), 'function.json'), ('{}/__init__.py'.format(folder), '__init__.py')]
+
+
+# zip below the service templates and its entries as (source below code/, name in the zip)
+PACKAGES = {
+    'iaas.blueprints.aws/ETL-FunctionOrchestration/files/AwsLambdaFunction_0/ListFiles/ListFiles.zip':
+        handler('aws/1. list-files') + PLANNING,
+    'iaas.blueprints.aws/ETL-FunctionOrchestration/files/AwsLambdaFunction_1/TransformData/TransformData.zip':
+        handler('aws/2. transform'),
+    'iaas.blueprints.aws/ETL-FunctionOrchestration/files/AwsLambdaFunction_2/AggregateData/AggregateData.zip':
+        handler('aws/3. reduce'),
+    'iaas.blueprints.aws/ETL-FunctionOrchestration/files/AwsLambdaFunction_3/CleanUp/CleanUp.zip':
+        handler('aws/4. cleanup'),
+    'iaas.blueprints.aws/ETL-FunctionOrchestration/files/AwsLambdaFunction_4/Notify/Notify.zip':
+        [('aws/5. notify/__main__.py', '__main__.py')],
+    'iaas.blueprints.ibm/ETL-FunctionOrchestration/files/IbmCloudFunction_0/ListFiles/ListFiles.zip':
+        handler('ibm/1. list-files') + PLANNING,
+    'iaas.blueprints.ibm/ETL-FunctionOrchestration/files/IbmCloudFunction_1/TransformData/TransformData.zip':
+        handler('ibm/2. transform'),
+    'iaas.blueprints.ibm/ETL-FunctionOrchestration/files/IbmCloudFunction_2/AggregateData/AggregateData.zip':
+        handler('ibm/3. reduce'),
+    'iaas.blueprints.ibm/ETL-FunctionOrchestration/files/IbmCloudFunction_3/CleanUp/CleanUp.zip':
+        handler('ibm/4. cleanup'),
+    'iaas.blueprints.ibm/ETL-FunctionOrchestration/files/IbmCloudFunction_4/Notify/Notify.zip':
+        [('ibm/5. notify/__main__.py', '__main__.py')],
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureActivityFunction_0/code/ListFiles.zip':
+        azure_function('azure/ETL-app/ListFiles'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureActivityFunction_1/code/TransformData.zip':
+        azure_function('azure/ETL-app/TransformData'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureActivityFunction_2/code/AggregateData.zip':
+        azure_function('azure/ETL-app/AggregateData'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureActivityFunction_3/code/CleanUp.zip':
+        azure_function('azure/ETL-app/CleanUp'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureClientFunction_0/code/MainOrchestratorStarter.zip':
+        azure_function('azure/ETL-app/ClientFunction'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureOrchestratingFunction_0/code/MainOrchestrator.zip':
+        azure_function('azure/ETL-app/MainOrchestrator'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureFunction_0/code/Notify.zip':
+        azure_function('azure/Notify-app/Notify'),
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureFunctionApp_0/dep/dep.zip':
+        [('azure/ETL-app/requirements.txt', 'requirements.txt')] + SHARED + PLANNING,
+    'iaas.blueprints.azure/ETL-FunctionOrchestration/files/AzureFunctionApp_1/dep/dep.zip':
+        [('azure/Notify-app/requirements.txt', 'requirements.txt')],
+}
+
+
+def read_sources(entries):
+    """Read the files of a package
+    Parameters
+    ----------
+    entries: list, required
+        Source below code/ and name in the zip of each file
+    Returns
+    -------
+    files: dict
+        Content by name in the zip
+    """
+
+    files = {}
+    for source, name in entries:
+        with open(os.path.join(CODE, source), 'rb') as f:
+            files[name] = f.read()
+    return files
+
+
+def read_package(path):
+    """Read the files of a built package
+    Parameters
+    ----------
+    path: string, required
+        Zip file
+    Returns
+    -------
+    files: dict
+        Content by name in the zip, None if the zip does not exist
+    """
+
+    if not os.path.exists(path):
+        return None
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def write_package(path, files):
+    """Write the files of a package as a reproducible zip
+    Parameters
+    ----------
+    path: string, required
+        Zip file
+    files: dict, required
+        Content by name in the zip
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name in sorted(files):
+            entry = zipfile.ZipInfo(name, date_time=ENTRY_TIME)
+            entry.compress_type = zipfile.ZIP_DEFLATED
+            entry.external_attr = 0o644 << 16
+            archive.writestr(entry, files[name])
+
+
+def find_stale(templates=TEMPLATES):
+    """Find the packages that do not match their sources
+    Parameters
+    ----------
+    templates: string, optional
+        Folder of the service templates
+    Returns
+    -------
+    stale: list
+        Zip files below the service templates to rebuild
+    """
+
+    return [package for package, entries in PACKAGES.items()
+            if read_package(os.path.join(templates, package)) != read_sources(entries)]
+
+
+def build(templates=TEMPLATES):
+    """Rebuild the packages that do not match their sources
+    Parameters
+    ----------
+    templates: string, optional
+        Folder of the service templates
+    Returns
+    -------
+    built: list
+        Zip files below the service templates that were rebuilt
+    """
+
+    built = find_stale(templates)
+    for package in built:
+        write_package(os.path.join(templates, package), read_sources(PACKAGES[package]))
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deployment packages of the functions')
+    parser.add_argument('--templates', default=TEMPLATES, help='folder of the service templates')
+    parser.add_argument('--check', action='store_true', help='only report packages that do not match their sources')
+    args = parser.parse_args()
+
+    packages = find_stale(args.templates) if args.check else build(args.templates)
+    for package in packages:
+        print(('stale ' if args.check else 'built ') + package)
+    if args.check and packages:
+        sys.exit('{} packages do not match their sources, run python package.py'.format(len(packages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+"""Offline makespan and cost simulator of the ETL function orchestration
+
+Replays ListFiles -> Map(TransformData) -> AggregateData -> CleanUp for a file inventory
+with the scheduling of each provider, and sweeps chunk size, concurrency, mapper memory,
+reducer layout and fan-in to pick a configuration before deploying.
+
+    python simulator.py inventory.json --provider aws --chunk-size 0,6,12 --concurrency 10,40 --memory 1024,2048
+
+Chunk size 0 plans the chunks like ListFiles does from telemetry: chunks that take a
+mapper TARGET_MAPPER_SECONDS, spread over full waves, with the planning and the fit
+ListFiles imports from shared/planning.py. With more mapper results than the fan-in (perf:fanIn of the BPMN
+model), a combine level of AggregateData merges them in groups before the reducers of
+the days run, as the compiled workflows do.
+
+The inventory is the output of get_file_inventory() or Storage.list() as JSON: a list of
+objects with 'key' and 'size', or such lists by day. Stage models default to the constants
+below and are replaced by a JSON file (--model) or fitted from the telemetry the reducers
+write below openaq/telemetry/ (--telemetry, a local copy of the folder).
+"""
+
+import argparse
+import glob
+import heapq
+import itertools
+import json
+import math
+import os
+import sys
+from collections import OrderedDict
+
+# folder of the shared modules, the chunk planning of ListFiles is imported from there
+SHARED = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'shared')
+
+# stage models, durations are overhead plus a cost per unit of work
+DEFAULT_MODEL = {
+    # ListFiles lists the day and plans the chunks
+    "list_files": {"overhead": 0.5, "seconds_per_file": 0.002, "memory": 128},
+    # TransformData by measured memory size (MB), seconds per byte of gzipped input
+    "transform": {"1024": {"overhead": 1.5, "seconds_per_byte": 4e-7}},
+    # rows of the intermediate results per byte of input
+    "rows_per_byte": 0.01,
+    # AggregateData by intermediate layout, each chunk adds one download and parse
+    "aggregate": {
+        "wide": {"overhead": 2.0, "seconds_per_row": 1e-5, "seconds_per_chunk": 0.2, "memory": 512},
+        "long": {"overhead": 2.0, "seconds_per_row": 1.5e-5, "seconds_per_chunk": 0.15, "memory": 512}},
+    # CleanUp deletes the intermediate results in batches
+    "cleanup": {"overhead": 0.3, "seconds_per_file": 0.001, "memory": 128},
+}
+
+# scheduling and billing of each provider, see the orchestration models
+PROVIDERS = {
+    # Step Functions Map keeps MaxConcurrency iterations running, a finished one frees its slot
+    'aws': {"scheduling": "window", "honors_concurrency": True, "step_overhead": 0.05,
+            "memory_scales_cpu": True, "billing_seconds": 0.001, "min_billed_seconds": 0.001,
+            "memory_granularity": 1, "bill_cold_starts": False, "orchestrator_memory": 0,
+            "cold_start": {"ListFiles": 0.4, "TransformData": 3.5, "AggregateData": 3.0, "CleanUp": 0.4},
+            "timeout": {"ListFiles": 300, "TransformData": 600, "AggregateData": 300, "CleanUp": 300}},
+    # Durable Functions wait for a whole wave of task_all before the next one starts
+    'azure': {"scheduling": "waves", "honors_concurrency": True, "step_overhead": 0.3,
+              "memory_scales_cpu": False, "billing_seconds": 0.001, "min_billed_seconds": 0.1,
+              "memory_granularity": 128, "bill_cold_starts": True, "orchestrator_memory": 0,
+              "cold_start": {"ListFiles": 1.5, "TransformData": 6.0, "AggregateData": 5.0, "CleanUp": 1.5},
+              "timeout": {"ListFiles": 300, "TransformData": 300, "AggregateData": 300, "CleanUp": 300}},
+    # the compiled composition runs max_concurrency items with composer.map, then the next batch
+    'ibm': {"scheduling": "waves", "honors_concurrency": True, "step_overhead": 0.15,
+            "memory_scales_cpu": True, "billing_seconds": 0.1, "min_billed_seconds": 0.1,
+            "memory_granularity": 1, "bill_cold_starts": True, "orchestrator_memory": 512,
+            "cold_start": {"ListFiles": 0.5, "TransformData": 3.0, "AggregateData": 2.5, "CleanUp": 0.5},
+            "timeout": {"ListFiles": 60, "TransformData": 900, "AggregateData": 900, "CleanUp": 60}},
+}
+# concurrent actions of an IBM namespace, the limit of a provider that ignores max_concurrency
+IBM_NAMESPACE_LIMIT = 1000
+# perf:fanIn of AggregateData in the BPMN model, 0 to simulate without a combine level
+FAN_IN = 16
+# second path segment of the OpenAQ keys is the day: realtime-gzipped/<date>/<file>
+DAY_SEGMENT = 1
+
+
+def load_inventory(path):
+    """Read a file inventory and group it by day
+    Parameters
+    ----------
+    path: string, required
+        JSON file with objects ('key', 'size'), a list of such lists or a dict of them by day
+    Returns
+    -------
+    inventory: OrderedDict
+        Sizes of the files by day, sorted by day
+    """
+
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        objects = [item for items in data.values() for item in items]
+    else:
+        objects = [item for entry in data for item in (entry if isinstance(entry, list) else [entry])]
+    inventory = OrderedDict()
+    for item in sorted(objects, key=lambda item: item['key']):
+        day = item['key'].split('/')[DAY_SEGMENT]
+        inventory.setdefault(day, []).append(int(item.get('size', item.get('Size', 0))))
+    return inventory
+
+
+def load_model(path=None, telemetry=None):
+    """Stage models from the defaults, a JSON file and reducer telemetry, later ones win
+    Parameters
+    ----------
+    path: string, optional
+        JSON file with any of the keys of DEFAULT_MODEL
+    telemetry: string, optional
+        Folder with the telemetry objects of earlier runs
+    Returns
+    -------
+    model: dict
+        Stage models
+    """
+
+    model = json.loads(json.dumps(DEFAULT_MODEL))
+    if path:
+        with open(path) as f:
+            model.update(json.load(f))
+    if telemetry:
+        chunks = []
+        for name in sorted(glob.glob(os.path.join(telemetry, '*.json'))):
+            with open(name) as f:
+                chunks.extend(json.load(f)['chunks'])
+        transform, rows_per_byte = fit_transform_model(chunks)
+        model['transform'].update(transform)
+        if rows_per_byte:
+            model['rows_per_byte'] = rows_per_byte
+    return model
+
+
+def load_planning():
+    """Import the chunk planning of ListFiles
+    Returns
+    -------
+    planning: module
+        Shared module with estimate_mapper_model(), plan_chunks() and fixed_chunks()
+    """
+
+    if SHARED not in sys.path:
+        sys.path.insert(0, SHARED)
+    import planning
+    return planning
+
+
+def fit_transform_model(chunks):
+    """Fit the mapper duration for each measured memory size with the fit of ListFiles
+    Parameters
+    ----------
+    chunks: list, required
+        Bytes, rows, duration and memory of the chunks of earlier runs
+    Returns
+    -------
+    transform: dict
+        Overhead and seconds per byte by memory size (MB)
+    rows_per_byte: float
+        Intermediate rows per input byte, None without telemetry
+    """
+
+    estimate_mapper_model = load_planning().estimate_mapper_model
+    transform = {}
+    for memory in sorted({chunk['memory'] for chunk in chunks}):
+        fit = estimate_mapper_model([chunk for chunk in chunks if chunk['memory'] == memory])
+        if fit is not None:
+            transform[str(memory)] = {"overhead": fit[0], "seconds_per_byte": fit[1]}
+    total_bytes = sum(chunk['bytes'] for chunk in chunks)
+    rows_per_byte = sum(chunk['rows'] for chunk in chunks) / total_bytes if total_bytes else None
+    return transform, rows_per_byte
+
+
+def transform_duration(model, memory, size, memory_scales_cpu=True):
+    """Duration of a mapper from the model of the nearest measured memory size
+    Parameters
+    ----------
+    model: dict, required
+        Stage models
+    memory: int, required
+        Memory size of the mapper (MB)
+    size: int, required
+        Bytes of the chunk
+    memory_scales_cpu: bool, optional
+        Whether the CPU share of the provider grows with the memory size
+    Returns
+    -------
+    duration: float
+        Seconds, without a cold start
+    """
+
+    measured = min(model['transform'], key=lambda key: abs(int(key) - memory))
+    stage = model['transform'][measured]
+    seconds_per_byte = stage['seconds_per_byte']
+    if memory_scales_cpu:
+        # CPU is allotted in proportion to memory, the fixed overhead is mostly I/O and stays
+        seconds_per_byte *= int(measured) / memory
+    return stage['overhead'] + size * seconds_per_byte
+
+
+def chunk_inventory(inventory, chunk_size, mapper_model=None, concurrency=None):
+    """Split the files of each day into chunks with the planning of ListFiles
+    Parameters
+    ----------
+    inventory: dict, required
+        Sizes of the files by day
+    chunk_size: int, required
+        Files per chunk, 0 to size the chunks from the mapper model
+    mapper_model: tuple, optional
+        Overhead in seconds and seconds per byte of a mapper, required for chunk size 0
+    concurrency: int, optional
+        Mappers running at the same time, required for chunk size 0
+    Returns
+    -------
+    chunks: list of tuples
+        Day, bytes and file count of each chunk
+    """
+
+    planning = load_planning()
+    days = list(inventory)
+    # file names only tell the chunks apart, their sizes drive the planning
+    inventories = [[{'key': '{}/{}'.format(day, i), 'size': size} for i, size in enumerate(inventory[day])]
+                   for day in days]
+    sizes = {item['key']: item['size'] for objects in inventories for item in objects}
+    if chunk_size:
+        planned = planning.fixed_chunks(days, inventories, chunk_size)
+    else:
+        planned = planning.plan_chunks(days, inventories, mapper_model, concurrency)
+    return [(day, sum(sizes[name] for name in files), len(files)) for day, files in planned]
+
+
+def mapper_model(model, memory, memory_scales_cpu=True):
+    """Mapper model ListFiles would fit from telemetry of the memory size
+    Parameters
+    ----------
+    model: dict, required
+        Stage models
+    memory: int, required
+        Memory size of the mapper (MB)
+    memory_scales_cpu: bool, optional
+        Whether the CPU share of the provider grows with the memory size
+    Returns
+    -------
+    mapper_model: tuple
+        Overhead in seconds and seconds per byte
+    """
+
+    overhead = transform_duration(model, memory, 0, memory_scales_cpu)
+    return overhead, transform_duration(model, memory, 1, memory_scales_cpu) - overhead
+
+
+def combine_groups(chunks, fan_in):
+    """Groups of mapper results the combine level of the reducers merges
+    Parameters
+    ----------
+    chunks: list, required
+        Day, bytes and file count of each chunk, in the order of the mapper results
+    fan_in: int, required
+        Most results per instance, 0 for no combine level
+    Returns
+    -------
+    groups: list
+        Chunks of each combining instance, empty if the reducers read the mapper results
+    """
+
+    if not fan_in or len(chunks) <= fan_in:
+        return []
+    return [chunks[i:i + fan_in] for i in range(0, len(chunks), fan_in)]
+
+
+def aggregate_duration(stage, rows, files):
+    """Duration of an AggregateData instance
+    Parameters
+    ----------
+    stage: dict, required
+        Aggregate model of the intermediate layout
+    rows: float, required
+        Rows of the intermediate results it reads
+    files: int, required
+        Intermediate files it downloads
+    Returns
+    -------
+    duration: float
+        Seconds, without a cold start
+    """
+
+    return stage['overhead'] + rows * stage['seconds_per_row'] + files * stage['seconds_per_chunk']
+
+
+class Function:
+    """Containers of one function, a new container pays the cold start"""
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.cold_start = settings['cold_start'][name]
+        self.timeout = settings['timeout'][name]
+        self.bill_cold_starts = settings['bill_cold_starts']
+        # times at which the warm containers are idle again
+        self.idle = []
+        self.cold_starts = 0
+        self.billed = []
+        self.timeouts = 0
+
+    def invoke(self, start, duration):
+        """Run one invocation on a warm container if one is idle
+        Parameters
+        ----------
+        start: float, required
+            Time the orchestrator starts the invocation
+        duration: float, required
+            Handler duration in seconds
+        Returns
+        -------
+        end: float
+            Time the invocation returns
+        """
+
+        if self.idle and self.idle[0] <= start:
+            heapq.heappop(self.idle)
+            billed = duration
+        else:
+            self.cold_starts += 1
+            duration += self.cold_start
+            billed = duration if self.bill_cold_starts else duration - self.cold_start
+        if duration > self.timeout:
+            self.timeouts += 1
+        end = start + duration
+        heapq.heappush(self.idle, end)
+        self.billed.append(billed)
+        return end
+
+
+def run_map(function, durations, start, limit, scheduling):
+    """Fan out invocations with the concurrency and barrier semantics of a provider
+    Parameters
+    ----------
+    function: Function, required
+        Function that runs the items
+    durations: list, required
+        Handler duration of each item
+    start: float, required
+        Time the fan-out starts
+    limit: int, required
+        Items running at the same time
+    scheduling: string, required
+        'window' starts an item as soon as a slot frees, 'waves' waits for the whole batch
+    Returns
+    -------
+    end: float
+        Time the last item returns
+    """
+
+    end = start
+    if scheduling == 'waves':
+        for i in range(0, len(durations), limit):
+            end = max([end] + [function.invoke(end, duration) for duration in durations[i:i + limit]])
+        return end
+    running = []
+    for duration in durations:
+        at = heapq.heappop(running) if len(running) >= limit else start
+        heapq.heappush(running, function.invoke(at, duration))
+    return max(running, default=end)
+
+
+def billed_gb_seconds(settings, memory, durations):
+    """GB-seconds billed for invocations of one memory size
+    Parameters
+    ----------
+    settings: dict, required
+        Billing settings of the provider
+    memory: int, required
+        Memory size (MB)
+    durations: list, required
+        Billed durations in seconds
+    Returns
+    -------
+    gb_seconds: float
+        Memory in GB times billed seconds
+    """
+
+    granularity = settings['memory_granularity']
+    memory = math.ceil(memory / granularity) * granularity
+    step = settings['billing_seconds']
+    seconds = sum(max(math.ceil(duration / step - 1e-9) * step, settings['min_billed_seconds']) for duration in durations)
+    return memory / 1024 * seconds
+
+
+def simulate(provider, inventory, model, chunk_size, concurrency, memory, layout, fan_in=FAN_IN):
+    """Simulate one run of the orchestration
+    Parameters
+    ----------
+    provider: string, required
+        'aws', 'azure' or 'ibm'
+    inventory: dict, required
+        Sizes of the files by day
+    model: dict, required
+        Stage models
+    chunk_size: int, required
+        Files per chunk, 0 to size the chunks like ListFiles does from telemetry
+    concurrency: int, required
+        max_concurrency of the run
+    memory: int, required
+        Memory size of TransformData (MB)
+    layout: string, required
+        Intermediate layout, a key of the aggregate models
+    fan_in: int, optional
+        Most mapper results per AggregateData, 0 for no combine level
+    Returns
+    -------
+    result: dict
+        Configuration, predicted makespan, GB-seconds, cold starts and timeouts
+    """
+
+    settings = PROVIDERS[provider]
+    limit = concurrency if settings['honors_concurrency'] else IBM_NAMESPACE_LIMIT
+    functions = {name: Function(name, settings) for name in settings['cold_start']}
+    chunks = chunk_inventory(inventory, chunk_size, mapper_model(model, memory, settings['memory_scales_cpu']), limit)
+    files = sum(len(sizes) for sizes in inventory.values())
+    steps = 0
+
+    stage = model['list_files']
+    t = functions['ListFiles'].invoke(0.0, stage['overhead'] + files * stage['seconds_per_file'])
+    steps += 1
+
+    t += settings['step_overhead']
+    durations = [transform_duration(model, memory, size, settings['memory_scales_cpu']) for _, size, _ in chunks]
+    t = run_map(functions['TransformData'], durations, t, limit, settings['scheduling'])
+    map_end = t
+    steps += 1
+
+    # many mapper results are first merged in groups, each group into one file per day
+    stage = model['aggregate'][layout]
+    groups = combine_groups(chunks, fan_in)
+    if groups:
+        durations = [aggregate_duration(stage, sum(size for _, size, _ in group) * model['rows_per_byte'], len(group))
+                     for group in groups]
+        t += settings['step_overhead']
+        t = run_map(functions['AggregateData'], durations, t, limit, settings['scheduling'])
+        steps += 1
+
+    # one reducer per day, each waits for all mappers of the run
+    durations = []
+    for day, sizes in inventory.items():
+        if groups:
+            files = sum(1 for group in groups if any(chunk[0] == day for chunk in group))
+        else:
+            files = sum(1 for chunk in chunks if chunk[0] == day)
+        durations.append(aggregate_duration(stage, sum(sizes) * model['rows_per_byte'], files))
+    t += settings['step_overhead']
+    t = run_map(functions['AggregateData'], durations, t, limit, settings['scheduling'])
+    steps += 1
+
+    stage = model['cleanup']
+    t += settings['step_overhead']
+    t = functions['CleanUp'].invoke(t, stage['overhead'] + len(chunks) * stage['seconds_per_file'])
+    steps += 1
+
+    memory_sizes = {"ListFiles": model['list_files']['memory'], "TransformData": memory,
+                    "AggregateData": model['aggregate'][layout]['memory'], "CleanUp": model['cleanup']['memory']}
+    gb_seconds = sum(billed_gb_seconds(settings, memory_sizes[name], function.billed)
+                     for name, function in functions.items())
+    # the IBM conductor action runs between the steps of the composition
+    gb_seconds += billed_gb_seconds(settings, settings['orchestrator_memory'], [settings['step_overhead']] * steps)
+    return {
+        "provider": provider,
+        "chunk_size": chunk_size,
+        "concurrency": concurrency,
+        "memory": memory,
+        "layout": layout,
+        "fan_in": fan_in,
+        "chunks": len(chunks),
+        "combiners": len(groups),
+        "map_seconds": round(map_end, 1),
+        "makespan": round(t, 1),
+        "gb_seconds": round(gb_seconds, 1),
+        "cold_starts": sum(function.cold_starts for function in functions.values()),
+        "timeouts": sum(function.timeouts for function in functions.values())}
+
+
+def sweep(providers, inventory, model, chunk_sizes, concurrencies, memories, layouts, fan_ins=(FAN_IN,)):
+    """Simulate every combination of the parameters
+    Parameters
+    ----------
+    providers, chunk_sizes, concurrencies, memories, layouts, fan_ins: list, required
+        Values of each parameter
+    inventory: dict, required
+        Sizes of the files by day
+    model: dict, required
+        Stage models
+    Returns
+    -------
+    results: list of dicts
+        Results of simulate(), fastest first, runs with timeouts last
+    """
+
+    results = []
+    for provider in providers:
+        # a provider that ignores max_concurrency is only simulated at its own limit
+        limits = concurrencies if PROVIDERS[provider]['honors_concurrency'] else [IBM_NAMESPACE_LIMIT]
+        results.extend(simulate(provider, inventory, model, chunk_size, concurrency, memory, layout, fan_in)
+                       for chunk_size, concurrency, memory, layout, fan_in
+                       in itertools.product(chunk_sizes, limits, memories, layouts, fan_ins))
+    results.sort(key=lambda result: (result['timeouts'] > 0, result['makespan'], result['gb_seconds']))
+    # a run is worth considering if no other run is both faster and cheaper
+    for result in results:
+        result['pareto'] = not result['timeouts'] and not any(
+            other is not result and not other['timeouts']
+            and other['makespan'] <= result['makespan'] and other['gb_seconds'] <= result['gb_seconds']
+            and (other['makespan'], other['gb_seconds']) != (result['makespan'], result['gb_seconds'])
+            for other in results)
+    return results
+
+
+def print_table(results):
+    columns = ['provider', 'chunk_size', 'concurrency', 'memory', 'layout', 'fan_in', 'chunks', 'combiners',
+               'map_seconds', 'makespan', 'gb_seconds', 'cold_starts', 'timeouts', 'pareto']
+    rows = [[str(result[column] if column != 'pareto' else '*' if result['pareto'] else '') for column in columns]
+            for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict makespan and GB-seconds of the ETL orchestration')
+    parser.add_argument('inventory', help='JSON file inventory with key and size of each object')
+    parser.add_argument('--provider', default='aws', help='comma-separated providers: aws, azure, ibm')
+    parser.add_argument('--chunk-size', default='0,6,12,24', type=parse_ints,
+                        help='files per chunk, 0 sizes the chunks from the mapper model like ListFiles')
+    parser.add_argument('--concurrency', default='10,40', type=parse_ints, help='max_concurrency of the run')
+    parser.add_argument('--memory', default='1024', type=parse_ints, help='TransformData memory sizes (MB)')
+    parser.add_argument('--layout', default=None, help='intermediate layouts, all modelled layouts by default')
+    parser.add_argument('--fan-in', default=str(FAN_IN), type=parse_ints,
+                        help='most mapper results per AggregateData, 0 for no combine level')
+    parser.add_argument('--model', help='JSON file with stage models')
+    parser.add_argument('--telemetry', help='local copy of openaq/telemetry/ to fit the TransformData model')
+    parser.add_argument('--top', default=20, type=int, help='rows to print, 0 for all')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per run')
+    args = parser.parse_args()
+
+    providers = [provider.strip() for provider in args.provider.split(',') if provider.strip()]
+    unknown = [provider for provider in providers if provider not in PROVIDERS]
+    if unknown:
+        sys.exit(f"Unknown provider: {', '.join(unknown)}")
+    inventory = load_inventory(args.inventory)
+    if not inventory:
+        sys.exit('Empty inventory')
+    model = load_model(args.model, args.telemetry)
+    layouts = args.layout.split(',') if args.layout else list(model['aggregate'])
+    results = sweep(providers, inventory, model, args.chunk_size, args.concurrency, args.memory, layouts,
+                    args.fan_in)
+    if args.top:
+        results = results[:args.top]
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Memory and timeout sizing of the functions of a service template
+
+Profiles of earlier runs give the duration and peak memory of every function at
+the memory sizes it ran with: invocation spans of the tracing exporters (function
+logs or JSON lines), benchmark records, or the telemetry of the reducers. For each
+function the tool picks the measured memory size that is fastest (--objective
+latency) or cheapest in GB-seconds (--objective cost) while the peak memory keeps
+its headroom, and a timeout from the slowest observed invocation.
+
+    python sizing.py /tmp/openaq-traces.jsonl --template ServiceTemplate.tosca --objective cost
+    python sizing.py bench.json --template ServiceTemplate.tosca --workflow ETL.asl --write
+
+Benchmark records are JSON objects (a list or one per line) with 'function',
+'memory' (MB), 'duration' (seconds) and optionally 'peak_memory' (MB). --write
+updates the memory and timeout properties of the function node templates and the
+task timeouts of the workflows: TimeoutSeconds in ASL, the limits of composer
+actions, and functionTimeout in the host.json of a function app.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import re
+import sys
+from collections import defaultdict
+
+import yaml
+
+from gantt import read_spans, is_invocation
+
+# share of the memory size kept free above the peak memory
+MEMORY_HEADROOM = 0.2
+# timeout as a multiple of the slowest observed invocation
+TIMEOUT_FACTOR = 2.0
+# shortest timeout in seconds, cold starts and retries of slow I/O need some slack
+MIN_TIMEOUT = 30
+# sizes within this share of the best are considered equal, the other objective decides
+TOLERANCE = 0.05
+# percentile of the durations that stands for the latency of a size
+LATENCY_PERCENTILE = 95
+
+# memory and timeout limits of the function services and the units of their properties
+PROVIDERS = {
+    'aws': {"memory": (128, 10240), "max_timeout": 900, "timeout_unit": 1},
+    'ibm': {"memory": (128, 2048), "max_timeout": 900, "timeout_unit": 1000},
+    # the consumption plan gives every function the same memory, the timeout applies to the whole app
+    'azure': {"memory": None, "max_timeout": 600, "timeout_unit": None},
+}
+
+
+def read_profiles(paths, telemetry=None):
+    """Read duration and memory of function invocations
+    Parameters
+    ----------
+    paths: list, required
+        Span files, function logs or benchmark records
+    telemetry: string, optional
+        Local copy of openaq/telemetry/, adds the TransformData chunks without peak memory
+    Returns
+    -------
+    profiles: list of dicts
+        Function, memory (MB), duration (seconds) and peak memory (MB or None) of each invocation
+    """
+
+    profiles = []
+    for span in read_spans(paths):
+        attributes = span['attributes']
+        # a failed invocation stops early, its duration does not tell how long the work takes
+        if is_invocation(span) and attributes.get('memory') and not attributes.get('error'):
+            profiles.append({
+                "function": span['function'],
+                "memory": int(attributes['memory']),
+                "duration": span['end'] - span['start'],
+                "peak_memory": attributes.get('peak_memory')})
+    for path in paths:
+        with open(path) as f:
+            text = f.read()
+        try:
+            records = json.loads(text)
+            records = records if isinstance(records, list) else [records]
+        except ValueError:
+            records = []
+            for line in text.splitlines():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        for record in records:
+            if isinstance(record, dict) and 'span_id' not in record and \
+                    {'function', 'memory', 'duration'} <= set(record):
+                profiles.append({
+                    "function": record['function'],
+                    "memory": int(record['memory']),
+                    "duration": float(record['duration']),
+                    "peak_memory": record.get('peak_memory')})
+    if telemetry:
+        for path in sorted(glob.glob(os.path.join(telemetry, '*.json'))):
+            with open(path) as f:
+                for chunk in json.load(f).get('chunks', []):
+                    if chunk.get('memory') and chunk.get('duration'):
+                        profiles.append({
+                            "function": 'TransformData',
+                            "memory": int(chunk['memory']),
+                            "duration": float(chunk['duration']),
+                            "peak_memory": None})
+    return profiles
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(profiles):
+    """Durations and peak memory of each function by memory size
+    Parameters
+    ----------
+    profiles: list, required
+        Output of read_profiles()
+    Returns
+    -------
+    stats: dict
+        Function to memory size to count, mean, latency and slowest duration and the peak memory
+    """
+
+    groups = defaultdict(lambda: defaultdict(list))
+    for profile in profiles:
+        groups[profile['function']][profile['memory']].append(profile)
+    stats = {}
+    for function, sizes in groups.items():
+        stats[function] = {}
+        for memory, items in sizes.items():
+            durations = [item['duration'] for item in items]
+            peaks = [item['peak_memory'] for item in items if item['peak_memory'] is not None]
+            stats[function][memory] = {
+                "count": len(items),
+                "mean": sum(durations) / len(durations),
+                "latency": percentile(durations, LATENCY_PERCENTILE),
+                "max": max(durations),
+                "peak_memory": max(peaks) if peaks else None}
+    return stats
+
+
+def recommend(sizes, provider, objective):
+    """Memory size and timeout of one function
+    Parameters
+    ----------
+    sizes: dict, required
+        Statistics of the function by memory size, see summarize()
+    provider: string, required
+        Key of PROVIDERS
+    objective: string, required
+        'latency' for the fastest size, 'cost' for the fewest GB-seconds
+    Returns
+    -------
+    recommendation: dict
+        Memory (MB, None where it is not configurable), timeout (seconds) and the statistics of the size
+    """
+
+    settings = PROVIDERS[provider]
+    note = ''
+    low, high = settings['memory'] or (0, math.inf)
+    feasible = {memory: stat for memory, stat in sizes.items()
+                if (stat['peak_memory'] is None or stat['peak_memory'] * (1 + MEMORY_HEADROOM) <= memory)
+                and stat['max'] <= settings['max_timeout'] and low <= memory <= high}
+    if not feasible:
+        # every measured size ran short of memory or time, size up from the largest one
+        memory = max(sizes)
+        stat = sizes[memory]
+        if stat['peak_memory'] is not None:
+            memory = max(memory, math.ceil(stat['peak_memory'] * (1 + MEMORY_HEADROOM)))
+        memory = min(max(memory, low), high)
+        note = 'no measured size fits, measure larger sizes'
+    else:
+        def cost(memory):
+            return memory / 1024 * feasible[memory]['mean']
+
+        if objective == 'latency':
+            best = min(stat['latency'] for stat in feasible.values())
+            memory = min((memory for memory, stat in feasible.items() if stat['latency'] <= best * (1 + TOLERANCE)),
+                         key=cost)
+        else:
+            best = min(cost(memory) for memory in feasible)
+            memory = min((memory for memory in feasible if cost(memory) <= best * (1 + TOLERANCE)),
+                         key=lambda memory: feasible[memory]['latency'])
+        stat = feasible[memory]
+        if len(sizes) == 1:
+            note = 'single measured size'
+    timeout = min(settings['max_timeout'], max(MIN_TIMEOUT, math.ceil(stat['max'] * TIMEOUT_FACTOR)))
+    return {
+        "memory": memory if settings['memory'] else None,
+        "timeout": timeout,
+        "latency": stat['latency'],
+        "gb_seconds": memory / 1024 * stat['mean'],
+        "peak_memory": stat['peak_memory'],
+        "count": stat['count'],
+        "note": note}
+
+
+def load_functions(path):
+    """Function node templates of a service template
+    Parameters
+    ----------
+    path: string, required
+        ServiceTemplate.tosca file
+    Returns
+    -------
+    functions: dict
+        Function name to its node template, provider and current memory and timeout
+    """
+
+    with open(path) as f:
+        template = yaml.safe_load(f)
+    functions = {}
+    for node, definition in template['topology_template']['node_templates'].items():
+        node_type = definition.get('type', '')
+        properties = definition.get('properties') or {}
+        provider = node_type.split('.')[2] if node_type.count('.') >= 3 else None
+        if provider in PROVIDERS and node_type.endswith('Function') and 'name' in properties:
+            functions[properties['name']] = {
+                "node": node,
+                "provider": provider,
+                "memory": properties.get('memory'),
+                "timeout": properties.get('timeout')}
+    return functions
+
+
+def update_template(path, functions, recommendations):
+    """Write memory and timeout properties into the node templates, keeping the layout of the file
+    Parameters
+    ----------
+    path: string, required
+        ServiceTemplate.tosca file
+    functions: dict, required
+        Output of load_functions()
+    recommendations: dict, required
+        Recommendation by function name
+    """
+
+    values = {}
+    for function, recommendation in recommendations.items():
+        settings = PROVIDERS[functions[function]['provider']]
+        values[functions[function]['node']] = {"memory": recommendation['memory']}
+        if settings['timeout_unit']:
+            values[functions[function]['node']]['timeout'] = recommendation['timeout'] * settings['timeout_unit']
+    with open(path) as f:
+        lines = f.read().split('\n')
+    node = None
+    for i, line in enumerate(lines):
+        match = re.match(r'^    (\S+):\s*$', line)
+        if match:
+            node = match.group(1)
+            continue
+        match = re.match(r'^(        )(memory|timeout):\s*\S+\s*$', line)
+        if match and node in values and values[node].get(match.group(2)) is not None:
+            lines[i] = '{}{}: {}'.format(match.group(1), match.group(2), values[node][match.group(2)])
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def update_workflow(path, recommendations):
+    """Set the task timeouts of a workflow to the timeouts of the functions
+    Parameters
+    ----------
+    path: string, required
+        ASL definition, composer module (.js) or host.json of a function app
+    recommendations: dict, required
+        Recommendation by function name
+    """
+
+    with open(path) as f:
+        text = f.read()
+    if os.path.basename(path) == 'host.json':
+        # one timeout for all functions of the app
+        host = json.loads(text)
+        seconds = max(recommendation['timeout'] for recommendation in recommendations.values())
+        host['functionTimeout'] = '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+        text = json.dumps(host, indent=2) + '\n'
+    elif path.endswith('.js'):
+        for function, recommendation in recommendations.items():
+            text = re.sub(r"(composer\.action\('{}', \{{ limits: \{{ timeout: )\d+".format(re.escape(function)),
+                          r'\g<1>{}'.format(recommendation['timeout'] * 1000), text)
+    else:
+        for function, recommendation in recommendations.items():
+            text = re.sub(r'("Resource": "{}_ARN",\s*"TimeoutSeconds": )\d+'.format(re.escape(function)),
+                          r'\g<1>{}'.format(recommendation['timeout']), text)
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def print_recommendations(functions, recommendations):
+    """Print current and recommended settings of each function"""
+
+    print('{:<16} {:>15} {:>13} {:>10} {:>10} {:>10} {:>7}  {}'.format(
+        'function', 'memory (MB)', 'timeout (s)', 'latency', 'GB-s', 'peak (MB)', 'runs', 'note'))
+    for function, recommendation in recommendations.items():
+        current = functions[function]
+        unit = PROVIDERS[current['provider']]['timeout_unit']
+        timeout = current['timeout'] // unit if unit and current['timeout'] else '-'
+        print('{:<16} {:>15} {:>13} {:>9.2f}s {:>10.3f} {:>10} {:>7}  {}'.format(
+            function,
+            '{} -> {}'.format(current['memory'] or '-', recommendation['memory'] or '-'),
+            '{} -> {}'.format(timeout, recommendation['timeout']),
+            recommendation['latency'], recommendation['gb_seconds'],
+            recommendation['peak_memory'] if recommendation['peak_memory'] is not None else '-',
+            recommendation['count'], recommendation['note']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory and timeout sizing of the functions of a service template')
+    parser.add_argument('profiles', nargs='*', help='span files, function logs or benchmark records')
+    parser.add_argument('--template', required=True, help='ServiceTemplate.tosca file')
+    parser.add_argument('--objective', default='latency', choices=['latency', 'cost'], help='what to optimize')
+    parser.add_argument('--telemetry', help='local copy of openaq/telemetry/ for TransformData durations')
+    parser.add_argument('--workflow', action='append', default=[],
+                        help='ASL, composer or host.json file whose timeouts follow the functions')
+    parser.add_argument('--write', action='store_true', help='write the recommendations into the files')
+    parser.add_argument('--json', action='store_true', help='print the recommendations as JSON')
+    args = parser.parse_args()
+
+    functions = load_functions(args.template)
+    stats = summarize(read_profiles(args.profiles, args.telemetry))
+    recommendations = {function: recommend(stats[function], functions[function]['provider'], args.objective)
+                       for function in functions if function in stats}
+    if not recommendations:
+        sys.exit('No profiles of the functions of ' + args.template)
+    if args.json:
+        print(json.dumps(recommendations, indent=2))
+    else:
+        print_recommendations(functions, recommendations)
+        missing = [function for function in functions if function not in recommendations]
+        if missing:
+            print('no profiles: ' + ', '.join(missing))
+    if args.write:
+        update_template(args.template, functions, recommendations)
+        for path in args.workflow:
+            update_workflow(path, recommendations)
+
+
+if __name__ == "__main__":
+    main()
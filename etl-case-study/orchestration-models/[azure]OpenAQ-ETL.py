@@ -1,15 +1,47 @@
 import azure.functions as func
 import azure.durable_functions as df
 
+# compiled from OpenAQ-ETL.bpmn by code/tools/bpmn_compiler.py
+
 def orchestrator_function(context: df.DurableOrchestrationContext):
+    # functionTimeout in host.json bounds every activity to the longest timeout of the model, 600 seconds
+    # retries wait a fixed interval, the Python SDK takes no backoff rate
+    retry_list_files = df.RetryOptions(1000, 3)
+    retry_transform_data = df.RetryOptions(1000, 3)
+    retry_clean_up = df.RetryOptions(1000, 3)
     result = context.get_input()
-    result = yield context.call_activity("ListFiles", result)
-    tasks = []
-    for item in result['value']:
-        tasks.append(context.call_activity("TransformData", item))
-    result = yield context.task_all(tasks)
-    result = yield context.call_activity("AggregateData", result)
-    result = yield context.call_activity("CleanUp", result)
+    result = yield context.call_activity_with_retry("ListFiles", retry_list_files, result)
+    # at most max_concurrency TransformData activities at a time
+    budget = result['max_concurrency']
+    items = result['value']
+    outputs = []
+    for i in range(0, len(items), budget):
+        tasks = [context.call_activity_with_retry("TransformData", retry_transform_data, item) for item in items[i:i + budget]]
+        outputs.extend((yield context.task_all(tasks)))
+    result['value'] = outputs
+    # at most max_concurrency AggregateData activities at a time
+    budget = result['max_concurrency']
+    value = result['value']
+    # a combine level merges groups of 16 results, so no AggregateData reads more of them
+    if len(value) > 16:
+        groups = [value[i:i + 16] for i in range(0, len(value), 16)]
+        combined = []
+        for i in range(0, len(groups), budget):
+            tasks = [context.call_activity("AggregateData", {"combine": True, "value": group, "trace": result['trace']}) for group in groups[i:i + budget]]
+            for output in (yield context.task_all(tasks)):
+                combined.extend(output['value'])
+        value = combined
+    # one AggregateData per date, each with the results of its date
+    days = result['days']
+    outputs = []
+    for i in range(0, len(days), budget):
+        tasks = []
+        for date in days[i:i + budget]:
+            items = [item for item in value if item.get('date') == date]
+            tasks.append(context.call_activity("AggregateData", {"date": date, "value": items, "trace": result['trace']}))
+        outputs.extend((yield context.task_all(tasks)))
+    result['value'] = outputs
+    result = yield context.call_activity_with_retry("CleanUp", retry_clean_up, result)
     return result
 
-main = df.Orchestrator.create(orchestrator_function)
\ No newline at end of file
+main = df.Orchestrator.create(orchestrator_function)